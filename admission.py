@@ -0,0 +1,239 @@
+import time
+
+# Максимальное количество одновременно ожидающих и выполняющихся
+# генераций по запросам игроков. Запросы сверх него отклоняются.
+MAX_QUEUE_DEPTH = 16
+# Глубина очереди, начиная с которой не ставится фоновая генерация
+# соседних локаций.
+PREFETCH_SHED_DEPTH = 8
+# Количество генераций, которые чат может запросить подряд, и скорость
+# восстановления этого запаса в генерациях в секунду. Показ изображений
+# из кэша и заранее сгенерированных изображений не ограничивается.
+RATE_LIMIT_BURST = 3
+RATE_LIMIT_PER_SECOND = 0.2
+# Количество чатов, после которого ограничения чатов с полным запасом
+# удаляются.
+MAX_TRACKED_CHATS = 10_000
+
+
+class OverloadedError(RuntimeError):
+    """
+    Запрос отклонён, так как очередь генерации заполнена.
+    """
+
+
+class RateLimitedError(RuntimeError):
+    """
+    Запрос отклонён, так как чат слишком часто запрашивает генерацию.
+    """
+
+
+class TokenBucket:
+    """
+    Ограничение частоты запросов одного чата.
+
+    Attributes:
+        tokens(float): Доступное количество запросов.
+        updated_at(float): Время последнего пересчёта запаса.
+    """
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self,
+                 tokens: float,
+                 updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+    def take(self,
+             capacity: float,
+             rate: float,
+             now: float):
+        """
+        Расход одного запроса с восстановлением запаса за прошедшее
+        время.
+
+        Parameters:
+            capacity(float): Максимальный запас.
+            rate(float): Скорость восстановления в запросах в секунду.
+            now(float): Текущее время.
+
+        Returns:
+            bool: Разрешён ли запрос.
+        """
+        self.tokens = min(capacity,
+                          self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController:
+    """
+    Допуск запросов к генерации. Ограничивает частоту генераций каждого
+    чата, общее количество генераций в очереди и объединяет повторные
+    нажатия: пока запрос чата выполняется, новые нажатия только
+    запоминаются, а после завершения выполняется один запрос с последним
+    выбором.
+
+    Все методы вызываются из цикла событий.
+
+    Attributes:
+        max_queue_depth(int): Максимальное количество генераций в
+        очереди.
+        prefetch_shed_depth(int): Глубина очереди, с которой фоновая
+        генерация не ставится.
+        burst(float): Количество запросов чата подряд.
+        rate(float): Скорость восстановления запросов чата в секунду.
+        depth(int): Текущее количество генераций в очереди.
+        rate_limited(int): Количество запросов, отклонённых по частоте.
+        shed(int): Количество генераций, отклонённых из-за заполненной
+        очереди.
+        prefetch_shed(int): Количество пропущенных фоновых генераций.
+        coalesced(int): Количество нажатий, объединённых с выполняющимся
+        запросом.
+    """
+
+    def __init__(self,
+                 max_queue_depth=MAX_QUEUE_DEPTH,
+                 prefetch_shed_depth=PREFETCH_SHED_DEPTH,
+                 burst=RATE_LIMIT_BURST,
+                 rate=RATE_LIMIT_PER_SECOND):
+        self.max_queue_depth = max_queue_depth
+        self.prefetch_shed_depth = prefetch_shed_depth
+        self.burst = burst
+        self.rate = rate
+        self.depth = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.prefetch_shed = 0
+        self.coalesced = 0
+        self._buckets = {}
+        self._active = {}
+
+    def allow(self,
+              chat_id: int):
+        """
+        Проверка частоты запросов чата.
+
+        Parameters:
+            chat_id(int): Id чата.
+
+        Returns:
+            bool: Разрешён ли запрос.
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_CHATS:
+                self._forget_idle(now)
+            bucket = self._buckets[chat_id] = TokenBucket(self.burst,
+                                                          now)
+        if bucket.take(self.burst,
+                       self.rate,
+                       now):
+            return True
+        self.rate_limited += 1
+        return False
+
+    def begin(self,
+              chat_id: int):
+        """
+        Начало запроса чата.
+
+        Parameters:
+            chat_id(int): Id чата.
+
+        Returns:
+            bool: True, если запрос нужно выполнить. False, если у чата
+            уже выполняется запрос: он будет повторён с последним выбором.
+        """
+        if chat_id in self._active:
+            self._active[chat_id] = True
+            self.coalesced += 1
+            return False
+        self._active[chat_id] = False
+        return True
+
+    def finish(self,
+               chat_id: int):
+        """
+        Завершение запроса чата.
+
+        Parameters:
+            chat_id(int): Id чата.
+
+        Returns:
+            bool: True, если во время выполнения были новые нажатия и
+            запрос нужно повторить с последним выбором.
+        """
+        if self._active.get(chat_id):
+            self._active[chat_id] = False
+            return True
+        self._active.pop(chat_id, None)
+        return False
+
+    def abandon(self,
+                chat_id: int):
+        """
+        Завершение запроса чата без повтора, например при ошибке.
+
+        Parameters:
+            chat_id(int): Id чата.
+        """
+        self._active.pop(chat_id, None)
+
+    def enter(self):
+        """
+        Допуск генерации в очередь.
+
+        Raises:
+            OverloadedError: Очередь заполнена.
+        """
+        if self.depth >= self.max_queue_depth:
+            self.shed += 1
+            raise OverloadedError("generation queue is full")
+        self.depth += 1
+
+    def leave(self):
+        """
+        Завершение генерации, допущенной enter.
+        """
+        self.depth -= 1
+
+    def allow_prefetch(self):
+        """
+        Проверка, можно ли поставить фоновую генерацию.
+
+        Returns:
+            bool: Очередь не загружена запросами игроков.
+        """
+        if self.depth >= self.prefetch_shed_depth:
+            self.prefetch_shed += 1
+            return False
+        return True
+
+    def _forget_idle(self,
+                     now: float):
+        # Чат с полным запасом не отличается от нового чата.
+        for chat_id, bucket in list(self._buckets.items()):
+            if (bucket.tokens + (now - bucket.updated_at) * self.rate
+                    >= self.burst):
+                del self._buckets[chat_id]
+
+    def stats(self):
+        """
+        Статистика допуска запросов.
+
+        Returns:
+            dict: Текущая глубина очереди и количество отклонённых,
+            пропущенных и объединённых запросов.
+        """
+        return {"depth": self.depth,
+                "max_queue_depth": self.max_queue_depth,
+                "rate_limited": self.rate_limited,
+                "shed": self.shed,
+                "prefetch_shed": self.prefetch_shed,
+                "coalesced": self.coalesced,
+                "active_chats": len(self._active)}
@@ -0,0 +1,276 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# Количество потоков для запросов к БД. У каждого потока своё
+# подключение peewee, WAL позволяет им читать параллельно.
+DATABASE_WORKERS = 2
+# Запросы дольше этого времени в секундах выводятся в консоль.
+SLOW_QUERY_TIME = 0.5
+
+
+class QueryStats:
+    """
+    Статистика выполнения запросов одного вида.
+
+    Attributes:
+        count(int): Количество запросов.
+        errors(int): Количество запросов, завершившихся ошибкой.
+        total_wait_time(float): Суммарное время ожидания свободного потока.
+        total_query_time(float): Суммарное время выполнения запросов.
+        max_query_time(float): Максимальное время выполнения запроса.
+    """
+    __slots__ = ("count", "errors", "total_wait_time", "total_query_time",
+                 "max_query_time")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_wait_time = 0.0
+        self.total_query_time = 0.0
+        self.max_query_time = 0.0
+
+
+class AsyncDatabase:
+    """
+    Асинхронный доступ к БД. Запросы выполняются в отдельном пуле
+    потоков, поэтому медленный диск или ожидание блокировки не
+    останавливают обработку сообщений других пользователей.
+
+    Результаты запросов peewee читаются полностью в потоке БД, чтобы в
+    цикле событий не выполнялось обращений к курсору.
+
+    Attributes:
+        workers(int): Количество потоков для запросов.
+        slow_query_time(float): Время, после которого запрос считается
+        медленным.
+    """
+
+    def __init__(self,
+                 workers=DATABASE_WORKERS,
+                 slow_query_time=SLOW_QUERY_TIME):
+        self.workers = workers
+        self.slow_query_time = slow_query_time
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="database")
+        self._hooks = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self,
+                 hook):
+        """
+        Добавление функции, вызываемой после каждого запроса.
+
+        Parameters:
+            hook(Callable[[str, float, float], None]): Функция, получающая
+            название запроса, время ожидания потока и время выполнения.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self,
+                    hook):
+        """
+        Удаление функции, вызываемой после каждого запроса.
+
+        Parameters:
+            hook(Callable[[str, float, float], None]): Добавленная функция.
+        """
+        self._hooks.remove(hook)
+
+    def _execute(self,
+                 name: str,
+                 function,
+                 args: tuple,
+                 submitted_at: float,
+                 materialize: bool):
+        started_at = time.perf_counter()
+        failed = False
+        try:
+            result = function(*args)
+            if materialize and result is not None:
+                result = list(result)
+            return result
+        except Exception:
+            failed = True
+            raise
+        finally:
+            finished_at = time.perf_counter()
+            self._record(name,
+                         started_at - submitted_at,
+                         finished_at - started_at,
+                         failed)
+
+    def _record(self,
+                name: str,
+                wait_time: float,
+                query_time: float,
+                failed: bool):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = QueryStats()
+            stats.count += 1
+            stats.errors += failed
+            stats.total_wait_time += wait_time
+            stats.total_query_time += query_time
+            stats.max_query_time = max(stats.max_query_time,
+                                       query_time)
+
+        if query_time >= self.slow_query_time:
+            print(f"slow query {name}: {query_time:.3f} s")
+        for hook in self._hooks:
+            try:
+                hook(name,
+                     wait_time,
+                     query_time)
+            except Exception as e:
+                print(e)
+
+    async def run(self,
+                  name: str,
+                  function,
+                  *args,
+                  materialize=False):
+        """
+        Выполнение функции доступа к БД в потоке БД.
+
+        Parameters:
+            name(str): Название запроса для статистики.
+            function(Callable): Функция, выполняющая запрос.
+            args: Аргументы функции.
+            materialize(bool): Прочитать результат запроса в список.
+
+        Returns:
+            Any: Результат функции.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          self._execute,
+                                          name,
+                                          function,
+                                          args,
+                                          time.perf_counter(),
+                                          materialize)
+
+    async def get_point_map(self,
+                            point_map_id: int):
+        """
+        Асинхронный вариант db.get_point_map.
+        """
+        return await self.run("get_point_map",
+                              db.get_point_map,
+                              point_map_id)
+
+    async def get_available_routes(self,
+                                   point_map_id: int):
+        """
+        Асинхронный вариант db.get_available_routes.
+        """
+        return await self.run("get_available_routes",
+                              db.get_available_routes,
+                              point_map_id,
+                              materialize=True)
+
+    async def get_statistic(self):
+        """
+        Асинхронный вариант db.get_statistic.
+        """
+        return await self.run("get_statistic",
+                              db.get_statistic,
+                              materialize=True)
+
+    async def get_statistic_buckets(self,
+                                    since: int):
+        """
+        Асинхронный вариант db.get_statistic_buckets.
+        """
+        return await self.run("get_statistic_buckets",
+                              db.get_statistic_buckets,
+                              since,
+                              materialize=True)
+
+    async def get_statistic_columns(self,
+                                    after_id=0):
+        """
+        Асинхронный вариант db.get_statistic_columns.
+        """
+        return await self.run("get_statistic_columns",
+                              db.get_statistic_columns,
+                              after_id)
+
+    async def add_statistics(self,
+                             records: list[dict]):
+        """
+        Асинхронный вариант db.add_statistics.
+        """
+        return await self.run("add_statistics",
+                              db.add_statistics,
+                              records)
+
+    async def get_telegram_file_ids(self):
+        """
+        Асинхронный вариант db.get_telegram_file_ids.
+        """
+        return await self.run("get_telegram_file_ids",
+                              db.get_telegram_file_ids)
+
+    async def set_telegram_file_id(self,
+                                   content_hash: str,
+                                   file_id: str):
+        """
+        Асинхронный вариант db.set_telegram_file_id.
+        """
+        return await self.run("set_telegram_file_id",
+                              db.set_telegram_file_id,
+                              content_hash,
+                              file_id)
+
+    async def delete_telegram_file_id(self,
+                                      content_hash: str):
+        """
+        Асинхронный вариант db.delete_telegram_file_id.
+        """
+        return await self.run("delete_telegram_file_id",
+                              db.delete_telegram_file_id,
+                              content_hash)
+
+    async def refresh_route_graph(self,
+                                  route_graph):
+        """
+        Проверка изменений карты и перестроение графа маршрутов в потоке
+        БД.
+
+        Parameters:
+            route_graph(RouteGraph): Граф маршрутов.
+        """
+        return await self.run("refresh_route_graph",
+                              route_graph.refresh_if_changed)
+
+    def stats(self):
+        """
+        Статистика выполнения запросов.
+
+        Returns:
+            dict: Количество запросов, ошибок, среднее время ожидания
+            потока, среднее и максимальное время выполнения по каждому
+            виду запросов.
+        """
+        with self._lock:
+            return {name: {"count": stats.count,
+                           "errors": stats.errors,
+                           "avg_wait_time": (stats.total_wait_time
+                                             / stats.count),
+                           "avg_query_time": (stats.total_query_time
+                                              / stats.count),
+                           "max_query_time": stats.max_query_time}
+                    for name, stats in self._stats.items()}
+
+    def close(self):
+        """
+        Остановка пула потоков после завершения начатых запросов.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,106 @@
+import heapq
+
+# Объединение запросов в пакеты включается явно, так как увеличивает
+# задержку первого запроса пакета на BATCH_WINDOW.
+BATCHING_ENABLED = False
+MAX_BATCH_SIZE = 4
+BATCH_WINDOW = 0.05
+
+
+class MicroBatcher:
+    """
+    Объединение ожидающих в очереди заданий с одинаковыми параметрами
+    генерации в один пакетный вызов модели.
+
+    Attributes:
+        max_batch_size(int): Максимальный размер пакета.
+        window(float): Время ожидания попутных заданий в секундах.
+    """
+
+    def __init__(self,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 window=BATCH_WINDOW):
+        self.max_batch_size = max_batch_size
+        self.window = window
+
+    def count_compatible(self,
+                         job,
+                         pending: list):
+        """
+        Количество ожидающих заданий, которые можно объединить с
+        заданием.
+
+        Parameters:
+            job(GenerationJob): Задание, открывающее пакет.
+            pending(list[GenerationJob]): Очередь ожидающих заданий.
+
+        Returns:
+            int: Количество совместимых заданий.
+        """
+        return sum(1 for other in pending
+                   if other.batch_key == job.batch_key
+                   and not other.future.done())
+
+    def take_batch(self,
+                   job,
+                   pending: list):
+        """
+        Извлечение из очереди заданий, совместимых с заданием, в порядке
+        приоритета.
+
+        Parameters:
+            job(GenerationJob): Задание, открывающее пакет.
+            pending(list[GenerationJob]): Очередь ожидающих заданий
+            (куча), изменяется на месте.
+
+        Returns:
+            list[GenerationJob]: Пакет заданий, первым идёт job.
+        """
+        batch = [job]
+        compatible = sorted(other for other in pending
+                            if other.batch_key == job.batch_key
+                            and not other.future.done())
+        for other in compatible[:self.max_batch_size - 1]:
+            batch.append(other)
+            pending.remove(other)
+        heapq.heapify(pending)
+        return batch
+
+
+def generate_batch(batch_args: list[tuple],
+                   batch_kwargs: list[dict],
+                   should_stop=None):
+    """
+    Пакетная генерация изображений для заданий планировщика. Каждое
+    задание передаёт аргументы (neural_network, prompt), необязательную
+    функцию progress и признак предварительного изображения preview,
+    одинаковый для всего пакета.
+
+    Parameters:
+        batch_args(list[tuple]): Аргументы заданий пакета.
+        batch_kwargs(list[dict]): Именованные аргументы заданий пакета.
+        should_stop(object): Функция should_stop(), по которой генерация
+        прерывается между шагами.
+
+    Returns:
+        list[bytes]: Закодированные изображения в порядке заданий. Если
+        генерация не удалась, для каждого задания возвращается None.
+    """
+    neural_network = batch_args[0][0]
+    prompts = [args[1] for args in batch_args]
+    progresses = [kwargs["progress"] for kwargs in batch_kwargs
+                  if kwargs.get("progress") is not None]
+
+    def progress(step, total):
+        for callback in progresses:
+            callback(step,
+                     total)
+
+    images = neural_network.generate_images(prompts,
+                                            progress if progresses else None,
+                                            should_stop,
+                                            batch_kwargs[0].get("preview",
+                                                                False))
+    if images is None:
+        return [None] * len(prompts)
+    return images
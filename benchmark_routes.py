@@ -0,0 +1,101 @@
+"""
+Замер времени поиска доступных маршрутов (db.get_available_routes) в
+зависимости от размера карты: на схеме без индексов и после миграций.
+
+Запуск:
+    python benchmark_routes.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+import db
+import migrations
+import texts as tx
+
+ROUTE_COUNTS = [1_000, 10_000, 100_000]
+ROUTES_PER_POINT = 2
+LOOKUPS = 200
+
+
+def create_map(database: SqliteDatabase,
+               route_count: int):
+    """
+    Создание карты со схемой без индексов и случайными маршрутами.
+
+    Parameters:
+        database(SqliteDatabase): БД.
+        route_count(int): Количество маршрутов.
+
+    Returns:
+        int: Количество точек на карте.
+    """
+    point_count = max(route_count // ROUTES_PER_POINT, 2)
+    database.execute_sql('CREATE TABLE "PointMaps" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"name" VARCHAR(255) NOT NULL, '
+                         '"description" TEXT NOT NULL, '
+                         '"ai_description" TEXT NOT NULL)')
+    database.execute_sql('CREATE TABLE "route" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"point_map_id" INTEGER NOT NULL, '
+                         '"another_point_map_id" INTEGER NOT NULL)')
+    database.execute_sql('CREATE TABLE "statistic" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"neural_network_name" VARCHAR(255) NOT NULL, '
+                         '"time_generated" DATETIME, '
+                         '"time_loaded" DATETIME)')
+
+    with database.atomic():
+        database.cursor().executemany(
+            'INSERT INTO "PointMaps" VALUES (?, ?, ?, ?)',
+            ((point_id, f"point {point_id}", "description", "prompt")
+             for point_id in range(1, point_count + 1)))
+        database.cursor().executemany(
+            'INSERT INTO "route" ("point_map_id", "another_point_map_id") '
+            'VALUES (?, ?)',
+            ((random.randint(1, point_count), random.randint(1, point_count))
+             for _ in range(route_count)))
+    return point_count
+
+
+def measure_lookups(point_count: int):
+    """
+    Среднее время поиска маршрутов из случайной точки на карте.
+
+    Parameters:
+        point_count(int): Количество точек на карте.
+
+    Returns:
+        float: Среднее время в миллисекундах.
+    """
+    point_ids = [random.randint(1, point_count) for _ in range(LOOKUPS)]
+    start_time = time.perf_counter()
+    for point_id in point_ids:
+        list(db.get_available_routes(point_id))
+    return (time.perf_counter() - start_time) / LOOKUPS * 1000
+
+
+def main():
+    random.seed(0)
+    print(f"{'routes':>8} {'no index, ms':>14} {'migrated, ms':>14}")
+    for route_count in ROUTE_COUNTS:
+        with tempfile.TemporaryDirectory() as directory:
+            database = SqliteDatabase(os.path.join(directory, "routes.db"),
+                                      pragmas=db.PRAGMAS)
+            with database.bind_ctx([db.PointMap, db.Route, db.Statistic]):
+                point_count = create_map(database,
+                                         route_count)
+                time_without_indexes = measure_lookups(point_count)
+                migrations.migrate(database)
+                time_migrated = measure_lookups(point_count)
+            database.close()
+        print(f"{route_count:>8} {time_without_indexes:>14.3f} "
+              f"{time_migrated:>14.3f}")
+
+
+if __name__ == tx.MAIN_MODULE_NAME:
+    main()
@@ -1,8 +1,33 @@
+import time
+
+import numpy as np
 import peewee
 
 from peewee import *
 
-connection = SqliteDatabase('routes.db')
+import migrations
+from quantile_sketch import QuantileSketch
+
+# WAL позволяет читать БД во время записи статистики, остальные
+# параметры уменьшают количество синхронизаций с диском.
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+}
+
+# Длительность интервала, по которому сводится статистика, в секундах.
+STATISTIC_BUCKET_SECONDS = 3600
+# Интервал сводной статистики за всё время.
+ALL_TIME_BUCKET = 0
+STATISTIC_METRICS = ('time_generated', 'time_loaded', 'time_cancelled',
+                     'time_timed_out', 'time_first_image')
+PERCENTILES = (0.5, 0.95, 0.99)
+
+connection = SqliteDatabase('routes.db',
+                            pragmas=PRAGMAS)
 cursor = connection.cursor()
 
 
@@ -40,7 +65,8 @@ class Route(BaseModel):
         point_map_id(int): Id точки на карте.
         another_point_map_id(int): Id связанной точки на карте.
     """
-    point_map_id = IntegerField(column_name='point_map_id')
+    point_map_id = IntegerField(column_name='point_map_id',
+                                index=True)
     another_point_map_id = ForeignKeyField(column_name='another_point_map_id',
                                            model=PointMap)
 
@@ -48,21 +74,104 @@ class Route(BaseModel):
 class Statistic(BaseModel):
     """
     Статистика по времени генерации изображений и времени загрузки
-    нейронных сетей.
+    нейронных сетей. В каждой записи задано одно поле времени.
 
     Attributes:
         neural_network_name(str): Название нейронной сети.
-        time_generated(datetime): Время генерации изображения.
-        time_loaded(datetime): Время загрузки нейронной сети.
+        time_generated(float): Время генерации изображения в секундах.
+        time_loaded(float): Время загрузки нейронной сети в секундах.
+        time_cancelled(float): Время от запроса до отмены генерации
+        игроком в секундах.
+        time_timed_out(float): Время от запроса до остановки генерации
+        по превышению времени в секундах.
+        time_first_image(float): Время от запроса до отправки первого
+        изображения, предварительного или в полном качестве, в секундах.
     """
-    neural_network_name = CharField(column_name='neural_network_name')
-    time_generated = DateTimeField(column_name='time_generated',
-                                   null=True)
-    time_loaded = DateTimeField(column_name='time_loaded',
+    neural_network_name = CharField(column_name='neural_network_name',
+                                    index=True)
+    time_generated = FloatField(column_name='time_generated',
+                                null=True)
+    time_loaded = FloatField(column_name='time_loaded',
+                             null=True)
+    time_cancelled = FloatField(column_name='time_cancelled',
                                 null=True)
+    time_timed_out = FloatField(column_name='time_timed_out',
+                                null=True)
+    time_first_image = FloatField(column_name='time_first_image',
+                                  null=True)
+
+
+class StatisticRollup(BaseModel):
+    """
+    Сводная статистика по нейронной сети за интервал времени. Обновляется
+    при каждой записи статистики.
+
+    Attributes:
+        neural_network_name(str): Название нейронной сети.
+        metric(str): Поле статистики из STATISTIC_METRICS.
+        bucket_start(int): Начало интервала в секундах от эпохи Unix,
+        ALL_TIME_BUCKET для статистики за всё время.
+        count(int): Количество измерений.
+        total(float): Сумма измерений.
+        min_value(float): Минимальное измерение.
+        max_value(float): Максимальное измерение.
+        sketch(str): Скетч перцентилей в формате JSON.
+    """
+    neural_network_name = CharField(column_name='neural_network_name')
+    metric = CharField(column_name='metric')
+    bucket_start = IntegerField(column_name='bucket_start')
+    count = IntegerField(column_name='count')
+    total = FloatField(column_name='total')
+    min_value = FloatField(column_name='min_value')
+    max_value = FloatField(column_name='max_value')
+    sketch = TextField(column_name='sketch')
+
+    class Meta:
+        table_name = 'statistic_rollup'
+        indexes = (
+            (('bucket_start', 'neural_network_name', 'metric'), True),
+        )
+
+    @property
+    def average(self):
+        """
+        Среднее значение измерений.
+        """
+        return self.total / self.count
+
+    def get_percentiles(self):
+        """
+        Оценка перцентилей PERCENTILES по скетчу.
+
+        Returns:
+            list[float]: Значения перцентилей.
+        """
+        sketch = QuantileSketch.from_json(self.sketch)
+        return [min(max(sketch.quantile(q), self.min_value), self.max_value)
+                for q in PERCENTILES]
+
+
+class TelegramFile(BaseModel):
+    """
+    Файл, уже загруженный в Telegram.
+
+    Attributes:
+        content_hash(str): Хэш содержимого файла (sha256).
+        file_id(str): Идентификатор файла в Telegram.
+    """
+    content_hash = CharField(column_name='content_hash',
+                             primary_key=True)
+    file_id = TextField(column_name='file_id')
+
+    class Meta:
+        table_name = 'telegram_file'
 
 
-connection.create_tables([PointMap, Route, Statistic], )
+is_new_database = not connection.get_tables()
+connection.create_tables([PointMap, Route, Statistic, StatisticRollup,
+                          TelegramFile], )
+migrations.migrate(connection,
+                   is_new_database)
 
 
 def get_available_routes(point_map_id):
@@ -82,7 +191,8 @@ def get_available_routes(point_map_id):
 
         available_routes = (Route.select(PointMap.id,
                                          PointMap.name,
-                                         PointMap.description).
+                                         PointMap.description,
+                                         PointMap.ai_description).
                             join(PointMap, on=join_condition).
                             where((PointMap.id != point_map_id)
                                   & ((Route.point_map_id == point_map_id)
@@ -94,6 +204,17 @@ def get_available_routes(point_map_id):
         print(de)
 
 
+def get_map_version():
+    """
+    Возвращает счётчик изменений точек на карте и маршрутов.
+
+    Returns:
+        int: Версия карты.
+    """
+    return connection.execute_sql('SELECT "version" FROM "map_version" '
+                                  'WHERE "id" = 1').fetchone()[0]
+
+
 def get_point_map(point_map_id: int):
     """
     Возвращает точку на карте по ее id.
@@ -114,51 +235,95 @@ def get_point_map(point_map_id: int):
 
 def get_statistic():
     """
-    Возвращает статистику по времени генерации изображений и времени
-    загрузки нейронных сетей.
+    Возвращает сводную статистику по времени генерации изображений и
+    времени загрузки нейронных сетей за всё время. Читается по одной
+    строке на нейронную сеть и поле статистики.
 
     Returns:
-        Any: Статистика по времени генерации изображений и времени
-        загрузки нейронных сетей.
+        list[StatisticRollup]: Сводная статистика, упорядоченная по
+        названию нейронной сети и полю статистики.
     """
     try:
-        statistic = (Statistic.select(Statistic.neural_network_name,
-                                      peewee.fn.AVG(Statistic.time_generated)
-                                      .alias('time_generated'),
-                                      peewee.fn.AVG(Statistic.time_loaded)
-                                      .alias('time_loaded'))
-                     .group_by(Statistic.neural_network_name)
-                     .order_by(Statistic.neural_network_name)
-                     .objects())
+        statistic = (StatisticRollup.select()
+                     .where(StatisticRollup.bucket_start == ALL_TIME_BUCKET)
+                     .order_by(StatisticRollup.neural_network_name,
+                               StatisticRollup.metric))
 
         return statistic
     except DoesNotExist as de:
         print(de)
 
 
-def get_statistic_detailed():
+def get_statistic_buckets(since: int):
     """
-    Возвращает детальную статистику по времени генерации изображений и
-    времени загрузки нейронных сетей.
-    Время генерации каждого изображения, и время загрузки каждой
-    нейронной сети.
+    Возвращает сводную статистику по интервалам времени.
+
+    Parameters:
+        since(int): Начало первого интервала в секундах от эпохи Unix.
 
     Returns:
-        Any: Детальная статистика по времени генерации изображений и
-        времени загрузки нейронных сетей.
+        list[StatisticRollup]: Сводная статистика, упорядоченная по
+        началу интервала, названию нейронной сети и полю статистики.
     """
     try:
-        statistic = (Statistic.select(Statistic.neural_network_name,
-                                      Statistic.time_generated,
-                                      Statistic.time_loaded)
-                     .order_by(Statistic.neural_network_name)
-                     .objects())
+        statistic = (StatisticRollup.select()
+                     .where(StatisticRollup.bucket_start >= max(since, 1))
+                     .order_by(StatisticRollup.bucket_start,
+                               StatisticRollup.neural_network_name,
+                               StatisticRollup.metric))
 
         return statistic
     except DoesNotExist as de:
         print(de)
 
 
+def get_statistic_columns(after_id=0):
+    """
+    Возвращает детальную статистику по столбцам в массивах NumPy.
+    Название нейронной сети заменяется номером в самом запросе, поэтому
+    массивы заполняются из курсора без создания строк и промежуточных
+    списков.
+
+    Parameters:
+        after_id(int): Возвращаются только записи с большим id.
+
+    Returns:
+        tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        Названия нейронных сетей, id записей, номер названия для каждой
+        записи, время генерации и время загрузки (NaN, если значение не
+        задано). Записи упорядочены по id.
+    """
+    with connection.atomic():
+        names = [name for name, in connection.execute_sql(
+            'SELECT DISTINCT "neural_network_name" FROM "statistic" '
+            'ORDER BY "neural_network_name"')]
+        codes = ' '.join(f'WHEN ? THEN {code}'
+                         for code in range(len(names)))
+        rows = connection.execute_sql(
+            f'SELECT "id", CASE "neural_network_name" {codes} END, '
+            f'IFNULL("time_generated", -1), IFNULL("time_loaded", -1) '
+            f'FROM "statistic" WHERE "id" > ? ORDER BY "id"',
+            names + [after_id]) if names else ()
+        columns = np.fromiter(rows,
+                              dtype=[('id', np.int64),
+                                     ('code', np.int16),
+                                     ('time_generated', np.float64),
+                                     ('time_loaded', np.float64)])
+
+    # Время не бывает отрицательным, поэтому -1 обозначает пустое значение.
+    time_generated = np.where(columns['time_generated'] < 0,
+                              np.nan,
+                              columns['time_generated'])
+    time_loaded = np.where(columns['time_loaded'] < 0,
+                           np.nan,
+                           columns['time_loaded'])
+    return (names,
+            columns['id'],
+            columns['code'],
+            time_generated,
+            time_loaded)
+
+
 def add_statistic_generated(neural_network_name: str,
                             time_generated: float):
     """
@@ -168,11 +333,12 @@ def add_statistic_generated(neural_network_name: str,
         neural_network_name(str): Название нейронной сети.
         time_generated(float): Время генерации изображения.
     """
-    try:
-        Statistic.create(neural_network_name=neural_network_name,
-                         time_generated=time_generated)
-    except IntegrityError as ie:
-        print(ie)
+    add_statistics([{'neural_network_name': neural_network_name,
+                     'time_generated': time_generated,
+                     'time_loaded': None,
+                     'time_cancelled': None,
+                     'time_timed_out': None,
+                     'time_first_image': None}])
 
 
 def add_statistic_loaded(neural_network_name: str,
@@ -184,8 +350,116 @@ def add_statistic_loaded(neural_network_name: str,
         neural_network_name(str): Название нейронной сети.
         time_loaded(float): Время загрузки нейронной сети.
     """
+    add_statistics([{'neural_network_name': neural_network_name,
+                     'time_generated': None,
+                     'time_loaded': time_loaded,
+                     'time_cancelled': None,
+                     'time_timed_out': None,
+                     'time_first_image': None}])
+
+
+def update_statistic_rollups(records: list[dict],
+                             bucket_start: int):
+    """
+    Добавляет записи статистики в сводную статистику за интервал и за
+    всё время.
+
+    Parameters:
+        records(list[dict]): Записи статистики с полями
+        neural_network_name и STATISTIC_METRICS.
+        bucket_start(int): Начало интервала в секундах от эпохи Unix.
+    """
+    values = {}
+    for record in records:
+        for metric in STATISTIC_METRICS:
+            value = record.get(metric)
+            if value is not None:
+                values.setdefault((record['neural_network_name'], metric),
+                                  []).append(value)
+
+    for (neural_network_name, metric), metric_values in values.items():
+        for bucket in (bucket_start, ALL_TIME_BUCKET):
+            rollup = StatisticRollup.get_or_none(
+                (StatisticRollup.bucket_start == bucket)
+                & (StatisticRollup.neural_network_name
+                   == neural_network_name)
+                & (StatisticRollup.metric == metric))
+            if rollup is None:
+                rollup = StatisticRollup(
+                    neural_network_name=neural_network_name,
+                    metric=metric,
+                    bucket_start=bucket,
+                    count=0,
+                    total=0.0,
+                    min_value=min(metric_values),
+                    max_value=max(metric_values))
+                sketch = QuantileSketch()
+            else:
+                sketch = QuantileSketch.from_json(rollup.sketch)
+
+            for value in metric_values:
+                sketch.add(value)
+            rollup.count += len(metric_values)
+            rollup.total += sum(metric_values)
+            rollup.min_value = min(rollup.min_value, *metric_values)
+            rollup.max_value = max(rollup.max_value, *metric_values)
+            rollup.sketch = sketch.to_json()
+            rollup.save()
+
+
+def add_statistics(records: list[dict]):
+    """
+    Добавляет несколько записей статистики и обновляет сводную
+    статистику одной транзакцией.
+
+    Parameters:
+        records(list[dict]): Записи статистики с полями
+        neural_network_name и STATISTIC_METRICS.
+    """
+    bucket_start = (int(time.time()) // STATISTIC_BUCKET_SECONDS
+                    * STATISTIC_BUCKET_SECONDS)
     try:
-        Statistic.create(neural_network_name=neural_network_name,
-                         time_loaded=time_loaded)
+        with connection.atomic():
+            Statistic.insert_many(records).execute()
+            update_statistic_rollups(records,
+                                     bucket_start)
     except IntegrityError as ie:
         print(ie)
+
+
+def get_telegram_file_ids():
+    """
+    Возвращает идентификаторы всех файлов, загруженных в Telegram.
+
+    Returns:
+        dict[str, str]: Идентификатор файла по хэшу содержимого.
+    """
+    return dict(TelegramFile.select(TelegramFile.content_hash,
+                                    TelegramFile.file_id).tuples())
+
+
+def set_telegram_file_id(content_hash: str,
+                         file_id: str):
+    """
+    Сохраняет идентификатор файла, загруженного в Telegram.
+
+    Parameters:
+        content_hash(str): Хэш содержимого файла.
+        file_id(str): Идентификатор файла в Telegram.
+    """
+    (TelegramFile.insert(content_hash=content_hash,
+                         file_id=file_id)
+     .on_conflict_replace()
+     .execute())
+
+
+def delete_telegram_file_id(content_hash: str):
+    """
+    Удаляет идентификатор файла, который Telegram больше не принимает.
+
+    Parameters:
+        content_hash(str): Хэш содержимого файла.
+    """
+    (TelegramFile.delete()
+     .where(TelegramFile.content_hash == content_hash)
+     .execute())
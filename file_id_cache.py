@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, InputMediaPhoto, Message
+
+from async_db import AsyncDatabase
+
+
+class FileIdCache:
+    """
+    Повторное использование файлов, уже загруженных в Telegram. После
+    первой загрузки изображения запоминается file_id, который Telegram
+    вернул для его содержимого, и повторные отправки того же содержимого
+    передают только file_id, не загружая файл.
+
+    Соответствие хранится в БД рядом с маршрутами и переживает
+    перезапуск бота. Ключом служит хэш содержимого, поэтому изменённое
+    изображение загружается заново. Если Telegram не принимает file_id,
+    запись удаляется и файл загружается снова.
+
+    Attributes:
+        database(AsyncDatabase): Асинхронный доступ к БД.
+        hits(int): Количество отправок по file_id.
+        misses(int): Количество загрузок файлов.
+        invalidations(int): Количество отклонённых file_id.
+        uploaded_bytes(int): Объём загруженных файлов.
+    """
+
+    def __init__(self,
+                 database: AsyncDatabase):
+        self.database = database
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.uploaded_bytes = 0
+        self._file_ids = None
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        async with self._lock:
+            if self._file_ids is None:
+                self._file_ids = await self.database.get_telegram_file_ids()
+        return self._file_ids
+
+    async def invalidate(self,
+                         content_hash: str):
+        """
+        Удаление file_id для содержимого.
+
+        Parameters:
+            content_hash(str): Хэш содержимого файла.
+        """
+        file_ids = await self._load()
+        if file_ids.pop(content_hash, None) is not None:
+            self.invalidations += 1
+            await self.database.delete_telegram_file_id(content_hash)
+
+    async def send_photo(self,
+                         bot: Bot,
+                         chat_id: int,
+                         data: bytes,
+                         filename: str,
+                         **kwargs):
+        """
+        Отправка изображения по file_id, если такое содержимое уже
+        загружалось, иначе загрузка файла.
+
+        Parameters:
+            bot(Bot): Бот.
+            chat_id(int): Id чата.
+            data(bytes): Содержимое изображения.
+            filename(str): Имя файла при загрузке.
+            kwargs: Остальные аргументы bot.send_photo.
+
+        Returns:
+            Message: Отправленное сообщение.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        file_ids = await self._load()
+
+        file_id = file_ids.get(content_hash)
+        if file_id is not None:
+            try:
+                message = await bot.send_photo(chat_id=chat_id,
+                                               photo=file_id,
+                                               **kwargs)
+                self.hits += 1
+                return message
+            except TelegramBadRequest as e:
+                print(e)
+                await self.invalidate(content_hash)
+
+        message = await bot.send_photo(chat_id=chat_id,
+                                       photo=BufferedInputFile(
+                                           data,
+                                           filename=filename),
+                                       **kwargs)
+        await self._remember(content_hash,
+                             data,
+                             message)
+        return message
+
+    async def edit_photo(self,
+                         bot: Bot,
+                         chat_id: int,
+                         message_id: int,
+                         data: bytes,
+                         filename: str):
+        """
+        Замена изображения в отправленном сообщении по file_id, если
+        такое содержимое уже загружалось, иначе загрузкой файла.
+
+        Parameters:
+            bot(Bot): Бот.
+            chat_id(int): Id чата.
+            message_id(int): Id сообщения с изображением.
+            data(bytes): Содержимое изображения.
+            filename(str): Имя файла при загрузке.
+
+        Returns:
+            Message: Изменённое сообщение.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        file_ids = await self._load()
+
+        file_id = file_ids.get(content_hash)
+        if file_id is not None:
+            try:
+                message = await bot.edit_message_media(
+                    media=InputMediaPhoto(media=file_id),
+                    chat_id=chat_id,
+                    message_id=message_id)
+                self.hits += 1
+                return message
+            except TelegramBadRequest as e:
+                print(e)
+                await self.invalidate(content_hash)
+
+        message = await bot.edit_message_media(
+            media=InputMediaPhoto(media=BufferedInputFile(data,
+                                                          filename=filename)),
+            chat_id=chat_id,
+            message_id=message_id)
+        await self._remember(content_hash,
+                             data,
+                             message)
+        return message
+
+    async def _remember(self,
+                        content_hash: str,
+                        data: bytes,
+                        message):
+        """
+        Сохранение file_id загруженного изображения.
+
+        Parameters:
+            content_hash(str): Хэш содержимого файла.
+            data(bytes): Содержимое изображения.
+            message(Message): Сообщение с загруженным изображением.
+        """
+        self.misses += 1
+        self.uploaded_bytes += len(data)
+        # Изменение сообщения может вернуть True вместо сообщения.
+        if isinstance(message, Message) and message.photo:
+            # Последний размер - исходное изображение.
+            file_id = message.photo[-1].file_id
+            (await self._load())[content_hash] = file_id
+            await self.database.set_telegram_file_id(content_hash,
+                                                     file_id)
+
+    def stats(self):
+        """
+        Статистика повторного использования файлов.
+
+        Returns:
+            dict: Количество отправок по file_id, загрузок, отклонённых
+            file_id, доля попаданий и объём загруженных файлов.
+        """
+        sent = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / sent if sent else 0.0,
+                "uploaded_bytes": self.uploaded_bytes,
+                "entries": len(self._file_ids or ())}
@@ -0,0 +1,199 @@
+"""
+Узел генерации изображений. Берёт задания из очереди заданий, загружает
+модели и возвращает изображения боту. Узлов может быть несколько, бот
+при этом не меняется: задание получает узел, на котором модель уже
+загружена.
+
+Запуск:
+    python generation_worker.py [классы генераторов для загрузки]
+
+Например, python generation_worker.py Kandinsky StableDiffusion.
+"""
+import importlib
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import config as c
+import job_queue as jq
+import remote_generator as rmg
+import texts as tx
+
+IMAGE_GENERATORS_MODULE = "image_generators"
+HEARTBEAT_INTERVAL = 5
+POLL_INTERVAL = 0.2
+
+
+class GenerationWorker:
+    """
+    Узел генерации. Задания выполняются по одному, о загруженных моделях
+    узел сообщает в очередь из отдельного потока, в том числе во время
+    долгой загрузки или генерации.
+
+    Attributes:
+        job_queue(JobQueue): Очередь заданий.
+        worker_id(str): Id узла.
+        heartbeat_interval(float): Интервал сообщений о работе узла.
+        poll_interval(float): Интервал проверки очереди без заданий.
+        generators(dict[str, ImageGenerator]): Загруженные генераторы по
+        имени класса.
+    """
+
+    def __init__(self,
+                 job_queue: jq.JobQueue,
+                 worker_id=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL,
+                 poll_interval=POLL_INTERVAL):
+        self.job_queue = job_queue
+        self.worker_id = (worker_id
+                          or f"{socket.gethostname()}-{os.getpid()}")
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.generators = {}
+        self._stopped = threading.Event()
+
+    def advertise(self):
+        """
+        Сообщение в очередь о работе узла и загруженных моделях.
+        """
+        self.job_queue.heartbeat(
+            self.worker_id,
+            {name: rmg.describe_generator(generator)
+             for name, generator in list(self.generators.items())})
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.advertise()
+            except Exception as e:
+                print(e)
+
+    def load(self,
+             class_name: str):
+        """
+        Загрузка генератора.
+
+        Parameters:
+            class_name(str): Имя класса генератора в image_generators.
+
+        Returns:
+            ImageGenerator: Генератор изображений.
+        """
+        image_generators = importlib.import_module(IMAGE_GENERATORS_MODULE)
+        generator_class = getattr(image_generators, class_name, None)
+        if (not isinstance(generator_class, type)
+                or not issubclass(generator_class,
+                                  image_generators.ImageGenerator)):
+            raise ValueError(f"unknown image generator {class_name}")
+        generator = generator_class()
+        self.generators[class_name] = generator
+        self.advertise()
+        return generator
+
+    def process(self,
+                job: jq.QueueJob):
+        """
+        Выполнение задания: загрузка модели, если её нет на узле, и
+        генерация изображений.
+
+        Parameters:
+            job(QueueJob): Задание.
+        """
+        try:
+            load_time = 0.0
+            generator = self.generators.get(job.model)
+            if generator is None:
+                started_at = time.perf_counter()
+                generator = self.load(job.model)
+                load_time = time.perf_counter() - started_at
+            self.job_queue.set_started(job.id,
+                                       load_time)
+
+            images = []
+            if job.kind == jq.JOB_GENERATE:
+                # Бот удаляет отменённое задание, генерация прерывается
+                # на следующем шаге.
+                job_removed = threading.Event()
+
+                def progress(step, total):
+                    if not self.job_queue.set_progress(job.id,
+                                                       step,
+                                                       total):
+                        job_removed.set()
+
+                images = generator.generate_images(
+                    job.payload["prompts"],
+                    progress,
+                    job_removed.is_set,
+                    job.payload.get("preview", False))
+                if images is None:
+                    self.job_queue.fail(job.id,
+                                        "image generation failed")
+                    return
+            self.job_queue.complete(job.id,
+                                    images,
+                                    rmg.describe_generator(generator))
+        except Exception as e:
+            print(e)
+            self.job_queue.fail(job.id,
+                                str(e))
+
+    def run(self,
+            preload=()):
+        """
+        Выполнение заданий до вызова stop. При выходе узел удаляется из
+        очереди, а его незавершённые задания возвращаются в очередь.
+
+        Parameters:
+            preload(Iterable[str]): Классы генераторов, загружаемые до
+            получения заданий.
+        """
+        self.advertise()
+        heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                            name="heartbeat",
+                                            daemon=True)
+        heartbeat_thread.start()
+        try:
+            for class_name in preload:
+                self.load(class_name)
+
+            while not self._stopped.is_set():
+                job = self.job_queue.claim(self.worker_id,
+                                           self.generators)
+                if job is None:
+                    self._stopped.wait(self.poll_interval)
+                else:
+                    self.process(job)
+        finally:
+            self._stopped.set()
+            heartbeat_thread.join()
+            self.job_queue.remove_worker(self.worker_id)
+
+    def stop(self):
+        """
+        Остановка узла после завершения текущего задания.
+        """
+        self._stopped.set()
+
+
+def main():
+    """
+    Запуск узла генерации. По SIGTERM узел завершает текущее задание и
+    останавливается, по Ctrl+C - останавливается сразу.
+    """
+    worker = GenerationWorker(
+        jq.SqliteJobQueue(getattr(c, "JOB_QUEUE_PATH", jq.JOB_QUEUE_PATH)))
+    signal.signal(signal.SIGTERM,
+                  lambda signal_number, frame: worker.stop())
+    print(f"worker {worker.worker_id}")
+    try:
+        worker.run(sys.argv[1:])
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == tx.MAIN_MODULE_NAME:
+    main()
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_PATH = "images/cache/"
+CACHE_FILE_EXTENSION = ".img"
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+HOT_CACHE_MAX_ITEMS = 16
+KEY_SEPARATOR = "\x1f"
+
+
+def make_key(model_id: str,
+             prompt: str,
+             negative_prompt: str,
+             num_inference_steps: int,
+             height: int,
+             width: int,
+             seed=None,
+             *extra):
+    """
+    Формирование ключа кэша по параметрам генерации изображения.
+
+    Parameters:
+        model_id(str): Имя модели.
+        prompt(str): Текстовое описание изображения.
+        negative_prompt(str): Негативное описание изображения.
+        num_inference_steps(int): Количество шагов генерации.
+        height(int): Высота изображения.
+        width(int): Ширина изображения.
+        seed(int): Зерно генератора случайных чисел.
+        extra: Дополнительные параметры, влияющие на результат.
+
+    Returns:
+        str: Ключ кэша (sha256 в шестнадцатеричном виде).
+    """
+    parts = [model_id,
+             prompt,
+             negative_prompt,
+             num_inference_steps,
+             height,
+             width,
+             seed,
+             *extra]
+    raw = KEY_SEPARATOR.join(str(part) for part in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """
+    Дисковый кэш сгенерированных изображений с вытеснением давно не
+    использованных записей (LRU) и необязательным уровнем в памяти.
+
+    Порядок использования записей на диске сохраняется во времени
+    изменения файлов, поэтому переживает перезапуск бота.
+
+    Attributes:
+        path(str): Каталог кэша.
+        max_bytes(int): Максимальный размер кэша на диске.
+        hot_max_items(int): Количество изображений в памяти, 0 отключает
+        уровень в памяти.
+        hits(int): Количество попаданий.
+        hot_hits(int): Количество попаданий в уровень в памяти.
+        misses(int): Количество промахов.
+        evictions(int): Количество вытесненных записей.
+    """
+
+    def __init__(self,
+                 path=CACHE_PATH,
+                 max_bytes=CACHE_MAX_BYTES,
+                 hot_max_items=HOT_CACHE_MAX_ITEMS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hot_max_items = hot_max_items
+        self.hits = 0
+        self.hot_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hot = OrderedDict()
+        self._size = 0
+
+        os.makedirs(self.path,
+                    exist_ok=True)
+        self._load_index()
+
+    def _file_path(self,
+                   key: str):
+        return os.path.join(self.path,
+                            key + CACHE_FILE_EXTENSION)
+
+    def _load_index(self):
+        """
+        Восстановление индекса кэша по файлам на диске.
+        """
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(CACHE_FILE_EXTENSION):
+                stat = entry.stat()
+                files.append((stat.st_mtime,
+                              entry.name[:-len(CACHE_FILE_EXTENSION)],
+                              stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self._hot.pop(key, None)
+            self.evictions += 1
+            try:
+                os.remove(self._file_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _remember_hot(self,
+                      key: str,
+                      data: bytes):
+        if self.hot_max_items <= 0:
+            return
+        self._hot[key] = data
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_max_items:
+            self._hot.popitem(last=False)
+
+    def get(self,
+            key: str):
+        """
+        Получение изображения из кэша.
+
+        Parameters:
+            key(str): Ключ кэша.
+
+        Returns:
+            bytes: Содержимое файла изображения. Если изображения нет в
+            кэше, возвращается None.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+            data = self._hot.get(key)
+            if data is not None:
+                self._hot.move_to_end(key)
+                self.hits += 1
+                self.hot_hits += 1
+                return data
+
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, "rb") as file:
+                data = file.read()
+            os.utime(file_path)
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._size -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember_hot(key,
+                               data)
+        return data
+
+    def put(self,
+            key: str,
+            data: bytes):
+        """
+        Сохранение изображения в кэш.
+
+        Parameters:
+            key(str): Ключ кэша.
+            data(bytes): Содержимое файла изображения.
+        """
+        file_path = self._file_path(key)
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path,
+                   file_path)
+
+        with self._lock:
+            old_size = self._entries.pop(key, None)
+            if old_size is not None:
+                self._size -= old_size
+            self._entries[key] = len(data)
+            self._size += len(data)
+            self._remember_hot(key,
+                               data)
+            self._evict()
+
+    def contains(self,
+                 key: str):
+        """
+        Проверка наличия изображения в кэше без изменения счётчиков.
+
+        Parameters:
+            key(str): Ключ кэша.
+
+        Returns:
+            bool: Есть ли изображение в кэше.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        """
+        Статистика работы кэша.
+
+        Returns:
+            dict: Количество попаданий, промахов, вытеснений, записей и
+            занятый объём.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "hot_hits": self.hot_hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "hot_entries": len(self._hot),
+                    "bytes": self._size}
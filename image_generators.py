@@ -1,5 +1,9 @@
 # Для входа в huggingface.co ввести учётные данные через команду:
 # huggingface-cli login
+import gc
+import io
+import os
+
 import torch
 
 from diffusers import (StableCascadeCombinedPipeline as scPipeline,
@@ -9,12 +13,13 @@ from diffusers import (StableCascadeCombinedPipeline as scPipeline,
 from huggingface_hub import login
 from config import HAGGINGFACE_TOKEN
 
-login(token=HAGGINGFACE_TOKEN)
-
-IMAGE_PATH = "images/"
-IMAGE_NAME_SD = "image_sd.png"
-IMAGE_NAME_KD = "image_kd.png"
-IMAGE_NAME_SK = "image_sk.png"
+# Формат отправляемых изображений: JPEG, WEBP или PNG. Качество
+# учитывается для JPEG и WEBP.
+IMAGE_FORMAT = "JPEG"
+IMAGE_QUALITY = 85
+IMAGE_EXTENSIONS = {"JPEG": ".jpg",
+                    "WEBP": ".webp",
+                    "PNG": ".png"}
 
 NEURO_PATH = "./neuro_models/"
 STABLE_DIFFUSION_PATH = "stable-diffusion-xl-base-1.0"
@@ -22,12 +27,225 @@ KANDINSKY_PATH = "kandinsky-2-1"
 STABLE_CASCADE_PATH = "stable-cascade"
 
 CUDA = "cuda"
+CPU = "cpu"
+# Устройство для всех моделей, None - CUDA при наличии, иначе CPU.
+DEVICE = None
 NEGATIVE_PROMPT = "low quality, bad quality"
 NUM_INFERENCE_STEPS = 50
 PRIOR_NUM_INFERENCE_STEPS = 30
 PRIOR_GUIDANCE_SCALE = 3.0
 IMAGE_HEIGHT = 1024
 IMAGE_WIDTH = 1024
+# Параметры быстрого предварительного изображения, которое отправляется
+# до готовности изображения в полном качестве.
+PREVIEW_NUM_INFERENCE_STEPS = 10
+PREVIEW_PRIOR_NUM_INFERENCE_STEPS = 10
+PREVIEW_IMAGE_HEIGHT = 512
+PREVIEW_IMAGE_WIDTH = 512
+# Фиксированное зерно делает изображение локации воспроизводимым,
+# None - случайное изображение при каждой генерации.
+SEED = None
+# Максимальное время генерации в секундах, после которого игрок получает
+# сообщение об ошибке, а генерация прерывается на следующем шаге
+# нейросети. Для моделей из EXECUTION_PROFILES задаётся своё значение.
+GENERATION_TIMEOUT = 300
+
+# Вход в huggingface.co выполняется один раз и только перед скачиванием
+# модели.
+_logged_in = False
+
+
+class GenerationCancelled(Exception):
+    """
+    Генерация прервана между шагами по запросу should_stop.
+    """
+
+
+def login_if_needed(model_id: str):
+    """
+    Вход в huggingface.co, если модели нет в локальном каталоге. Модели,
+    уже скачанные в NEURO_PATH, загружаются без обращения к сети.
+
+    Parameters:
+        model_id(str): Путь к модели или её имя на huggingface.co.
+    """
+    global _logged_in
+    if _logged_in or os.path.isdir(model_id):
+        return
+    login(token=HAGGINGFACE_TOKEN)
+    _logged_in = True
+
+
+class ExecutionProfile:
+    """
+    Параметры выполнения модели: устройство, тип весов, размер
+    изображения, количество шагов и способы экономии памяти.
+
+    На CPU веса float16 заменяются на float32: большая часть операций
+    CPU не поддерживает половинную точность. Для проверки генерации без
+    GPU в model_id указывается путь к небольшой локальной модели той же
+    архитектуры.
+
+    Attributes:
+        device(str): Устройство: "cuda", "cuda:1", "cpu". None - значение
+        DEVICE.
+        dtype(str): Тип весов: "float16", "bfloat16", "float32".
+        variant(str): Вариант файлов весов модели, например "bf16".
+        None - основные файлы.
+        model_id(str): Путь к модели вместо пути по умолчанию.
+        height(int): Высота изображения.
+        width(int): Ширина изображения.
+        num_inference_steps(int): Количество шагов генерации.
+        prior_num_inference_steps(int): Количество шагов prior для
+        двухэтапных моделей.
+        attention_slicing(bool): Вычисление внимания по частям: меньше
+        памяти, немного медленнее.
+        vae_tiling(bool): Декодирование изображения VAE по фрагментам.
+        sequential_offload(bool): Загрузка слоёв на GPU только на время
+        их выполнения: минимум видеопамяти, намного медленнее.
+        generation_timeout(float): Максимальное время генерации в
+        секундах.
+        preview_num_inference_steps(int): Количество шагов
+        предварительного изображения. None - предварительное изображение
+        не генерируется.
+        preview_prior_num_inference_steps(int): Количество шагов prior
+        предварительного изображения.
+        preview_height(int): Высота предварительного изображения.
+        preview_width(int): Ширина предварительного изображения.
+    """
+
+    def __init__(self,
+                 device=None,
+                 dtype="float16",
+                 variant=None,
+                 model_id=None,
+                 height=IMAGE_HEIGHT,
+                 width=IMAGE_WIDTH,
+                 num_inference_steps=NUM_INFERENCE_STEPS,
+                 prior_num_inference_steps=PRIOR_NUM_INFERENCE_STEPS,
+                 attention_slicing=False,
+                 vae_tiling=False,
+                 sequential_offload=False,
+                 generation_timeout=GENERATION_TIMEOUT,
+                 preview_num_inference_steps=PREVIEW_NUM_INFERENCE_STEPS,
+                 preview_prior_num_inference_steps=(
+                     PREVIEW_PRIOR_NUM_INFERENCE_STEPS),
+                 preview_height=PREVIEW_IMAGE_HEIGHT,
+                 preview_width=PREVIEW_IMAGE_WIDTH):
+        self.device = device
+        self.dtype = dtype
+        self.variant = variant
+        self.model_id = model_id
+        self.height = height
+        self.width = width
+        self.num_inference_steps = num_inference_steps
+        self.prior_num_inference_steps = prior_num_inference_steps
+        self.attention_slicing = attention_slicing
+        self.vae_tiling = vae_tiling
+        self.sequential_offload = sequential_offload
+        self.generation_timeout = generation_timeout
+        self.preview_num_inference_steps = preview_num_inference_steps
+        self.preview_prior_num_inference_steps = (
+            preview_prior_num_inference_steps)
+        self.preview_height = preview_height
+        self.preview_width = preview_width
+
+    def get_device(self):
+        """
+        Устройство, на котором выполняется модель.
+
+        Returns:
+            str: Имя устройства torch.
+        """
+        device = self.device or DEVICE
+        if device is None:
+            device = CUDA if torch.cuda.is_available() else CPU
+        return device
+
+    def is_cpu(self):
+        """
+        Returns:
+            bool: Модель выполняется на CPU.
+        """
+        return torch.device(self.get_device()).type == CPU
+
+    def get_torch_dtype(self):
+        """
+        Тип весов модели с учётом устройства.
+
+        Returns:
+            torch.dtype: Тип весов.
+        """
+        if self.dtype == "float16" and self.is_cpu():
+            return torch.float32
+        return getattr(torch, self.dtype)
+
+    def get_pretrained_arguments(self):
+        """
+        Аргументы from_pretrained для загрузки весов.
+
+        Returns:
+            dict: Именованные аргументы.
+        """
+        arguments = {"torch_dtype": self.get_torch_dtype()}
+        if self.variant is not None:
+            arguments["variant"] = self.variant
+        return arguments
+
+    def apply(self,
+              pipe):
+        """
+        Перенос модели на устройство и включение способов экономии
+        памяти.
+
+        Parameters:
+            pipe(DiffusionPipeline): Загруженная модель.
+
+        Returns:
+            DiffusionPipeline: Модель, готовая к генерации.
+        """
+        if self.sequential_offload and not self.is_cpu():
+            # Модель остаётся в памяти CPU, слои переносятся на GPU
+            # при выполнении.
+            pipe.enable_sequential_cpu_offload(device=self.get_device())
+        else:
+            pipe = pipe.to(self.get_device())
+        if self.attention_slicing:
+            pipe.enable_attention_slicing()
+        if self.vae_tiling and hasattr(pipe, "enable_vae_tiling"):
+            pipe.enable_vae_tiling()
+        return pipe
+
+
+# Параметры выполнения по имени класса генератора.
+# Ограничение времени генерации выбрано с запасом относительно
+# собранной статистики: Stable Diffusion - p50 29 с, максимум 52 с,
+# Kandinsky - p50 14 с, максимум 24 с, Stable Cascade - p50 364 с,
+# максимум 671 с.
+EXECUTION_PROFILES = {
+    "StableDiffusion": ExecutionProfile(generation_timeout=180),
+    "Kandinsky": ExecutionProfile(generation_timeout=120),
+    # Decoder Stable Cascade даёт приемлемое изображение за несколько
+    # шагов.
+    "StableCascade": ExecutionProfile(dtype="bfloat16",
+                                      variant="bf16",
+                                      preview_num_inference_steps=4,
+                                      generation_timeout=1200),
+}
+
+
+def get_execution_profile(class_name: str):
+    """
+    Параметры выполнения генератора.
+
+    Parameters:
+        class_name(str): Имя класса генератора.
+
+    Returns:
+        ExecutionProfile: Параметры из EXECUTION_PROFILES или параметры
+        по умолчанию.
+    """
+    return EXECUTION_PROFILES.get(class_name) or ExecutionProfile()
 
 
 class ImageGenerator:
@@ -37,32 +255,262 @@ class ImageGenerator:
     Attributes:
         model_id: Имя модели.
         pipe: Последовательность элементов модели.
-        image: Изображение.
-        image_name: Имя изображения.
+        profile: Параметры выполнения модели.
+        image_format: Формат изображения при кодировании.
+        image_quality: Качество изображения при кодировании.
+        negative_prompt: Негативное описание изображения.
+        num_inference_steps: Количество шагов генерации.
+        prior_num_inference_steps: Количество шагов prior.
+        height: Высота изображения.
+        width: Ширина изображения.
+        seed: Зерно генератора случайных чисел.
+        generation_timeout: Максимальное время генерации в секундах.
+        preview_num_inference_steps: Количество шагов предварительного
+        изображения, None - без предварительного изображения.
+        preview_prior_num_inference_steps: Количество шагов prior
+        предварительного изображения.
+        preview_height: Высота предварительного изображения.
+        preview_width: Ширина предварительного изображения.
     """
 
     def __init__(self,
                  model_id,
                  pipe,
-                 image_name=IMAGE_NAME_SD):
+                 profile=None):
         self.model_id = model_id
         self.pipe = pipe
-        self.image = None
-        self.image_name = image_name
+        self.profile = profile or ExecutionProfile()
+        self.image_format = IMAGE_FORMAT
+        self.image_quality = IMAGE_QUALITY
+        self.negative_prompt = NEGATIVE_PROMPT
+        self.num_inference_steps = self.profile.num_inference_steps
+        self.prior_num_inference_steps = (
+            self.profile.prior_num_inference_steps)
+        self.height = self.profile.height
+        self.width = self.profile.width
+        self.seed = SEED
+        self.generation_timeout = self.profile.generation_timeout
+        self.preview_num_inference_steps = (
+            self.profile.preview_num_inference_steps)
+        self.preview_prior_num_inference_steps = (
+            self.profile.preview_prior_num_inference_steps)
+        self.preview_height = self.profile.preview_height
+        self.preview_width = self.profile.preview_width
+
+    def get_torch_generator(self,
+                            count=1):
+        """
+        Генераторы случайных чисел для воспроизводимой генерации.
+
+        Parameters:
+            count(int): Количество изображений в пакете.
+
+        Returns:
+            list[torch.Generator]: Генераторы с заданным зерном, по
+            одному на изображение. Если зерно не задано, возвращается
+            None.
+        """
+        if self.seed is None:
+            return None
+        return [torch.Generator(self.profile.get_device()).manual_seed(
+            self.seed)
+                for _ in range(count)]
+
+    def get_memory_size(self):
+        """
+        Объём памяти, занимаемый весами и буферами модели.
+
+        Returns:
+            int: Размер модели в байтах.
+        """
+        size = 0
+        for component in self.pipe.components.values():
+            if isinstance(component, torch.nn.Module):
+                for tensor in component.parameters():
+                    size += tensor.numel() * tensor.element_size()
+                for tensor in component.buffers():
+                    size += tensor.numel() * tensor.element_size()
+        return size
+
+    def release(self):
+        """
+        Освобождение памяти, занятой моделью.
+        """
+        self.pipe = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get_progress_arguments(self,
+                               progress):
+        """
+        Аргументы вызова модели для отслеживания хода генерации.
+
+        Parameters:
+            progress(object): Функция progress(step, total), вызываемая
+            после каждого шага генерации.
+
+        Returns:
+            dict: Именованные аргументы для вызова модели.
+        """
+        if progress is None:
+            return {}
+        total = self.num_inference_steps
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            progress(step + 1,
+                     total)
+            return callback_kwargs
+
+        return {"callback_on_step_end": on_step_end}
+
+    def get_generation_arguments(self,
+                                 preview=False):
+        """
+        Количество шагов и размер изображения.
+
+        Parameters:
+            preview(bool): Параметры предварительного изображения.
+
+        Returns:
+            dict: Именованные аргументы для вызова модели.
+        """
+        if preview:
+            return {"num_inference_steps": self.preview_num_inference_steps,
+                    "prior_num_inference_steps": (
+                        self.preview_prior_num_inference_steps),
+                    "height": self.preview_height,
+                    "width": self.preview_width}
+        return {"num_inference_steps": self.num_inference_steps,
+                "prior_num_inference_steps": self.prior_num_inference_steps,
+                "height": self.height,
+                "width": self.width}
+
+    @staticmethod
+    def get_step_callback(progress,
+                          should_stop):
+        """
+        Функция, вызываемая после каждого шага генерации: проверка
+        остановки и сообщение о ходе генерации. Исключение из функции
+        шага прерывает цикл шагов модели.
+
+        Parameters:
+            progress(object): Функция progress(step, total).
+            should_stop(object): Функция should_stop().
+
+        Returns:
+            object: Функция progress(step, total). Если обе функции
+            не заданы, возвращается None.
+        """
+        if should_stop is None:
+            return progress
+
+        def on_step(step, total):
+            if should_stop():
+                raise GenerationCancelled(f"stopped at step {step}")
+            if progress is not None:
+                progress(step,
+                         total)
+
+        return on_step
+
+    def get_image_extension(self):
+        """
+        Расширение файла изображения в формате генератора.
+
+        Returns:
+            str: Расширение файла с точкой.
+        """
+        return IMAGE_EXTENSIONS[self.image_format]
+
+    def encode_image(self,
+                     image):
+        """
+        Кодирование изображения в памяти в формате генератора.
+
+        Parameters:
+            image(PIL.Image.Image): Изображение.
+
+        Returns:
+            bytes: Закодированное изображение.
+        """
+        buffer = io.BytesIO()
+        if self.image_format == "PNG":
+            image.save(buffer,
+                       format=self.image_format)
+        else:
+            # JPEG не поддерживает прозрачность.
+            image.convert("RGB").save(buffer,
+                                      format=self.image_format,
+                                      quality=self.image_quality)
+        return buffer.getvalue()
 
     def generate_image(self,
-                       prompt: str):
+                       prompt: str,
+                       progress=None,
+                       should_stop=None,
+                       preview=False):
         """
         Генерация изображения по текстовому описанию.
 
         Parameters:
             prompt(srt): Текстовое описание, по которому генерируется
             изображение.
+            progress(object): Функция progress(step, total), вызываемая
+            после каждого шага генерации.
+            should_stop(object): Функция should_stop(), проверяемая
+            после каждого шага генерации.
+            preview(bool): Генерация предварительного изображения.
+
+        Returns:
+            bytes: Закодированное изображение.
+        """
+        images = self.generate_images([prompt],
+                                      progress,
+                                      should_stop,
+                                      preview)
+        if images is None:
+            return None
+        return images[0]
+
+    def generate_images(self,
+                        prompts: list[str],
+                        progress=None,
+                        should_stop=None,
+                        preview=False):
+        """
+        Генерация нескольких изображений одним вызовом модели.
+
+        Parameters:
+            prompts(list[str]): Текстовые описания изображений.
+            progress(object): Функция progress(step, total), вызываемая
+            после каждого шага генерации.
+            should_stop(object): Функция should_stop(), проверяемая
+            после каждого шага генерации. Если она возвращает True,
+            генерация прерывается.
+            preview(bool): Генерация предварительного изображения с
+            меньшим количеством шагов и размером.
 
         Returns:
-            str: Путь к изображению на сервере.
+            list[bytes]: Закодированные изображения в порядке описаний.
+            Если генерация не удалась или прервана, возвращается None.
         """
-        pass
+        try:
+            images = self.pipe(
+                prompt=prompts,
+                negative_prompt=[self.negative_prompt] * len(prompts),
+                prior_guidance_scale=PRIOR_GUIDANCE_SCALE,
+                generator=self.get_torch_generator(len(prompts)),
+                **self.get_generation_arguments(preview),
+                **self.get_progress_arguments(
+                    self.get_step_callback(progress,
+                                           should_stop)),
+            ).images
+
+            return [self.encode_image(image) for image in images]
+        except Exception as e:
+            print(e)
+            return None
 
 
 class StableDiffusion(ImageGenerator):
@@ -70,39 +518,22 @@ class StableDiffusion(ImageGenerator):
     Генератор изображений с использованием Stable Diffusion.
     """
 
-    def __init__(self):
-        self.model_id = NEURO_PATH + STABLE_DIFFUSION_PATH
+    def __init__(self,
+                 profile=None):
+        profile = profile or get_execution_profile("StableDiffusion")
+        self.model_id = (profile.model_id
+                         or NEURO_PATH + STABLE_DIFFUSION_PATH)
+        login_if_needed(self.model_id)
         self.ddim = DDIMScheduler.from_pretrained(self.model_id,
                                                   subfolder="scheduler")
-        self.pipe = DiffusionPipeline.from_pretrained(self.model_id,
-                                                      ddim=self.ddim,
-                                                      torch_dtype=torch.float16
-                                                      )
-        self.pipe = self.pipe.to(CUDA)
+        self.pipe = DiffusionPipeline.from_pretrained(
+            self.model_id,
+            ddim=self.ddim,
+            **profile.get_pretrained_arguments())
+        self.pipe = profile.apply(self.pipe)
         super().__init__(self.model_id,
                          self.pipe,
-                         image_name=IMAGE_NAME_SD)
-
-    def generate_image(self,
-                       prompt):
-        try:
-            image = self.pipe(
-                prompt=prompt,
-                negative_prompt=NEGATIVE_PROMPT,
-                num_inference_steps=NUM_INFERENCE_STEPS,
-                prior_num_inference_steps=PRIOR_NUM_INFERENCE_STEPS,
-                prior_guidance_scale=PRIOR_GUIDANCE_SCALE,
-                height=IMAGE_HEIGHT,
-                width=IMAGE_WIDTH,
-                # guidance_scale=7.0,
-            ).images[0]
-
-            image.save(IMAGE_PATH + self.image_name)
-
-            return IMAGE_PATH + self.image_name
-        except Exception as e:
-            print(e)
-            return None
+                         profile)
 
 
 class Kandinsky(ImageGenerator):
@@ -110,34 +541,32 @@ class Kandinsky(ImageGenerator):
     Генератор изображений с использованием нейросети Kandinsky.
     """
 
-    def __init__(self):
-        self.model_id = NEURO_PATH + KANDINSKY_PATH
-        self.pipe = autoPipeline.from_pretrained(self.model_id,
-                                                 torch_dtype=torch.float16)
-        self.pipe = self.pipe.to(CUDA)
+    def __init__(self,
+                 profile=None):
+        profile = profile or get_execution_profile("Kandinsky")
+        self.model_id = profile.model_id or NEURO_PATH + KANDINSKY_PATH
+        login_if_needed(self.model_id)
+        self.pipe = autoPipeline.from_pretrained(
+            self.model_id,
+            **profile.get_pretrained_arguments())
+        self.pipe = profile.apply(self.pipe)
         super().__init__(self.model_id,
                          self.pipe,
-                         image_name=IMAGE_NAME_KD)
+                         profile)
 
-    def generate_image(self,
-                       prompt):
-        try:
-            image = self.pipe(
-                prompt=prompt,
-                negative_prompt=NEGATIVE_PROMPT,
-                num_inference_steps=NUM_INFERENCE_STEPS,
-                prior_num_inference_steps=PRIOR_NUM_INFERENCE_STEPS,
-                prior_guidance_scale=PRIOR_GUIDANCE_SCALE,
-                height=IMAGE_HEIGHT,
-                width=IMAGE_WIDTH,
-            ).images[0]
+    def get_progress_arguments(self,
+                               progress):
+        # Kandinsky 2.1 поддерживает только callback(step, timestep, latents).
+        if progress is None:
+            return {}
+        total = self.num_inference_steps
 
-            image.save(IMAGE_PATH + self.image_name)
+        def on_step(step, timestep, latents):
+            progress(step + 1,
+                     total)
 
-            return IMAGE_PATH + self.image_name
-        except Exception as e:
-            print(e)
-            return None
+        return {"callback": on_step,
+                "callback_steps": 1}
 
 
 class StableCascade(ImageGenerator):
@@ -145,32 +574,35 @@ class StableCascade(ImageGenerator):
     Генератор изображений с использованием нейросети Stable Cascade.
     """
 
-    def __init__(self):
-        self.model_id = NEURO_PATH + STABLE_CASCADE_PATH
-        self.pipe = scPipeline.from_pretrained(self.model_id,
-                                               variant="bf16",
-                                               torch_dtype=torch.bfloat16)
-        self.pipe = self.pipe.to(CUDA)
+    def __init__(self,
+                 profile=None):
+        profile = profile or get_execution_profile("StableCascade")
+        self.model_id = profile.model_id or NEURO_PATH + STABLE_CASCADE_PATH
+        login_if_needed(self.model_id)
+        self.pipe = scPipeline.from_pretrained(
+            self.model_id,
+            **profile.get_pretrained_arguments())
+        self.pipe = profile.apply(self.pipe)
         super().__init__(self.model_id,
                          self.pipe,
-                         image_name=IMAGE_NAME_SK)
+                         profile)
 
-    def generate_image(self,
-                       prompt):
-        try:
-            image = self.pipe(
-                prompt=prompt,
-                negative_prompt=NEGATIVE_PROMPT,
-                num_inference_steps=NUM_INFERENCE_STEPS,
-                prior_num_inference_steps=PRIOR_NUM_INFERENCE_STEPS,
-                prior_guidance_scale=PRIOR_GUIDANCE_SCALE,
-                height=IMAGE_HEIGHT,
-                width=IMAGE_WIDTH,
-            ).images[0]
+    def get_progress_arguments(self,
+                               progress):
+        # Сначала выполняются шаги prior, затем шаги decoder.
+        if progress is None:
+            return {}
+        total = self.prior_num_inference_steps + self.num_inference_steps
 
-            image.save(IMAGE_PATH + self.image_name)
+        def on_prior_step_end(pipe, step, timestep, callback_kwargs):
+            progress(step + 1,
+                     total)
+            return callback_kwargs
 
-            return IMAGE_PATH + self.image_name
-        except Exception as e:
-            print(e)
-            return None
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            progress(self.prior_num_inference_steps + step + 1,
+                     total)
+            return callback_kwargs
+
+        return {"prior_callback_on_step_end": on_prior_step_end,
+                "callback_on_step_end": on_step_end}
@@ -0,0 +1,559 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+JOB_QUEUE_PATH = "jobs.db"
+JOB_LOAD = "load"
+JOB_GENERATE = "generate"
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+# Узел считается остановленным, если не сообщал о себе дольше этого
+# времени в секундах. Его незавершённые задания возвращаются в очередь.
+WORKER_TIMEOUT = 30
+# Задание модели, загруженной на другом узле, может взять узел без этой
+# модели, если задание ждёт дольше этого времени в секундах.
+COLD_START_DELAY = 30
+# Количество ожидающих заданий, просматриваемых при выборе задания.
+CLAIM_SCAN_LIMIT = 100
+POLL_INTERVAL = 0.2
+
+
+class QueueJob:
+    """
+    Задание, взятое узлом генерации.
+
+    Attributes:
+        id(int): Id задания.
+        kind(str): Вид задания: JOB_LOAD или JOB_GENERATE.
+        model(str): Имя класса генератора.
+        payload(dict): Параметры задания.
+        submitted_at(float): Время постановки в очередь.
+    """
+    __slots__ = ("id", "kind", "model", "payload", "submitted_at")
+
+    def __init__(self,
+                 id: int,
+                 kind: str,
+                 model: str,
+                 payload: dict,
+                 submitted_at: float):
+        self.id = id
+        self.kind = kind
+        self.model = model
+        self.payload = payload
+        self.submitted_at = submitted_at
+
+
+class JobResult:
+    """
+    Состояние задания и его результат.
+
+    Attributes:
+        status(str): Состояние задания.
+        images(list[bytes]): Закодированные изображения.
+        result(dict): Параметры генератора, выполнившего задание.
+        error(str): Текст ошибки.
+        timing(dict): Узел, время ожидания в очереди, загрузки модели
+        и генерации в секундах.
+        progress(tuple[int, int]): Выполненный шаг и количество шагов.
+    """
+    __slots__ = ("status", "images", "result", "error", "timing",
+                 "progress")
+
+    def __init__(self,
+                 status: str,
+                 images=None,
+                 result=None,
+                 error=None,
+                 timing=None,
+                 progress=None):
+        self.status = status
+        self.images = images or []
+        self.result = result
+        self.error = error
+        self.timing = timing or {}
+        self.progress = progress
+
+    def finished(self):
+        return self.status in (STATUS_DONE, STATUS_FAILED)
+
+
+class JobQueue(ABC):
+    """
+    Очередь заданий генерации между ботом и узлами генерации. Бот ставит
+    задания и ожидает результат, узлы сообщают о загруженных моделях,
+    берут задания и возвращают изображения с временем выполнения.
+
+    Задание модели получает узел, на котором модель уже загружена. Узел
+    без модели берёт задание, только если модель не загружена ни на
+    одном работающем узле или задание ждёт дольше COLD_START_DELAY.
+    """
+
+    @abstractmethod
+    def submit(self,
+               kind: str,
+               model: str,
+               payload: dict,
+               priority=0):
+        """
+        Постановка задания в очередь.
+
+        Parameters:
+            kind(str): Вид задания.
+            model(str): Имя класса генератора.
+            payload(dict): Параметры задания.
+            priority(int): Приоритет, меньшее значение выполняется раньше.
+
+        Returns:
+            int: Id задания.
+        """
+
+    @abstractmethod
+    def get(self,
+            job_id: int):
+        """
+        Состояние задания.
+
+        Parameters:
+            job_id(int): Id задания.
+
+        Returns:
+            JobResult: Состояние задания. Если задание не найдено,
+            возвращается None.
+        """
+
+    @abstractmethod
+    def delete(self,
+               job_id: int):
+        """
+        Удаление задания и его результата. Результат удалённого
+        выполняющегося задания не сохраняется.
+
+        Parameters:
+            job_id(int): Id задания.
+        """
+
+    @abstractmethod
+    def heartbeat(self,
+                  worker_id: str,
+                  models: dict):
+        """
+        Сообщение узла о том, что он работает, и о загруженных моделях.
+
+        Parameters:
+            worker_id(str): Id узла.
+            models(dict[str, dict]): Параметры загруженных генераторов по
+            имени класса.
+        """
+
+    @abstractmethod
+    def remove_worker(self,
+                      worker_id: str):
+        """
+        Удаление остановленного узла. Его незавершённые задания
+        возвращаются в очередь.
+
+        Parameters:
+            worker_id(str): Id узла.
+        """
+
+    @abstractmethod
+    def claim(self,
+              worker_id: str,
+              warm_models):
+        """
+        Получение узлом следующего задания.
+
+        Parameters:
+            worker_id(str): Id узла.
+            warm_models(Iterable[str]): Модели, загруженные на узле.
+
+        Returns:
+            QueueJob: Задание. Если подходящих заданий нет, возвращается
+            None.
+        """
+
+    @abstractmethod
+    def set_started(self,
+                    job_id: int,
+                    load_time: float):
+        """
+        Отметка о начале генерации после загрузки модели.
+
+        Parameters:
+            job_id(int): Id задания.
+            load_time(float): Время загрузки модели в секундах.
+        """
+
+    @abstractmethod
+    def set_progress(self,
+                     job_id: int,
+                     step: int,
+                     total: int):
+        """
+        Сохранение хода выполнения задания.
+
+        Parameters:
+            job_id(int): Id задания.
+            step(int): Выполненный шаг.
+            total(int): Количество шагов.
+
+        Returns:
+            bool: Есть ли задание в очереди. Если бот удалил задание,
+            например при отмене, генерацию можно прекратить.
+        """
+
+    @abstractmethod
+    def complete(self,
+                 job_id: int,
+                 images: list[bytes],
+                 result: dict):
+        """
+        Сохранение результата задания.
+
+        Parameters:
+            job_id(int): Id задания.
+            images(list[bytes]): Закодированные изображения.
+            result(dict): Параметры генератора.
+        """
+
+    @abstractmethod
+    def fail(self,
+             job_id: int,
+             error: str):
+        """
+        Сохранение ошибки выполнения задания.
+
+        Parameters:
+            job_id(int): Id задания.
+            error(str): Текст ошибки.
+        """
+
+    @abstractmethod
+    def workers(self):
+        """
+        Работающие узлы.
+
+        Returns:
+            dict[str, list[str]]: Загруженные модели по id узла.
+        """
+
+    def wait(self,
+             job_id: int,
+             timeout=None,
+             progress=None,
+             should_stop=None,
+             poll_interval=POLL_INTERVAL):
+        """
+        Ожидание завершения задания с удалением его из очереди.
+
+        Parameters:
+            job_id(int): Id задания.
+            timeout(float): Время ожидания в секундах. None - без
+            ограничения.
+            progress(object): Функция progress(step, total), вызываемая
+            при изменении хода выполнения.
+            should_stop(object): Функция should_stop(). Если она
+            возвращает True, ожидание прекращается, а задание удаляется
+            из очереди.
+            poll_interval(float): Интервал проверки задания в секундах.
+
+        Returns:
+            JobResult: Результат задания.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        last_progress = None
+        try:
+            while True:
+                job_result = self.get(job_id)
+                if job_result is None:
+                    raise RuntimeError(f"job {job_id} was removed")
+                if job_result.finished():
+                    return job_result
+                if (progress is not None
+                        and job_result.progress is not None
+                        and job_result.progress != last_progress):
+                    last_progress = job_result.progress
+                    progress(*last_progress)
+                if should_stop is not None and should_stop():
+                    return JobResult(STATUS_FAILED,
+                                     error=f"job {job_id} cancelled",
+                                     timing=job_result.timing)
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(f"job {job_id} timed out")
+                time.sleep(poll_interval)
+        finally:
+            self.delete(job_id)
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    Очередь заданий в файле SQLite для бота и узлов генерации на одной
+    машине или с общим диском, а также для проверки без отдельных
+    серверов. У каждого потока своё подключение.
+
+    Attributes:
+        path(str): Путь к файлу очереди.
+        worker_timeout(float): Время, после которого молчащий узел
+        считается остановленным.
+        cold_start_delay(float): Время ожидания задания, после которого
+        его может взять узел без загруженной модели.
+    """
+
+    def __init__(self,
+                 path=JOB_QUEUE_PATH,
+                 worker_timeout=WORKER_TIMEOUT,
+                 cold_start_delay=COLD_START_DELAY):
+        self.path = path
+        self.worker_timeout = worker_timeout
+        self.cold_start_delay = cold_start_delay
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path,
+                                         timeout=WORKER_TIMEOUT,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        connection.executescript(
+            'CREATE TABLE IF NOT EXISTS "job" ('
+            '"id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+            '"kind" TEXT NOT NULL, '
+            '"model" TEXT NOT NULL, '
+            '"payload" TEXT NOT NULL, '
+            '"priority" INTEGER NOT NULL, '
+            '"status" TEXT NOT NULL, '
+            '"worker_id" TEXT, '
+            '"submitted_at" REAL NOT NULL, '
+            '"claimed_at" REAL, '
+            '"started_at" REAL, '
+            '"finished_at" REAL, '
+            '"load_time" REAL, '
+            '"progress_step" INTEGER, '
+            '"progress_total" INTEGER, '
+            '"result" TEXT, '
+            '"error" TEXT);'
+            'CREATE INDEX IF NOT EXISTS "job_status_priority" '
+            'ON "job" ("status", "priority", "id");'
+            'CREATE TABLE IF NOT EXISTS "job_image" ('
+            '"job_id" INTEGER NOT NULL, '
+            '"position" INTEGER NOT NULL, '
+            '"data" BLOB NOT NULL, '
+            'PRIMARY KEY ("job_id", "position"));'
+            'CREATE TABLE IF NOT EXISTS "worker" ('
+            '"id" TEXT NOT NULL PRIMARY KEY, '
+            '"heartbeat" REAL NOT NULL, '
+            '"models" TEXT NOT NULL);')
+
+    def submit(self,
+               kind: str,
+               model: str,
+               payload: dict,
+               priority=0):
+        cursor = self._connection().execute(
+            'INSERT INTO "job" ("kind", "model", "payload", "priority", '
+            '"status", "submitted_at") VALUES (?, ?, ?, ?, ?, ?)',
+            (kind, model, json.dumps(payload), priority, STATUS_PENDING,
+             time.time()))
+        return cursor.lastrowid
+
+    def get(self,
+            job_id: int):
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT "status", "result", "error", "worker_id", '
+            '"submitted_at", "claimed_at", "started_at", "finished_at", '
+            '"load_time", "progress_step", "progress_total" '
+            'FROM "job" WHERE "id" = ?',
+            (job_id,)).fetchone()
+        if row is None:
+            return None
+        (status, result, error, worker_id, submitted_at, claimed_at,
+         started_at, finished_at, load_time, step, total) = row
+
+        progress = None if step is None else (step, total)
+        if status not in (STATUS_DONE, STATUS_FAILED):
+            return JobResult(status,
+                             progress=progress)
+
+        images = [data for data, in connection.execute(
+            'SELECT "data" FROM "job_image" WHERE "job_id" = ? '
+            'ORDER BY "position"',
+            (job_id,))]
+        timing = {"worker_id": worker_id,
+                  "queue_time": (claimed_at or finished_at) - submitted_at,
+                  "load_time": load_time or 0.0,
+                  "generation_time": (finished_at
+                                      - (started_at or finished_at)),
+                  "total_time": finished_at - submitted_at}
+        return JobResult(status,
+                         images,
+                         json.loads(result) if result else None,
+                         error,
+                         timing,
+                         progress)
+
+    def delete(self,
+               job_id: int):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute('DELETE FROM "job_image" WHERE "job_id" = ?',
+                               (job_id,))
+            connection.execute('DELETE FROM "job" WHERE "id" = ?',
+                               (job_id,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def heartbeat(self,
+                  worker_id: str,
+                  models: dict):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO "worker" ("id", "heartbeat", "models") '
+            'VALUES (?, ?, ?)',
+            (worker_id, time.time(), json.dumps(models)))
+
+    def remove_worker(self,
+                      worker_id: str):
+        connection = self._connection()
+        connection.execute('DELETE FROM "worker" WHERE "id" = ?',
+                           (worker_id,))
+        self._requeue(connection,
+                      time.time())
+
+    def _requeue(self,
+                 connection: sqlite3.Connection,
+                 now: float):
+        # Задания остановленных узлов выполняются заново.
+        connection.execute(
+            'UPDATE "job" SET "status" = ?, "worker_id" = NULL, '
+            '"claimed_at" = NULL, "started_at" = NULL, '
+            '"progress_step" = NULL, "progress_total" = NULL '
+            'WHERE "status" = ? AND "worker_id" NOT IN '
+            '(SELECT "id" FROM "worker" WHERE "heartbeat" >= ?)',
+            (STATUS_PENDING, STATUS_RUNNING, now - self.worker_timeout))
+
+    def _live_workers(self,
+                      connection: sqlite3.Connection,
+                      now: float):
+        return {worker_id: json.loads(models)
+                for worker_id, models in connection.execute(
+                    'SELECT "id", "models" FROM "worker" '
+                    'WHERE "heartbeat" >= ?',
+                    (now - self.worker_timeout,))}
+
+    def claim(self,
+              worker_id: str,
+              warm_models):
+        warm_models = set(warm_models)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            self._requeue(connection,
+                          now)
+            warm_elsewhere = set()
+            for other_id, models in self._live_workers(connection,
+                                                       now).items():
+                if other_id != worker_id:
+                    warm_elsewhere.update(models)
+
+            rows = connection.execute(
+                'SELECT "id", "kind", "model", "payload", "submitted_at" '
+                'FROM "job" WHERE "status" = ? '
+                'ORDER BY "priority", "id" LIMIT ?',
+                (STATUS_PENDING, CLAIM_SCAN_LIMIT)).fetchall()
+            row = next((row for row in rows if row[2] in warm_models),
+                       None)
+            if row is None:
+                row = next((row for row in rows
+                            if row[2] not in warm_elsewhere
+                            or row[4] <= now - self.cold_start_delay),
+                           None)
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            connection.execute(
+                'UPDATE "job" SET "status" = ?, "worker_id" = ?, '
+                '"claimed_at" = ? WHERE "id" = ?',
+                (STATUS_RUNNING, worker_id, now, row[0]))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return QueueJob(row[0],
+                        row[1],
+                        row[2],
+                        json.loads(row[3]),
+                        row[4])
+
+    def set_started(self,
+                    job_id: int,
+                    load_time: float):
+        self._connection().execute(
+            'UPDATE "job" SET "started_at" = ?, "load_time" = ? '
+            'WHERE "id" = ?',
+            (time.time(), load_time, job_id))
+
+    def set_progress(self,
+                     job_id: int,
+                     step: int,
+                     total: int):
+        cursor = self._connection().execute(
+            'UPDATE "job" SET "progress_step" = ?, "progress_total" = ? '
+            'WHERE "id" = ?',
+            (step, total, job_id))
+        return cursor.rowcount > 0
+
+    def complete(self,
+                 job_id: int,
+                 images: list[bytes],
+                 result: dict):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(
+                'UPDATE "job" SET "status" = ?, "finished_at" = ?, '
+                '"result" = ? WHERE "id" = ? AND "status" = ?',
+                (STATUS_DONE, time.time(), json.dumps(result), job_id,
+                 STATUS_RUNNING))
+            # Удалённое или возвращённое в очередь задание не
+            # обновляется.
+            if cursor.rowcount:
+                connection.executemany(
+                    'INSERT INTO "job_image" ("job_id", "position", "data") '
+                    'VALUES (?, ?, ?)',
+                    [(job_id, position, data)
+                     for position, data in enumerate(images)])
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def fail(self,
+             job_id: int,
+             error: str):
+        self._connection().execute(
+            'UPDATE "job" SET "status" = ?, "finished_at" = ?, '
+            '"error" = ? WHERE "id" = ? AND "status" = ?',
+            (STATUS_FAILED, time.time(), error, job_id, STATUS_RUNNING))
+
+    def workers(self):
+        return {worker_id: list(models)
+                for worker_id, models in self._live_workers(
+                    self._connection(),
+                    time.time()).items()}
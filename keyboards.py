@@ -12,6 +12,8 @@ BUTTON_KANDINSKY = "Kandinsky"
 BUTTON_KANDINSKY_CALL = "kandinsky"
 BUTTON_STABLE_CASCADE = "Stable Cascade"
 BUTTON_STABLE_CASCADE_CALL = "stable_cascade"
+BUTTON_CANCEL = "Отменить"
+BUTTON_CANCEL_CALL = "cancel_generation"
 
 neural_network_kb = InlineKeyboardMarkup(
     inline_keyboard=[
@@ -24,6 +26,13 @@ neural_network_kb = InlineKeyboardMarkup(
     ], resize_keyboard=True
 )
 
+cancel_kb = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text=BUTTON_CANCEL,
+                              callback_data=BUTTON_CANCEL_CALL)],
+    ]
+)
+
 stats_kb = ReplyKeyboardMarkup(
     keyboard=[
         [
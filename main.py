@@ -1,59 +1,119 @@
-import threading as th
+# Импортируется первым, чтобы отчёт о запуске учитывал импорт остальных
+# модулей.
+import startup_report as sr
+
 import asyncio
-import datetime as dt
+import functools
+import importlib
+import time
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import (Message, FSInputFile, InlineKeyboardMarkup,
-                           InlineKeyboardButton, CallbackQuery)
+from aiogram.types import (Message, InlineKeyboardMarkup,
+                           InlineKeyboardButton, CallbackQuery,
+                           BufferedInputFile)
 
+import admission as adm
+import async_db as adb
+import batching as ba
 import config as c
-import db
-import image_generators as ig
+import file_id_cache as fic
+import image_cache as ic
+import job_queue as jq
 import keyboards as kb
+import model_registry as mr
+import prefetch as pf
+import process_generator as pg
+import progress as pr
+import remote_generator as rmg
+import route_graph as rg
+import scheduler as sch
+import statistic_writer as sw
 import texts as tx
 import statistic as st
-
-current_neural_network = None
-current_point_map = 1
-
-bot = Bot(token=c.TG_API_TOKEN)
+import webhook as wh
+
+SESSION_NEURAL_NETWORK = "neural_network_name"
+SESSION_POINT_MAP = "point_map_id"
+# Данные кнопки перехода - id локации.
+ROUTE_CALLBACK_PATTERN = r"^\d+$"
+DEFAULT_POINT_MAP = 1
+PROGRESS_INTERVAL = 1
+# Максимальное количество одновременных соединений с Bot API. Пул
+# соединений общий для всех запросов бота.
+CONNECTION_LIMIT = 100
+# Если в config.py указан внешний адрес WEBHOOK_URL, обновления
+# принимаются через веб-хук, иначе - опросом сервера Telegram.
+WEBHOOK_URL = getattr(c, "WEBHOOK_URL", None)
+WEBHOOK_SECRET = getattr(c, "WEBHOOK_SECRET", None)
+# Путь веб-хука и адрес, на котором принимаются соединения, например
+# при работе за обратным прокси.
+WEBHOOK_PATH = getattr(c, "WEBHOOK_PATH", wh.WEBHOOK_PATH)
+WEBHOOK_HOST = getattr(c, "WEBHOOK_HOST", wh.WEBHOOK_HOST)
+WEBHOOK_PORT = getattr(c, "WEBHOOK_PORT", wh.WEBHOOK_PORT)
+# Если в config.py указан путь к очереди заданий JOB_QUEUE_PATH, модели
+# загружаются и изображения генерируются на узлах generation_worker.py.
+JOB_QUEUE_PATH = getattr(c, "JOB_QUEUE_PATH", None)
+# Количество одновременных заданий модели при генерации на узлах.
+REMOTE_WORKERS_PER_MODEL = 4
+# Причины отмены генерации: кнопка отмены и новый переход того же чата.
+CANCEL_REASON_USER = "user"
+CANCEL_REASON_SUPERSEDED = "superseded"
+# Двухэтапная отправка изображения: сначала быстрое предварительное
+# изображение с параметрами preview_* нейросети, затем изображение того
+# же сообщения заменяется изображением в полном качестве. Включается
+# явно, так как предварительное изображение занимает нейросеть.
+PREVIEW_ENABLED = False
+PREVIEW_FILE_PREFIX = "preview_"
+# Интервал вывода в журнал счётчиков кэшей, очередей и БД в секундах.
+# Если в config.py указан STATS_LOG_INTERVAL = 0, счётчики выводятся
+# только при остановке бота.
+STATS_LOG_INTERVAL = getattr(c, "STATS_LOG_INTERVAL", 600)
+
+# Загруженные нейронные сети общие для всех чатов и хранятся в реестре
+# моделей. Выбор нейронной сети и текущая точка на карте хранятся в
+# состоянии чата (FSM).
+# Классы генераторов указаны по имени: модуль image_generators вместе с
+# torch и diffusers импортируется только при первой загрузке модели.
+NEURAL_NETWORK_LOADERS = {
+    kb.BUTTON_STABLE_DIFFUSION_CALL: "StableDiffusion",
+    kb.BUTTON_KANDINSKY_CALL: "Kandinsky",
+    kb.BUTTON_STABLE_CASCADE_CALL: "StableCascade",
+}
+IMAGE_GENERATORS_MODULE = "image_generators"
+
+startup_report = sr.StartupReport()
+startup_report.mark("imports and database")
+
+bot = Bot(token=c.TG_API_TOKEN,
+          session=AiohttpSession(limit=CONNECTION_LIMIT))
 dp = Dispatcher(storage=MemoryStorage())
-
-class ThreadWithResult(th.Thread):
-    """
-    Класс для создания потоков, возвращающих результат выполнения
-    функции.
-
-    Attributes:
-        group(object): Группа потока.
-        target(object): Функция, выполняемая в потоке.
-        name(str): Имя потока.
-        args(tuple): Аргументы функции.
-        kwargs(dict): Аргументы функции.
-        daemon(bool): Является ли этот поток потоком демона.
-        result(object): Результат выполнения функции.
-    """
-
-    def __init__(self,
-                 group=None,
-                 target=None,
-                 name=None,
-                 args=(),
-                 kwargs={},
-                 *,
-                 daemon=None):
-        self.result = None
-
-        def function():
-            self.result = target(*args,
-                                 **kwargs)
-
-        super().__init__(group=group,
-                         target=function,
-                         name=name,
-                         daemon=daemon)
+image_cache = ic.ImageCache()
+admission = adm.AdmissionController()
+job_queue = jq.SqliteJobQueue(JOB_QUEUE_PATH) if JOB_QUEUE_PATH else None
+scheduler = sch.GenerationScheduler(
+    workers_per_model=(REMOTE_WORKERS_PER_MODEL if job_queue is not None
+                       else sch.WORKERS_PER_MODEL),
+    batcher=ba.MicroBatcher() if ba.BATCHING_ENABLED else None)
+progress_updater = pr.ProgressUpdater(bot)
+model_registry = mr.ModelRegistry(scheduler)
+prefetcher = pf.Prefetcher(scheduler,
+                           image_cache)
+route_graph = rg.RouteGraph()
+database = adb.AsyncDatabase()
+statistic_writer = sw.StatisticWriter(database)
+file_id_cache = fic.FileIdCache(database)
+statistic_columns = st.StatisticColumns()
+chart_renderer = st.ChartRenderer()
+# Клавиатуры маршрутов для точек на карте текущей версии графа.
+routes_keyboards = {}
+# Ожидаемое задание генерации и id сообщения о ходе генерации по id чата.
+active_jobs = {}
+startup_report.mark("bot objects")
 
 
 def build_routes_menu(buttons: list[InlineKeyboardButton],
@@ -111,60 +171,234 @@ async def get_neural_network_name(neural_network):
             return parts_name[0] + _underscore + parts_name[1]
 
 
+async def get_session(state: FSMContext):
+    """
+    Получение состояния игры текущего чата.
+
+    Parameters:
+        state(FSMContext): Состояние чата.
+
+    Returns:
+        tuple[str, int]: Название выбранной нейронной сети и id текущей
+        точки на карте.
+    """
+    data = await state.get_data()
+    return (data.get(SESSION_NEURAL_NETWORK),
+            data.get(SESSION_POINT_MAP, DEFAULT_POINT_MAP))
+
+
+async def get_image_cache_key(neural_network,
+                              prompt: str):
+    """
+    Получение ключа кэша изображения для нейронной сети и описания.
+
+    Parameters:
+        neural_network (ImageGenerator): Нейронная сеть.
+        prompt (str): Текстовое описание изображения.
+
+    Returns:
+        str: Ключ кэша.
+    """
+    return ic.make_key(neural_network.model_id,
+                       prompt,
+                       neural_network.negative_prompt,
+                       neural_network.num_inference_steps,
+                       neural_network.height,
+                       neural_network.width,
+                       neural_network.seed,
+                       neural_network.image_format,
+                       neural_network.image_quality)
+
+
+async def get_batch_key(neural_network,
+                        preview=False,
+                        priority=sch.PRIORITY_INTERACTIVE):
+    """
+    Получение ключа объединения запросов генерации в пакет: все
+    параметры генерации, кроме текстового описания, и приоритет.
+    Запросы игроков не объединяются с фоновой генерацией, чтобы не
+    ждать генерации изображений, которые могут не понадобиться.
+
+    Parameters:
+        neural_network (ImageGenerator): Нейронная сеть.
+        preview (bool): Генерация предварительного изображения.
+        priority (int): Приоритет задания.
+
+    Returns:
+        tuple: Ключ пакета.
+    """
+    return (neural_network.model_id,
+            neural_network.negative_prompt,
+            neural_network.num_inference_steps,
+            neural_network.height,
+            neural_network.width,
+            neural_network.seed,
+            preview,
+            priority)
+
+
+async def get_job_progress_text(job: sch.GenerationJob,
+                                text_in_process: str):
+    """
+    Текст сообщения о ходе выполнения задания.
+
+    Parameters:
+        job(GenerationJob): Задание планировщика.
+        text_in_process(str): Текст для выполняющегося задания. Если
+        None, ход выполнения сообщается по шагам генерации.
+
+    Returns:
+        str: Позиция в очереди или время выполнения задания.
+    """
+    position = scheduler.queue_position(job)
+    if position > 0:
+        return (tx.QUEUE_POSITION
+                + str(position)
+                + tx.QUEUE_POSITION_OF
+                + str(scheduler.queue_length(job.queue_name)))
+    if text_in_process is None:
+        return None
+    return text_in_process + f"{int(job.service_time)}" + tx.TIME_UNITS
+
+
+async def wait_for_job(job: sch.GenerationJob,
+                       load_message: Message,
+                       text_in_process=None):
+    """
+    Ожидание выполнения задания с выводом позиции в очереди и хода
+    выполнения в сообщении.
+
+    Parameters:
+        job(GenerationJob): Задание планировщика.
+        load_message(Message): Сообщение о ходе выполнения.
+        text_in_process(str): Текст для выполняющегося задания. Если
+        None, ход выполнения сообщается по шагам генерации.
+
+    Returns:
+        Any: Результат выполнения задания.
+    """
+    chat_id = load_message.chat.id
+    while not job.done():
+        await asyncio.wait({job.future},
+                           timeout=PROGRESS_INTERVAL)
+        if not job.done():
+            text = await get_job_progress_text(job,
+                                               text_in_process)
+            if text is not None:
+                progress_updater.update(chat_id,
+                                        load_message.message_id,
+                                        text)
+
+    progress_updater.discard(chat_id,
+                             load_message.message_id)
+    await load_message.delete()
+
+    if st.SHOW_STATISTICS and job.wait_time >= PROGRESS_INTERVAL:
+        await bot.send_message(chat_id=chat_id,
+                               text=tx.QUEUE_WAIT_TIME
+                                    + f"{job.wait_time:.2f}"
+                                    + tx.TIME_UNITS)
+    return job.future.result()
+
+
+def create_neural_network(class_name: str):
+    """
+    Создание генератора изображений. Выполняется в потоке загрузки
+    моделей, поэтому импорт torch и diffusers не блокирует цикл событий.
+    При работе с узлами генерации модель загружается на узле, а в режиме
+    PROCESS_ISOLATION - в дочернем процессе.
+
+    Parameters:
+        class_name (str): Имя класса генератора в image_generators.
+
+    Returns:
+        ImageGenerator: Нейронная сеть.
+    """
+    if job_queue is not None:
+        return rmg.RemoteImageGenerator(job_queue,
+                                        class_name)
+    if pg.PROCESS_ISOLATION:
+        return pg.ProcessImageGenerator(class_name)
+    image_generators = importlib.import_module(IMAGE_GENERATORS_MODULE)
+    return getattr(image_generators, class_name)()
+
+
+async def get_neural_network(neural_network_name: str,
+                             chat_id: int):
+    """
+    Получение нейронной сети из реестра с загрузкой, если она ещё не
+    загружена или была вытеснена.
+
+    Parameters:
+        neural_network_name (str): Название нейронной сети.
+        chat_id (int): Id чата для вывода хода загрузки.
+
+    Returns:
+        ImageGenerator: Нейронная сеть. Если загрузить нейронную сеть не
+        удалось, возвращается None.
+    """
+    neural_network = model_registry.get(neural_network_name)
+    if neural_network is not None:
+        return neural_network
+
+    class_name = NEURAL_NETWORK_LOADERS.get(neural_network_name)
+    if class_name is None:
+        return None
+    loader = functools.partial(create_neural_network,
+                               class_name)
+
+    load_message = await bot.send_message(chat_id=chat_id,
+                                          text=tx.QUEUE_WAITING)
+    job, is_new = await model_registry.load(neural_network_name,
+                                            loader)
+    try:
+        neural_network = await wait_for_job(job,
+                                            load_message,
+                                            tx.NEURO_IN_PROCESS)
+    except Exception as e:
+        print(e)
+        neural_network = None
+    if neural_network is None:
+        await bot.send_message(chat_id=chat_id,
+                               text=tx.NEURO_LOADING_ERROR)
+        return None
+
+    if is_new:
+        time_load_in_seconds = job.service_time
+        if st.SHOW_STATISTICS:
+            await bot.send_message(chat_id=chat_id,
+                                   text=tx.NEURO_INIT_TIME
+                                        + str(time_load_in_seconds))
+        if st.COLLECT_STATISTIC:
+            statistic_writer.add_loaded(neural_network_name,
+                                        time_load_in_seconds)
+    return neural_network
+
+
 async def load_neural_network(neural_network_name: str,
-                              call: CallbackQuery):
+                              call: CallbackQuery,
+                              state: FSMContext):
     """
-    Загрузка нейронной сети в память.
+    Загрузка нейронной сети в память и выбор её для текущего чата.
 
     Parameters:
         neural_network_name (str): Название нейронной сети.
         call (CallbackQuery): Запрос.
+        state (FSMContext): Состояние чата.
 
     Returns:
         str: Ошибка при загрузке.
     """
-    global current_neural_network
-    global current_point_map
-
     await call.answer(text=tx.NEURO_LOADING.format(neural_network_name))
 
-    start_time = dt.datetime.now()
-    if neural_network_name == kb.BUTTON_STABLE_DIFFUSION_CALL:
-        thread = ThreadWithResult(target=ig.StableDiffusion,
-                                  args=())
-    elif neural_network_name == kb.BUTTON_KANDINSKY_CALL:
-        thread = ThreadWithResult(target=ig.Kandinsky,
-                                  args=())
-    elif neural_network_name == kb.BUTTON_STABLE_CASCADE_CALL:
-        thread = ThreadWithResult(target=ig.StableCascade,
-                                  args=())
-    else:
+    if neural_network_name not in NEURAL_NETWORK_LOADERS:
         return await call.answer(tx.NEURO_NOT_FOUND)
 
-    thread.start()
-
-    i = 0
-    text = (tx.NEURO_IN_PROCESS + f"{i}" + tx.TIME_UNITS)
-    load_message = await bot.send_message(chat_id=call.message.chat.id,
-                                          text=text)
-    while thread.is_alive():
-        i += 1
-        await asyncio.sleep(1)
-        text = (tx.NEURO_LOADING_TIME + f"{i}" + tx.TIME_UNITS)
-        await load_message.edit_text(text=text)
-
-    await load_message.delete()
-    current_neural_network = thread.result
-    end_time = dt.datetime.now()
-    time_load_in_seconds = (end_time - start_time).total_seconds()
-
-    if st.SHOW_STATISTICS:
-        await bot.send_message(chat_id=call.message.chat.id,
-                               text=tx.NEURO_INIT_TIME
-                                    + str(time_load_in_seconds))
-    if st.COLLECT_STATISTIC:
-        db.add_statistic_loaded(neural_network_name,
-                                time_load_in_seconds)
+    neural_network = await get_neural_network(neural_network_name,
+                                              call.message.chat.id)
+    if neural_network is not None:
+        await state.update_data(
+            {SESSION_NEURAL_NETWORK: neural_network_name})
 
 
 async def call_to_message(call: CallbackQuery,
@@ -205,25 +439,357 @@ async def start(call: CallbackQuery):
                       reply_markup=kb.neural_network_kb)
 
 
+async def generate_location_image(message: Message,
+                                  neural_network,
+                                  prompt: str,
+                                  cache_key: str,
+                                  image_name: str):
+    """
+    Генерация и отправка изображения локации выбранной нейронной сетью.
+    Если изображение уже генерируется в фоне, ожидается фоновое задание,
+    иначе генерация ставится в очередь, если она не заполнена.
+
+    Parameters:
+        message(Message): Сообщение.
+        neural_network(ImageGenerator): Нейронная сеть.
+        prompt(str): Текстовое описание изображения.
+        cache_key(str): Ключ кэша изображения.
+        image_name(str): Имя файла изображения.
+
+    Returns:
+        bytes: Закодированное сгенерированное изображение.
+
+    Raises:
+        RateLimitedError: Чат слишком часто запрашивает генерацию.
+        OverloadedError: Очередь генерации заполнена.
+    """
+    job = prefetcher.take(cache_key)
+    if job is None:
+        # Запас чата расходуется только на новую генерацию, которая
+        # поместилась в очередь.
+        admission.enter()
+        if not admission.allow(message.chat.id):
+            admission.leave()
+            raise adm.RateLimitedError("generation rate limit exceeded")
+    try:
+        return await wait_for_location_image(message,
+                                             neural_network,
+                                             prompt,
+                                             job,
+                                             image_name)
+    finally:
+        if job is None:
+            admission.leave()
+
+
+async def add_first_image_statistic(neural_network,
+                                    requested_at: float):
+    """
+    Добавление статистики по времени от запроса до первого изображения,
+    предварительного или в полном качестве.
+
+    Parameters:
+        neural_network(ImageGenerator): Нейронная сеть.
+        requested_at(float): Время запроса по time.monotonic().
+    """
+    if st.COLLECT_STATISTIC:
+        name = await get_neural_network_name(neural_network)
+        statistic_writer.add_first_image(name,
+                                         time.monotonic() - requested_at)
+
+
+async def send_preview(chat_id: int,
+                       neural_network,
+                       preview_job: sch.GenerationJob,
+                       image_name: str,
+                       requested_at: float):
+    """
+    Отправка предварительного изображения, как только оно готово.
+
+    Parameters:
+        chat_id(int): Id чата.
+        neural_network(ImageGenerator): Нейронная сеть.
+        preview_job(GenerationJob): Задание генерации предварительного
+        изображения.
+        image_name(str): Имя файла изображения в полном качестве.
+        requested_at(float): Время запроса по time.monotonic().
+
+    Returns:
+        Message: Сообщение с предварительным изображением. Если
+        изображение не получено, возвращается None.
+    """
+    try:
+        preview_data = await preview_job
+        if preview_data is None:
+            return None
+        preview_message = await bot.send_photo(
+            chat_id=chat_id,
+            photo=BufferedInputFile(preview_data,
+                                    filename=PREVIEW_FILE_PREFIX + image_name))
+    except Exception as e:
+        print(e)
+        return None
+    await add_first_image_statistic(neural_network,
+                                    requested_at)
+    return preview_message
+
+
+async def wait_for_location_image(message: Message,
+                                  neural_network,
+                                  prompt: str,
+                                  job,
+                                  image_name: str):
+    """
+    Постановка генерации изображения в очередь, если фонового задания
+    нет, ожидание результата и отправка изображения. В режиме
+    PREVIEW_ENABLED перед изображением в полном качестве генерируется
+    предварительное, и изображение в полном качестве заменяет его в том
+    же сообщении.
+
+    Parameters:
+        message(Message): Сообщение.
+        neural_network(ImageGenerator): Нейронная сеть.
+        prompt(str): Текстовое описание изображения.
+        job(GenerationJob): Фоновое задание или None.
+        image_name(str): Имя файла изображения.
+
+    Returns:
+        bytes: Закодированное сгенерированное изображение.
+
+    Raises:
+        JobCancelled: Генерация отменена.
+        TimeoutError: Генерация превысила время выполнения модели.
+    """
+    requested_at = time.monotonic()
+    load_message = await bot.send_message(chat_id=message.chat.id,
+                                          text=tx.QUEUE_WAITING,
+                                          reply_markup=kb.cancel_kb)
+    progress_updater.set_reply_markup(message.chat.id,
+                                      load_message.message_id,
+                                      kb.cancel_kb)
+    preview_job = None
+    preview_task = None
+    if job is None:
+        if (PREVIEW_ENABLED
+                and neural_network.preview_num_inference_steps is not None):
+            # Ставится первым, чтобы выполниться раньше основного задания.
+            preview_job = await scheduler.submit(
+                neural_network.model_id,
+                ba.generate_batch,
+                neural_network,
+                prompt,
+                preview=True,
+                priority=sch.PRIORITY_INTERACTIVE,
+                batch_key=await get_batch_key(neural_network,
+                                              preview=True),
+                timeout=neural_network.generation_timeout)
+            preview_task = asyncio.create_task(
+                send_preview(message.chat.id,
+                             neural_network,
+                             preview_job,
+                             image_name,
+                             requested_at))
+
+        progress = progress_updater.make_step_callback(
+            message.chat.id,
+            load_message.message_id,
+            tx.GENERATION_STEP)
+        job = await scheduler.submit(neural_network.model_id,
+                                     ba.generate_batch,
+                                     neural_network,
+                                     prompt,
+                                     progress=progress,
+                                     priority=sch.PRIORITY_INTERACTIVE,
+                                     batch_key=await get_batch_key(
+                                         neural_network),
+                                     timeout=neural_network.generation_timeout)
+        text_in_process = None
+    else:
+        text_in_process = tx.GENERATION_IN_PROCESS
+
+    active_jobs[message.chat.id] = (load_message.message_id,
+                                    job)
+    try:
+        image_data = await wait_for_job(job,
+                                        load_message,
+                                        text_in_process)
+    except (sch.JobCancelled, TimeoutError) as e:
+        if st.COLLECT_STATISTIC:
+            name = await get_neural_network_name(neural_network)
+            time_interrupted = job.wait_time + job.service_time
+            if isinstance(e, TimeoutError):
+                statistic_writer.add_timed_out(name,
+                                               time_interrupted)
+            else:
+                statistic_writer.add_cancelled(name,
+                                               time_interrupted)
+        raise
+    finally:
+        if active_jobs.get(message.chat.id, (None, None))[1] is job:
+            del active_jobs[message.chat.id]
+        # Предварительное изображение не нужно, если основное уже
+        # готово или отменено.
+        if preview_job is not None:
+            preview_job.cancel(interrupt=True)
+    if image_data is None:
+        raise RuntimeError(tx.GENERATION_ERROR)
+
+    time_generate_in_seconds = job.service_time
+
+    text = (tx.GENERATION_TIME
+            + str(time_generate_in_seconds)
+            + tx.TIME_UNITS)
+    if st.SHOW_STATISTICS:
+        await bot.send_message(chat_id=message.chat.id,
+                               text=text)
+
+    if st.COLLECT_STATISTIC:
+        name = await get_neural_network_name(neural_network)
+
+        statistic_writer.add_generated(name,
+                                       time_generate_in_seconds)
+
+    preview_message = None
+    if preview_task is not None:
+        preview_message = await preview_task
+    if preview_message is not None:
+        try:
+            await file_id_cache.edit_photo(bot,
+                                           message.chat.id,
+                                           preview_message.message_id,
+                                           image_data,
+                                           image_name)
+            return image_data
+        except TelegramBadRequest as e:
+            # Например, сообщение с предварительным изображением удалено.
+            print(e)
+    await file_id_cache.send_photo(bot,
+                                   message.chat.id,
+                                   image_data,
+                                   image_name)
+    if preview_message is None:
+        await add_first_image_statistic(neural_network,
+                                        requested_at)
+    return image_data
+
+
+async def get_routes_keyboard(point_map_id: int,
+                              available_routes: list[rg.PointRecord]):
+    """
+    Клавиатура маршрутов из точки на карте. Клавиатура создаётся один
+    раз для каждой версии графа маршрутов.
+
+    Parameters:
+        point_map_id(int): Id точки на карте.
+        available_routes(list[PointRecord]): Доступные точки на карте.
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура маршрутов. Если маршрутов нет,
+        возвращается None.
+    """
+    key = (route_graph.version, point_map_id)
+    if key in routes_keyboards:
+        return routes_keyboards[key]
+    if any(version != route_graph.version
+           for version, _ in routes_keyboards):
+        routes_keyboards.clear()
+
+    keyboard_buttons = []
+    for route in available_routes:
+        keyboard_buttons.append(
+            InlineKeyboardButton(text=route.name,
+                                 callback_data=str(route.id)))
+
+    keyboard_markup = None
+    if keyboard_buttons:
+        keyboard_markup = InlineKeyboardMarkup(
+            inline_keyboard=build_routes_menu(keyboard_buttons,
+                                              1))
+    routes_keyboards[key] = keyboard_markup
+    return keyboard_markup
+
+
+async def prefetch_routes(chat_id: int,
+                          neural_network,
+                          available_routes):
+    """
+    Фоновая генерация изображений локаций, доступных из текущей.
+
+    Parameters:
+        chat_id(int): Id чата.
+        neural_network(ImageGenerator): Нейронная сеть.
+        available_routes(list[PointRecord]): Доступные локации.
+    """
+    if not admission.allow_prefetch():
+        return
+    requests = []
+    for route in available_routes:
+        if route.ai_description is not None:
+            cache_key = await get_image_cache_key(neural_network,
+                                                  route.ai_description)
+            requests.append((cache_key,
+                             route.ai_description))
+
+    await prefetcher.prefetch(chat_id,
+                              neural_network,
+                              requests,
+                              await get_batch_key(
+                                  neural_network,
+                                  priority=sch.PRIORITY_BACKGROUND))
+
+
 @dp.message(Command(tx.COMMAND_SHOW_ROUTES))
-async def show_routes(message: Message):
+async def show_routes(message: Message,
+                      state: FSMContext):
     """
     Функция отображения маршрутов.
 
     Parameters:
         message(Message): Сообщение.
+        state(FSMContext): Состояние чата.
     """
-    point_map = db.get_point_map(current_point_map)
-    available_routes = db.get_available_routes(current_point_map)
+    neural_network_name, point_map_id = await get_session(state)
+
+    await database.refresh_route_graph(route_graph)
+    point_map = route_graph.get_point(point_map_id)
+    available_routes = route_graph.get_neighbours(point_map_id)
 
     if point_map is None:
         await message.answer(tx.ROUTES_UNAVAILABLE)
         return
 
-    if current_neural_network is None:
+    if neural_network_name is None:
         await message.answer(tx.NEURO_NOT_FOUND)
         return
+    # Модель не вытесняется, пока изображение не сгенерировано и фоновые
+    # задания не поставлены в очередь.
+    model_registry.pin(neural_network_name)
+    try:
+        neural_network = await get_neural_network(neural_network_name,
+                                                  message.chat.id)
+        if neural_network is None:
+            return
+        await show_location(message,
+                            neural_network,
+                            point_map,
+                            available_routes)
+    finally:
+        model_registry.unpin(neural_network_name)
+
+
+async def show_location(message: Message,
+                        neural_network,
+                        point_map: rg.PointRecord,
+                        available_routes: list[rg.PointRecord]):
+    """
+    Отображение локации: название, описание, изображение и маршруты.
 
+    Parameters:
+        message(Message): Сообщение.
+        neural_network(ImageGenerator): Нейронная сеть.
+        point_map(PointRecord): Точка на карте.
+        available_routes(list[PointRecord]): Доступные точки на карте.
+    """
     await bot.send_message(chat_id=message.chat.id,
                            text=point_map.name)
     await bot.send_message(chat_id=message.chat.id,
@@ -234,215 +800,384 @@ async def show_routes(message: Message):
                                text=tx.ROUTES_WITHOUT_DESCRIPTION)
     else:
         try:
-            start_time = dt.datetime.now()
-            thread = ThreadWithResult(target=current_neural_network.
-                                             generate_image,
-                                      args=(point_map.ai_description,))
-            thread.start()
-
-            i = 0
-            text = (tx.GENERATION_IN_PROCESS + f"{i}" + tx.TIME_UNITS)
-
-            load_message = await bot.send_message(chat_id=message.chat.id,
-                                                  text=text)
-            while thread.is_alive():
-                i += 1
-                await asyncio.sleep(1)
-                text = (tx.GENERATION_IN_PROCESS + f"{i}" + tx.TIME_UNITS)
-                await load_message.edit_text(text=text)
-
-            await load_message.delete()
-            generate_image_path = thread.result
-
-            end_time = dt.datetime.now()
-
-            time_generate_in_seconds = (end_time - start_time).total_seconds()
-
-            text = (tx.GENERATION_TIME
-                    + str(time_generate_in_seconds)
-                    + tx.TIME_UNITS)
-            if st.SHOW_STATISTICS:
-                await bot.send_message(chat_id=message.chat.id,
-                                       text=text)
-
-            if st.COLLECT_STATISTIC:
-                name = await get_neural_network_name(current_neural_network)
-
-                db.add_statistic_generated(name,
-                                           time_generate_in_seconds)
-
-            await bot.send_photo(chat_id=message.chat.id,
-                                 photo=FSInputFile(generate_image_path))
+            cache_key = await get_image_cache_key(neural_network,
+                                                  point_map.ai_description)
+            image_name = cache_key + neural_network.get_image_extension()
+            image_data = await asyncio.to_thread(image_cache.get,
+                                                 cache_key)
+            if image_data is None:
+                image_data = await generate_location_image(
+                    message,
+                    neural_network,
+                    point_map.ai_description,
+                    cache_key,
+                    image_name)
+                await asyncio.to_thread(image_cache.put,
+                                        cache_key,
+                                        image_data)
+            else:
+                await file_id_cache.send_photo(bot,
+                                               message.chat.id,
+                                               image_data,
+                                               image_name)
+        except adm.RateLimitedError as e:
+            print(e)
+            await bot.send_message(chat_id=message.chat.id,
+                                   text=tx.RATE_LIMITED)
+        except adm.OverloadedError as e:
+            print(e)
+            await bot.send_message(chat_id=message.chat.id,
+                                   text=tx.QUEUE_FULL)
+            return
+        except sch.JobCancelled as e:
+            # После отмены новым переходом показывается новая локация.
+            if e.reason == CANCEL_REASON_SUPERSEDED:
+                return
+            await bot.send_message(chat_id=message.chat.id,
+                                   text=tx.GENERATION_CANCELLED)
+        except TimeoutError as e:
+            print(e)
+            await bot.send_message(chat_id=message.chat.id,
+                                   text=tx.GENERATION_TIMEOUT)
         except Exception as e:
             print(e)
             await bot.send_message(chat_id=message.chat.id,
                                    text=tx.GENERATION_ERROR)
             return
 
-    keyboard_buttons = []
-
-    for route in available_routes:
-        keyboard_buttons.append(
-            InlineKeyboardButton(text=route.name,
-                                 callback_data=str(route.id)))
-
-    if keyboard_buttons is None:
+    keyboard_markup = await get_routes_keyboard(point_map.id,
+                                                available_routes)
+    if keyboard_markup is None:
         await bot.send_message(chat_id=message.chat.id,
                                text=tx.ROUTES_UNAVAILABLE)
     else:
-        keyboard_markup = InlineKeyboardMarkup(
-            inline_keyboard=build_routes_menu(keyboard_buttons,
-                                              1))
         await bot.send_message(chat_id=message.chat.id,
                                text=tx.ROUTES_ANSWER,
                                reply_markup=keyboard_markup)
 
+    if pf.PREFETCH_ENABLED:
+        await prefetch_routes(message.chat.id,
+                              neural_network,
+                              available_routes)
+
 
 @dp.callback_query(F.data == kb.BUTTON_STABLE_DIFFUSION_CALL)
-async def stable_diffusion(call: CallbackQuery):
+async def stable_diffusion(call: CallbackQuery,
+                           state: FSMContext):
     """
     Загрузка нейронной сети Stable Diffusion.
 
     Parameters:
         call(CallbackQuery): Запрос.
+        state(FSMContext): Состояние чата.
     """
     await load_neural_network(kb.BUTTON_STABLE_DIFFUSION_CALL,
-                              call)
+                              call,
+                              state)
 
     message = await call_to_message(call,
                                     tx.COMMAND_SHOW_ROUTES)
-    await show_routes(message)
+    await show_routes(message,
+                      state)
 
 
 @dp.callback_query(F.data == kb.BUTTON_KANDINSKY_CALL)
-async def kandinsky(call: CallbackQuery):
+async def kandinsky(call: CallbackQuery,
+                    state: FSMContext):
     """
     Загрузка нейронной сети Kandinsky.
 
     Parameters:
         call(CallbackQuery): Запрос.
+        state(FSMContext): Состояние чата.
     """
     await load_neural_network(kb.BUTTON_KANDINSKY_CALL,
-                              call)
+                              call,
+                              state)
 
     message = await call_to_message(call,
                                     tx.COMMAND_SHOW_ROUTES)
-    await show_routes(message)
+    await show_routes(message,
+                      state)
 
 
 @dp.callback_query(F.data == kb.BUTTON_STABLE_CASCADE_CALL)
-async def stable_cascade(call: CallbackQuery):
+async def stable_cascade(call: CallbackQuery,
+                         state: FSMContext):
     """
     Загрузка нейронной сети Stable Cascade.
 
     Parameters:
         call(CallbackQuery): Запрос.
+        state(FSMContext): Состояние чата.
     """
     await load_neural_network(kb.BUTTON_STABLE_CASCADE_CALL,
-                              call)
+                              call,
+                              state)
     message = await call_to_message(call,
                                     tx.COMMAND_SHOW_ROUTES)
-    await show_routes(message)
+    await show_routes(message,
+                      state)
 
 
-@dp.callback_query()
-async def next_route(call: CallbackQuery):
+def cancel_active_job(chat_id: int,
+                      reason: str,
+                      message_id=None):
+    """
+    Отмена ожидаемой чатом генерации изображения, в том числе уже
+    выполняющейся.
+
+    Parameters:
+        chat_id(int): Id чата.
+        reason(str): Причина отмены.
+        message_id(int): Id сообщения о ходе генерации. Если задан,
+        отменяется только генерация этого сообщения.
+
+    Returns:
+        bool: Удалось ли отменить генерацию.
+    """
+    active = active_jobs.get(chat_id)
+    if active is None:
+        return False
+    active_message_id, job = active
+    if message_id is not None and message_id != active_message_id:
+        return False
+    return job.cancel(interrupt=True,
+                      reason=reason)
+
+
+# Регистрируется до next_route, который обрабатывает остальные нажатия.
+@dp.callback_query(F.data == kb.BUTTON_CANCEL_CALL)
+async def cancel_generation(call: CallbackQuery):
+    """
+    Отмена генерации кнопкой в сообщении о ходе генерации.
+
+    Parameters:
+        call(CallbackQuery): Запрос.
+    """
+    if cancel_active_job(call.message.chat.id,
+                         CANCEL_REASON_USER,
+                         call.message.message_id):
+        await call.answer(tx.GENERATION_CANCELLING)
+    else:
+        await call.answer(tx.GENERATION_NOT_CANCELLED)
+
+
+@dp.callback_query(F.data.regexp(ROUTE_CALLBACK_PATTERN))
+async def next_route(call: CallbackQuery,
+                     state: FSMContext):
     """
-    Переход к следующему маршруту.
+    Переход к следующему маршруту. Нажатия во время показа предыдущего
+    перехода объединяются: генерация изображения предыдущей локации
+    отменяется, и после завершения показа выводится последняя выбранная
+    локация. Частота ограничивается только для новых генераций.
 
     Parameters:
         call(CallbackQuery): Запрос.
+        state(FSMContext): Состояние чата.
     """
-    global current_point_map
-    current_point_map = call.data
+    chat_id = call.message.chat.id
+    await state.update_data({SESSION_POINT_MAP: int(call.data)})
+    if not admission.begin(chat_id):
+        cancel_active_job(chat_id,
+                          CANCEL_REASON_SUPERSEDED)
+        await call.answer(tx.REQUEST_COALESCED)
+        return
 
     message = await call_to_message(call,
                                     tx.COMMAND_SHOW_ROUTES)
+    try:
+        await show_routes(message,
+                          state)
+        while admission.finish(chat_id):
+            await show_routes(message,
+                              state)
+    finally:
+        admission.abandon(chat_id)
+
+
+@dp.callback_query()
+async def unknown_callback(call: CallbackQuery):
+    """
+    Ответ на нажатие кнопки, для которой нет обработчика, например
+    кнопки сообщения из старой версии бота.
+
+    Parameters:
+        call(CallbackQuery): Запрос.
+    """
+    await call.answer(tx.BUTTON_OUTDATED)
+
+
+async def send_statistics_summary(message: Message):
+    """
+    Отправка сводной статистики всех нейронных сетей одним сообщением.
+
+    Parameters:
+        message(Message): Сообщение.
+    """
+    statistics_data = await database.get_statistic()
+    texts = await st.get_summary_texts(statistics_data)
+    await message.answer(tx.COMMAND_STATISTICS_TEXT
+                         + "\n\n"
+                         + "".join(texts))
+
+
+async def render_statistics_dashboard():
+    """
+    Построение общего изображения с графиками статистики всех нейронных
+    сетей.
 
-    await show_routes(message)
+    Returns:
+        bytes: Изображение в формате PNG. Если статистики нет,
+        возвращается None.
+    """
+    # Разделение статистики по нейронным сетям
+    await statistic_columns.refresh(database)
+    series_generated = await statistic_columns.get_series("time_generated")
+    series_loaded = await statistic_columns.get_series("time_loaded")
+
+    return await chart_renderer.render_dashboard(series_generated,
+                                                 series_loaded,
+                                                 statistic_columns.last_id)
 
 
 @dp.message(lambda message: message.text == kb.BUTTON_STATS)
 async def get_statistics(message: Message):
     """
     Статистика загрузки нейронных сетей, и времени создания изображений.
+    Сводная статистика отправляется, пока строится изображение с
+    графиками, поэтому ответ занимает два запроса к Telegram при любом
+    количестве нейронных сетей.
 
     Parameters:
         message(Message): Сообщение.
     """
-    statistics_data = db.get_statistic()
-    text = ""
-
-    await message.answer(tx.COMMAND_STATISTICS_TEXT)
-    for stat in statistics_data:
-        text = stat.neural_network_name + ": \n"
-        if stat.time_generated is not None:
-            text += st.AVG_TIME_GENERATED_NAME + str(stat.time_generated)
-            text += "\n"
-        if stat.time_loaded is not None:
-            text += st.AVG_TIME_LOADED_NAME + str(stat.time_loaded)
-            text += "\n"
-        text += "\n"
-        await message.answer(text)
-        text = ""
-    # Разделение статистики по нейронным сетям
-    statistics_detailed_data = db.get_statistic_detailed()
-
-    lists_by_neural_networks = await st.get_lists_by_neural_networks(
-        statistics_detailed_data)
-
-    (lists_time_generated,
-     lists_time_generated_indexes,
-     lists_time_loaded,
-     lists_time_loaded_indexes) = await st.get_time_generated_list_and_indexes(
-        lists_by_neural_networks)
-
-    index = 0
-    for list in lists_by_neural_networks:
-        list_time_generated = lists_time_generated[index]
-        list_time_generated_indexes = lists_time_generated_indexes[index]
-        list_time_loaded = lists_time_loaded[index]
-        list_time_loaded_indexes = lists_time_loaded_indexes[index]
-
-        (neural_network_name,
-         time_loaded,
-         time_generated) = list[index]
-
-        graph_file_path = await st.create_graph(list_time_generated_indexes,
-                                                list_time_generated,
-                                                st.TIME_GENERATED_NAME
-                                                + " "
-                                                + neural_network_name,
-                                                st.INDEX_NAME,
-                                                st.TIME_GENERATED_NAME,
-                                                list_time_generated_indexes,
-                                                list_time_generated)
-        await bot.send_photo(chat_id=message.chat.id,
-                             photo=FSInputFile(graph_file_path))
-
-        graph_file_path = await st.create_graph(list_time_loaded_indexes,
-                                                list_time_loaded,
-                                                st.TIME_LOADED_NAME
-                                                + " "
-                                                + neural_network_name,
-                                                st.INDEX_NAME,
-                                                st.TIME_LOADED_NAME,
-                                                list_time_loaded_indexes,
-                                                list_time_loaded)
-
-        await bot.send_photo(chat_id=message.chat.id,
-                             photo=FSInputFile(graph_file_path))
-
-        index += 1
+    await statistic_writer.flush()
+    _, dashboard = await asyncio.gather(send_statistics_summary(message),
+                                        render_statistics_dashboard())
+
+    if dashboard is not None:
+        await file_id_cache.send_photo(bot,
+                                       message.chat.id,
+                                       dashboard,
+                                       st.DASHBOARD_NAME)
+
+
+def get_runtime_stats():
+    """
+    Счётчики компонентов бота: очередей генерации, кэшей, реестра
+    моделей, фоновой генерации, допуска запросов и БД.
+
+    Returns:
+        dict[str, dict]: Счётчики по названиям компонентов.
+    """
+    return {"scheduler": scheduler.stats(),
+            "admission": admission.stats(),
+            "models": model_registry.stats(),
+            "prefetch": prefetcher.stats(),
+            "image_cache": image_cache.stats(),
+            "file_id_cache": file_id_cache.stats(),
+            "database": database.stats(),
+            "progress": {"updates": progress_updater.updates,
+                         "edits": progress_updater.edits},
+            "statistic_writer": {"written": statistic_writer.written,
+                                 "flushes": statistic_writer.flushes,
+                                 "failures": statistic_writer.failures,
+                                 "dropped": statistic_writer.dropped}}
+
+
+def format_runtime_stats():
+    """
+    Текст счётчиков компонентов бота для журнала.
+
+    Returns:
+        str: По строке на компонент.
+    """
+    return "\n".join(f"{name}: {stats}"
+                     for name, stats in get_runtime_stats().items())
+
+
+async def log_runtime_stats(interval: float):
+    """
+    Периодический вывод счётчиков компонентов бота в журнал.
+
+    Parameters:
+        interval(float): Интервал вывода в секундах.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            print(format_runtime_stats())
+        except Exception as e:
+            print(e)
+
+
+@dp.shutdown()
+async def on_shutdown():
+    """
+    Вывод счётчиков компонентов, остановка планировщика генерации, запись
+    накопленной статистики, остановка потоков БД и процессов построения
+    графиков при завершении работы бота.
+    """
+    print(format_runtime_stats())
+    await scheduler.shutdown()
+    await statistic_writer.close()
+    database.close()
+    chart_renderer.close()
+
+
+async def run_polling():
+    """
+    Получение обновлений опросом сервера Telegram. Обновления,
+    пришедшие пока бот был остановлен, пропускаются.
+    """
+    await bot.delete_webhook(drop_pending_updates=True)
+    startup_report.mark("polling")
+    print(startup_report.format())
+    await dp.start_polling(bot,
+                           allowed_updates=dp.resolve_used_update_types())
+
+
+async def run_webhook():
+    """
+    Получение обновлений через веб-хук до сигнала остановки процесса.
+    """
+    server = wh.WebhookServer(dp,
+                              bot,
+                              url=WEBHOOK_URL,
+                              secret_token=WEBHOOK_SECRET,
+                              path=WEBHOOK_PATH,
+                              host=WEBHOOK_HOST,
+                              port=WEBHOOK_PORT)
+    try:
+        await server.start()
+        startup_report.mark("webhook")
+        print(startup_report.format())
+        await server.wait()
+    finally:
+        await server.stop()
 
 
 async def main():
     """
     Запуск бота.
     """
-    await bot.get_updates(timeout=100)
-    await dp.start_polling(bot,
-                           skip_updates=True)
+    chart_renderer.start()
+    startup_report.mark("chart workers")
+    await database.refresh_route_graph(route_graph)
+    startup_report.mark("route graph")
+    stats_task = None
+    if STATS_LOG_INTERVAL:
+        stats_task = asyncio.create_task(
+            log_runtime_stats(STATS_LOG_INTERVAL))
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if stats_task is not None:
+            stats_task.cancel()
 
 
 if __name__ == tx.MAIN_MODULE_NAME:
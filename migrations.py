@@ -0,0 +1,191 @@
+from peewee import SqliteDatabase
+
+from quantile_sketch import QuantileSketch
+
+
+def add_lookup_indexes(database: SqliteDatabase):
+    """
+    Индексы для поиска маршрутов из точки на карте и для группировки
+    статистики по нейронным сетям.
+    """
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "route_point_map_id" '
+                         'ON "route" ("point_map_id")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS '
+                         '"route_another_point_map_id" '
+                         'ON "route" ("another_point_map_id")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS '
+                         '"statistic_neural_network_name" '
+                         'ON "statistic" ("neural_network_name")')
+
+
+def convert_statistic_times_to_real(database: SqliteDatabase):
+    """
+    Время генерации и загрузки хранится в секундах, поэтому столбцы,
+    созданные как DATETIME, пересоздаются как REAL.
+    """
+    database.execute_sql('CREATE TABLE "statistic_new" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"neural_network_name" VARCHAR(255) NOT NULL, '
+                         '"time_generated" REAL, '
+                         '"time_loaded" REAL)')
+    database.execute_sql('INSERT INTO "statistic_new" '
+                         'SELECT "id", "neural_network_name", '
+                         'CAST("time_generated" AS REAL), '
+                         'CAST("time_loaded" AS REAL) '
+                         'FROM "statistic"')
+    database.execute_sql('DROP TABLE "statistic"')
+    database.execute_sql('ALTER TABLE "statistic_new" '
+                         'RENAME TO "statistic"')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS '
+                         '"statistic_neural_network_name" '
+                         'ON "statistic" ("neural_network_name")')
+
+
+def add_map_version_triggers(database: SqliteDatabase):
+    """
+    Счётчик изменений таблиц карты. Триггеры увеличивают его при любом
+    изменении точек на карте и маршрутов, в отличие от PRAGMA
+    data_version, которая меняется и при записи статистики.
+    """
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "map_version" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"version" INTEGER NOT NULL)')
+    database.execute_sql('INSERT OR IGNORE INTO "map_version" '
+                         'VALUES (1, 0)')
+    for table in ("PointMaps", "route"):
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            database.execute_sql(
+                f'CREATE TRIGGER IF NOT EXISTS '
+                f'"{table}_{operation.lower()}_map_version" '
+                f'AFTER {operation} ON "{table}" BEGIN '
+                f'UPDATE "map_version" SET "version" = "version" + 1 '
+                f'WHERE "id" = 1; END')
+
+
+def add_statistic_rollups(database: SqliteDatabase):
+    """
+    Сводная статистика по нейронным сетям. Существующие записи не
+    содержат времени измерения, поэтому переносятся только в сводную
+    статистику за всё время (интервал 0).
+    """
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "statistic_rollup" ('
+                         '"id" INTEGER NOT NULL PRIMARY KEY, '
+                         '"neural_network_name" VARCHAR(255) NOT NULL, '
+                         '"metric" VARCHAR(255) NOT NULL, '
+                         '"bucket_start" INTEGER NOT NULL, '
+                         '"count" INTEGER NOT NULL, '
+                         '"total" REAL NOT NULL, '
+                         '"min_value" REAL NOT NULL, '
+                         '"max_value" REAL NOT NULL, '
+                         '"sketch" TEXT NOT NULL)')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS '
+                         '"statisticrollup_bucket_start_neural_network_'
+                         'name_metric" ON "statistic_rollup" '
+                         '("bucket_start", "neural_network_name", "metric")')
+
+    for metric in ("time_generated", "time_loaded"):
+        sketches = {}
+        rows = database.execute_sql(f'SELECT "neural_network_name", '
+                                    f'"{metric}" FROM "statistic" '
+                                    f'WHERE "{metric}" IS NOT NULL')
+        for neural_network_name, value in rows:
+            sketches.setdefault(neural_network_name,
+                                QuantileSketch()).add(value)
+
+        totals = database.execute_sql(f'SELECT "neural_network_name", '
+                                      f'COUNT("{metric}"), SUM("{metric}"), '
+                                      f'MIN("{metric}"), MAX("{metric}") '
+                                      f'FROM "statistic" '
+                                      f'WHERE "{metric}" IS NOT NULL '
+                                      f'GROUP BY "neural_network_name"')
+        for neural_network_name, count, total, min_value, max_value in (
+                totals.fetchall()):
+            database.execute_sql('INSERT OR REPLACE INTO "statistic_rollup" '
+                                 '("neural_network_name", "metric", '
+                                 '"bucket_start", "count", "total", '
+                                 '"min_value", "max_value", "sketch") '
+                                 'VALUES (?, ?, 0, ?, ?, ?, ?, ?)',
+                                 (neural_network_name,
+                                  metric,
+                                  count,
+                                  total,
+                                  min_value,
+                                  max_value,
+                                  sketches[neural_network_name].to_json()))
+
+
+def add_statistic_interruptions(database: SqliteDatabase):
+    """
+    Время до отмены генерации игроком и до остановки генерации по
+    превышению времени.
+    """
+    database.execute_sql('ALTER TABLE "statistic" '
+                         'ADD COLUMN "time_cancelled" REAL')
+    database.execute_sql('ALTER TABLE "statistic" '
+                         'ADD COLUMN "time_timed_out" REAL')
+
+
+def add_statistic_first_image(database: SqliteDatabase):
+    """
+    Время от запроса до отправки первого изображения локации.
+    """
+    database.execute_sql('ALTER TABLE "statistic" '
+                         'ADD COLUMN "time_first_image" REAL')
+
+
+# Миграции выполняются по порядку, номер последней выполненной миграции
+# хранится в PRAGMA user_version. Для новой БД, созданной по моделям,
+# выполняются только миграции, создающие объекты вне моделей.
+MIGRATIONS = [
+    (1, add_lookup_indexes, False),
+    (2, convert_statistic_times_to_real, False),
+    (3, add_map_version_triggers, True),
+    (4, add_statistic_rollups, False),
+    (5, add_statistic_interruptions, False),
+    (6, add_statistic_first_image, False),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(database: SqliteDatabase):
+    """
+    Версия схемы БД.
+
+    Parameters:
+        database(SqliteDatabase): БД.
+
+    Returns:
+        int: Номер последней выполненной миграции.
+    """
+    return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(database: SqliteDatabase,
+            is_new_database=False):
+    """
+    Обновление схемы БД до последней версии. Каждая миграция выполняется
+    в отдельной транзакции вместе с изменением версии.
+
+    Parameters:
+        database(SqliteDatabase): БД.
+        is_new_database(bool): БД создана по текущим моделям, поэтому
+        выполняются только миграции объектов вне моделей.
+
+    Returns:
+        list[int]: Номера выполненных миграций.
+    """
+    applied = []
+    version = get_version(database)
+    for migration_version, migration, for_new_database in MIGRATIONS:
+        if (migration_version <= version
+                or (is_new_database and not for_new_database)):
+            continue
+        with database.atomic():
+            migration(database)
+            database.execute_sql(
+                f"PRAGMA user_version = {migration_version}")
+        applied.append(migration_version)
+
+    if is_new_database:
+        database.execute_sql(f"PRAGMA user_version = {LATEST_VERSION}")
+    return applied
@@ -0,0 +1,188 @@
+import asyncio
+from collections import Counter, OrderedDict
+
+import scheduler as sch
+
+# Бюджет памяти ускорителя для одновременно загруженных моделей.
+MEMORY_BUDGET = 20 * 1024 ** 3
+# Оценка размера модели до её первой загрузки.
+DEFAULT_MODEL_SIZE = 8 * 1024 ** 3
+
+
+class ModelRegistry:
+    """
+    Реестр загруженных нейронных сетей. Хранит в памяти несколько моделей
+    в пределах бюджета памяти и вытесняет давно не использованные (LRU).
+    Одновременные запросы на загрузку одной модели объединяются в одно
+    задание планировщика. Модели, закреплённые обработчиками запросов
+    через pin, не вытесняются.
+
+    Attributes:
+        scheduler(GenerationScheduler): Планировщик, выполняющий загрузку.
+        memory_budget(int): Бюджет памяти в байтах.
+        hits(int): Количество обращений к уже загруженной модели.
+        loads(int): Количество загрузок моделей.
+        deduplicated(int): Количество запросов, присоединившихся к уже
+        идущей загрузке.
+        evictions(int): Количество вытесненных моделей.
+    """
+
+    def __init__(self,
+                 scheduler: sch.GenerationScheduler,
+                 memory_budget=MEMORY_BUDGET):
+        self.scheduler = scheduler
+        self.memory_budget = memory_budget
+        self.hits = 0
+        self.loads = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self.load_times = {}
+        self._resident = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._pins = Counter()
+        # Проверка идущей загрузки, вытеснение и постановка задания
+        # выполняются без переключения на другие загрузки.
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def used_memory(self):
+        return sum(self._sizes[name] for name in self._resident)
+
+    def get(self,
+            name: str):
+        """
+        Получение загруженной модели с отметкой о её использовании.
+
+        Parameters:
+            name(str): Название нейронной сети.
+
+        Returns:
+            ImageGenerator: Модель. Если модель не загружена,
+            возвращается None.
+        """
+        neural_network = self._resident.get(name)
+        if neural_network is not None:
+            self._resident.move_to_end(name)
+            self.hits += 1
+        return neural_network
+
+    def pin(self,
+            name: str):
+        """
+        Запрет вытеснения модели на время обработки запроса, в том числе
+        до её загрузки. Каждому вызову pin соответствует вызов unpin.
+
+        Parameters:
+            name(str): Название нейронной сети.
+        """
+        self._pins[name] += 1
+
+    def unpin(self,
+              name: str):
+        """
+        Снятие запрета вытеснения, установленного pin.
+
+        Parameters:
+            name(str): Название нейронной сети.
+        """
+        self._pins[name] -= 1
+        if self._pins[name] <= 0:
+            del self._pins[name]
+
+    async def load(self,
+                   name: str,
+                   loader):
+        """
+        Загрузка модели через планировщик. Если модель уже загружается,
+        возвращается существующее задание.
+
+        Parameters:
+            name(str): Название нейронной сети.
+            loader(object): Функция, создающая модель.
+
+        Returns:
+            tuple[GenerationJob, bool]: Задание загрузки и признак того,
+            что загрузка начата этим вызовом.
+        """
+        async with self._load_lock:
+            job = self._loading.get(name)
+            if job is not None:
+                self.deduplicated += 1
+                return job, False
+
+            await self._evict(self._sizes.get(name, DEFAULT_MODEL_SIZE))
+
+            job = await self.scheduler.submit(sch.LOADER_QUEUE,
+                                              loader)
+            self._loading[name] = job
+        job.future.add_done_callback(
+            lambda future: asyncio.ensure_future(self._on_loaded(name,
+                                                                 job)))
+        return job, True
+
+    async def _on_loaded(self,
+                         name: str,
+                         job: sch.GenerationJob):
+        if self._loading.get(name) is job:
+            del self._loading[name]
+        if job.future.cancelled() or job.future.exception() is not None:
+            return
+        neural_network = job.future.result()
+        if neural_network is None:
+            return
+
+        self.loads += 1
+        self.load_times[name] = job.service_time
+        try:
+            self._sizes[name] = neural_network.get_memory_size()
+        except Exception as e:
+            print(e)
+            self._sizes.setdefault(name, DEFAULT_MODEL_SIZE)
+        self._resident[name] = neural_network
+        await self._evict(0,
+                          keep=name)
+
+    async def _evict(self,
+                     required: int,
+                     keep=None):
+        """
+        Вытеснение давно не использованных моделей, пока не освободится
+        требуемый объём памяти. Закреплённые модели и модели с
+        незавершёнными заданиями генерации не вытесняются.
+
+        Parameters:
+            required(int): Требуемый объём памяти в байтах.
+            keep(str): Модель, которую нельзя вытеснять.
+        """
+        for name in list(self._resident):
+            if self.used_memory + required <= self.memory_budget:
+                return
+            neural_network = self._resident.get(name)
+            if (neural_network is None
+                    or name == keep
+                    or name in self._pins
+                    or self.scheduler.is_busy(neural_network.model_id)):
+                continue
+            del self._resident[name]
+            self.evictions += 1
+            await asyncio.to_thread(neural_network.release)
+
+    def stats(self):
+        """
+        Статистика реестра моделей.
+
+        Returns:
+            dict: Загруженные модели, занятая память, количество
+            загрузок, попаданий, объединённых загрузок и вытеснений.
+        """
+        return {"resident": list(self._resident),
+                "loading": list(self._loading),
+                "pinned": dict(self._pins),
+                "used_memory": self.used_memory,
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "loads": self.loads,
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "load_times": dict(self.load_times)}
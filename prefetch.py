@@ -0,0 +1,185 @@
+import asyncio
+
+import batching as ba
+import image_cache as ic
+import scheduler as sch
+
+PREFETCH_ENABLED = True
+
+
+class Prefetcher:
+    """
+    Фоновая генерация изображений соседних локаций, пока игрок
+    рассматривает текущую. Задания ставятся с низким приоритетом,
+    одинаковые изображения для разных чатов генерируются один раз, а
+    задания для локаций, в которые больше нельзя перейти, отменяются.
+
+    Attributes:
+        scheduler(GenerationScheduler): Планировщик генерации.
+        image_cache(ImageCache): Кэш изображений.
+        scheduled(int): Количество поставленных заданий.
+        deduplicated(int): Количество запросов, присоединившихся к уже
+        поставленному заданию.
+        skipped(int): Количество запросов, уже находящихся в кэше.
+        cancelled(int): Количество отменённых заданий.
+        completed(int): Количество изображений, сохранённых в кэш.
+    """
+
+    def __init__(self,
+                 scheduler: sch.GenerationScheduler,
+                 image_cache: ic.ImageCache):
+        self.scheduler = scheduler
+        self.image_cache = image_cache
+        self.scheduled = 0
+        self.deduplicated = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.completed = 0
+        self._jobs = {}
+        self._wanted = {}
+        self._chat_keys = {}
+
+    async def prefetch(self,
+                       chat_id: int,
+                       neural_network,
+                       requests: list[tuple[str, str]],
+                       batch_key=None):
+        """
+        Постановка в очередь генерации изображений соседних локаций
+        чата. Ранее запрошенные этим чатом изображения, которых нет
+        среди новых, отменяются, если они не нужны другим чатам.
+
+        Parameters:
+            chat_id(int): Id чата.
+            neural_network(ImageGenerator): Нейронная сеть.
+            requests(list[tuple[str, str]]): Ключи кэша и текстовые
+            описания изображений.
+            batch_key(object): Ключ объединения заданий в пакет.
+        """
+        keys = {cache_key for cache_key, _ in requests}
+        self.forget(chat_id,
+                    keep=keys)
+        self._chat_keys[chat_id] = keys
+
+        for cache_key, prompt in requests:
+            if cache_key in self._jobs:
+                if chat_id not in self._wanted[cache_key]:
+                    self._wanted[cache_key].add(chat_id)
+                    self.deduplicated += 1
+                continue
+            if self.image_cache.contains(cache_key):
+                self.skipped += 1
+                continue
+
+            job = await self.scheduler.submit(
+                neural_network.model_id,
+                ba.generate_batch,
+                neural_network,
+                prompt,
+                priority=sch.PRIORITY_BACKGROUND,
+                batch_key=batch_key,
+                timeout=neural_network.generation_timeout)
+            self._jobs[cache_key] = job
+            self._wanted[cache_key] = {chat_id}
+            self.scheduled += 1
+            job.future.add_done_callback(
+                lambda future, key=cache_key, prefetch_job=job:
+                asyncio.ensure_future(self._store(key,
+                                                  prefetch_job)))
+
+    def forget(self,
+               chat_id: int,
+               keep=frozenset()):
+        """
+        Отказ чата от запрошенных изображений с отменой заданий, которые
+        больше никому не нужны. Выполняющееся задание прерывается после
+        текущего шага генерации, чтобы не задерживать запросы игроков.
+
+        Parameters:
+            chat_id(int): Id чата.
+            keep(set[str]): Ключи кэша, от которых отказываться не нужно.
+        """
+        for cache_key in self._chat_keys.pop(chat_id, set()) - keep:
+            wanted = self._wanted.get(cache_key)
+            if wanted is None:
+                continue
+            wanted.discard(chat_id)
+            # Завершённое задание не отменяется: его изображение
+            # сохранит в кэш _store.
+            if not wanted and self._jobs[cache_key].cancel(interrupt=True):
+                self._discard(cache_key)
+                self.cancelled += 1
+
+    def take(self,
+             cache_key: str):
+        """
+        Передача фонового задания интерактивному запросу. Выполняющееся
+        задание возвращается для ожидания, ожидающее в очереди
+        отменяется, чтобы запрос поставил своё задание с высоким
+        приоритетом.
+
+        Parameters:
+            cache_key(str): Ключ кэша.
+
+        Returns:
+            GenerationJob: Выполняющееся задание. Если задания нет или
+            оно ещё не начато, возвращается None.
+        """
+        job = self._discard(cache_key)
+        if job is None:
+            return None
+        if job.cancel():
+            self.cancelled += 1
+            return None
+        return job
+
+    def _discard(self,
+                 cache_key: str):
+        """
+        Удаление задания из учёта фоновой генерации. Результат
+        удалённого задания не сохраняется в кэш.
+
+        Parameters:
+            cache_key(str): Ключ кэша.
+
+        Returns:
+            GenerationJob: Задание или None, если его нет.
+        """
+        self._wanted.pop(cache_key, None)
+        return self._jobs.pop(cache_key, None)
+
+    async def _store(self,
+                     cache_key: str,
+                     job: sch.GenerationJob):
+        # Исключение прерванного задания извлекается, даже если задание
+        # уже не учитывается, чтобы asyncio не сообщал о нём.
+        failed = (job.future.cancelled()
+                  or job.future.exception() is not None)
+        if self._jobs.get(cache_key) is not job:
+            return
+        self._discard(cache_key)
+        if failed:
+            return
+        image_data = job.future.result()
+        if image_data is None:
+            return
+
+        await asyncio.to_thread(self.image_cache.put,
+                                cache_key,
+                                image_data)
+        self.completed += 1
+
+    def stats(self):
+        """
+        Статистика фоновой генерации.
+
+        Returns:
+            dict: Количество поставленных, объединённых, пропущенных,
+            отменённых и выполненных заданий.
+        """
+        return {"in_flight": len(self._jobs),
+                "scheduled": self.scheduled,
+                "deduplicated": self.deduplicated,
+                "skipped": self.skipped,
+                "cancelled": self.cancelled,
+                "completed": self.completed}
@@ -0,0 +1,361 @@
+import importlib
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import remote_generator as rmg
+
+# Генераторы выполняются в дочерних процессах, а не в потоках бота.
+PROCESS_ISOLATION = False
+# Процессы запускаются новым интерпретатором. Копирование бота через
+# fork небезопасно: в момент копирования потоки бота могут удерживать
+# блокировки импорта и БД, а дочерний процесс унаследовал бы соединения
+# с Telegram и открытые файлы SQLite. Дочерний процесс импортирует
+# main.py как __mp_main__ без запуска бота.
+START_METHOD = "spawn"
+IMAGE_GENERATORS_MODULE = "image_generators"
+# Интервал проверки, жив ли дочерний процесс, при ожидании ответа.
+POLL_INTERVAL = 1
+STOP_TIMEOUT = 10
+# Время, за которое дочерний процесс должен прервать генерацию после
+# отмены. Иначе процесс завершается и перезапускается.
+CANCEL_TIMEOUT = 10
+# Префикс имён блоков общей памяти. Блоки дочернего процесса нумеруются
+# подряд, поэтому после завершения процесса бот находит и удаляет блоки,
+# которые он не успел прочитать.
+SHARED_MEMORY_PREFIX = "igg"
+
+MESSAGE_READY = "ready"
+MESSAGE_ERROR = "error"
+MESSAGE_PROGRESS = "progress"
+MESSAGE_RESULT = "result"
+COMMAND_GENERATE = "generate"
+COMMAND_STOP = "stop"
+COMMAND_CANCEL = "cancel"
+
+
+class WorkerDiedError(RuntimeError):
+    """
+    Дочерний процесс генератора завершился во время выполнения команды.
+    """
+
+
+def _get_block_name(pid: int,
+                    index: int):
+    """
+    Имя блока общей памяти дочернего процесса.
+
+    Parameters:
+        pid(int): Id дочернего процесса.
+        index(int): Номер блока в дочернем процессе.
+
+    Returns:
+        str: Имя блока.
+    """
+    return f"{SHARED_MEMORY_PREFIX}_{pid}_{index}"
+
+
+def _share(data: bytes,
+           name: str):
+    """
+    Копирование изображения в новый блок общей памяти. Блок удаляет
+    процесс бота после чтения, поэтому дочерний процесс снимает его с
+    учёта, чтобы не удалить блок при своём завершении.
+
+    Parameters:
+        data(bytes): Закодированное изображение.
+        name(str): Имя блока.
+
+    Returns:
+        tuple[str, int]: Имя блока и размер данных.
+    """
+    block = shared_memory.SharedMemory(name=name,
+                                       create=True,
+                                       size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    resource_tracker.unregister(block._name,
+                                "shared_memory")
+    block.close()
+    return block.name, len(data)
+
+
+def _take_shared(name: str,
+                 size: int):
+    """
+    Чтение изображения из блока общей памяти с удалением блока.
+
+    Parameters:
+        name(str): Имя блока.
+        size(int): Размер данных.
+
+    Returns:
+        bytes: Закодированное изображение.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _serve(class_name: str,
+           connection,
+           parent_connection):
+    """
+    Основная функция дочернего процесса: загрузка генератора и
+    выполнение команд бота.
+
+    Parameters:
+        class_name(str): Имя класса генератора в image_generators.
+        connection(Connection): Канал связи с ботом.
+        parent_connection(Connection): Конец канала на стороне бота.
+        Закрывается, чтобы дочерний процесс завершился при завершении
+        бота.
+    """
+    parent_connection.close()
+    try:
+        image_generators = importlib.import_module(IMAGE_GENERATORS_MODULE)
+        generator = getattr(image_generators, class_name)()
+        params = rmg.describe_generator(generator)
+        params["memory_size"] = generator.get_memory_size()
+    except Exception as e:
+        connection.send((MESSAGE_ERROR,
+                         str(e)))
+        return
+    connection.send((MESSAGE_READY,
+                     params))
+
+    def progress(step, total):
+        connection.send((MESSAGE_PROGRESS,
+                         step,
+                         total))
+
+    cancelled = threading.Event()
+    block_indexes = itertools.count()
+
+    def should_stop():
+        # Во время генерации бот присылает только команду отмены.
+        while not cancelled.is_set() and connection.poll():
+            if connection.recv()[0] == COMMAND_CANCEL:
+                cancelled.set()
+        return cancelled.is_set()
+
+    while True:
+        try:
+            command, *args = connection.recv()
+        except EOFError:
+            return
+        if command == COMMAND_STOP:
+            return
+        if command == COMMAND_CANCEL:
+            # Отмена пришла после завершения генерации.
+            continue
+        cancelled.clear()
+        images = generator.generate_images(args[0],
+                                           progress,
+                                           should_stop,
+                                           args[1])
+        connection.send((MESSAGE_RESULT,
+                         None if images is None
+                         else [_share(image,
+                                      _get_block_name(os.getpid(),
+                                                      next(block_indexes)))
+                               for image in images]))
+
+
+class ProcessImageGenerator(rmg.GeneratorProxy):
+    """
+    Генератор изображений в дочернем процессе. Вызовы модели и
+    кодирование изображений не занимают GIL процесса бота, а падение
+    или нехватка памяти при генерации завершают только дочерний процесс.
+    Закодированные изображения передаются через общую память, по каналу
+    связи передаются только имена блоков.
+
+    Завершившийся дочерний процесс перезапускается с повторной загрузкой
+    модели: сразу после обнаружения во время генерации или перед
+    следующей генерацией. Так же перезапускается процесс, который не
+    прервал генерацию за CANCEL_TIMEOUT секунд после отмены.
+
+    Attributes:
+        restarts(int): Количество перезапусков дочернего процесса.
+    """
+
+    def __init__(self,
+                 class_name: str):
+        super().__init__(class_name)
+        self.restarts = 0
+        self._context = multiprocessing.get_context(START_METHOD)
+        self._lock = threading.Lock()
+        self._process = None
+        self._connection = None
+        self._memory_size = 0
+        self._blocks_received = 0
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_serve,
+                                        args=(self.class_name,
+                                              child_connection,
+                                              connection),
+                                        name=f"generator-{self.class_name}",
+                                        daemon=True)
+        process.start()
+        child_connection.close()
+        self._process = process
+        self._connection = connection
+        self._blocks_received = 0
+
+        message = self._receive()
+        if message[0] != MESSAGE_READY:
+            self._stop()
+            raise RuntimeError(message[1])
+        params = message[1]
+        self._memory_size = params["memory_size"]
+        self.set_params(params)
+
+    def _receive(self,
+                 on_idle=None):
+        """
+        Ожидание сообщения дочернего процесса с проверкой, что процесс
+        жив.
+
+        Parameters:
+            on_idle(object): Функция, вызываемая каждые POLL_INTERVAL
+            секунд ожидания.
+
+        Returns:
+            tuple: Сообщение.
+        """
+        while not self._connection.poll(POLL_INTERVAL):
+            if not self._process.is_alive():
+                raise WorkerDiedError(
+                    f"generator process exited with code "
+                    f"{self._process.exitcode}")
+            if on_idle is not None:
+                on_idle()
+        try:
+            return self._connection.recv()
+        except EOFError:
+            self._process.join()
+            raise WorkerDiedError(
+                f"generator process exited with code "
+                f"{self._process.exitcode}")
+
+    def _stop(self):
+        if self._process is None:
+            return
+        try:
+            self._connection.send((COMMAND_STOP,))
+        except (OSError, ValueError):
+            pass
+        self._process.join(STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._connection.close()
+        self._unlink_unread(self._process.pid)
+        self._process = None
+        self._connection = None
+
+    def _unlink_unread(self,
+                       pid: int):
+        """
+        Удаление блоков общей памяти завершённого дочернего процесса,
+        которые бот не прочитал, например если процесс был завершён после
+        отмены, когда изображение уже было записано.
+
+        Parameters:
+            pid(int): Id дочернего процесса.
+        """
+        for index in itertools.count(self._blocks_received):
+            try:
+                block = shared_memory.SharedMemory(
+                    name=_get_block_name(pid,
+                                         index))
+            except FileNotFoundError:
+                return
+            block.close()
+            block.unlink()
+
+    def _restart(self):
+        self._stop()
+        self.restarts += 1
+        self._start()
+
+    def get_memory_size(self):
+        return self._memory_size
+
+    def release(self):
+        """
+        Остановка дочернего процесса вместе с моделью.
+        """
+        with self._lock:
+            self._stop()
+
+    def generate_images(self,
+                        prompts: list[str],
+                        progress=None,
+                        should_stop=None,
+                        preview=False):
+        with self._lock:
+            try:
+                if self._process is None or not self._process.is_alive():
+                    self._restart()
+                return self._generate(prompts,
+                                      progress,
+                                      should_stop,
+                                      preview)
+            except WorkerDiedError as e:
+                print(e)
+                try:
+                    self._restart()
+                except Exception as restart_error:
+                    print(restart_error)
+                return None
+            except Exception as e:
+                print(e)
+                return None
+
+    def _generate(self,
+                  prompts: list[str],
+                  progress,
+                  should_stop,
+                  preview):
+        self._connection.send((COMMAND_GENERATE,
+                               prompts,
+                               preview))
+        cancelled_at = None
+
+        def check_cancel():
+            nonlocal cancelled_at
+            if cancelled_at is None:
+                if should_stop is not None and should_stop():
+                    self._connection.send((COMMAND_CANCEL,))
+                    cancelled_at = time.monotonic()
+            elif time.monotonic() - cancelled_at > CANCEL_TIMEOUT:
+                self._process.kill()
+                raise WorkerDiedError(
+                    "generator process did not stop after cancel")
+
+        while True:
+            check_cancel()
+            message = self._receive(check_cancel)
+            if message[0] == MESSAGE_PROGRESS:
+                if progress is not None:
+                    progress(message[1],
+                             message[2])
+            elif message[0] == MESSAGE_RESULT:
+                if message[1] is None:
+                    return None
+                images = []
+                for name, size in message[1]:
+                    self._blocks_received += 1
+                    images.append(_take_shared(name,
+                                               size))
+                return images
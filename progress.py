@@ -0,0 +1,182 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Telegram ограничивает частоту сообщений в один чат, поэтому
+# изменения сообщений одного чата отправляются не чаще этого интервала.
+MIN_EDIT_INTERVAL = 2.0
+# Количество запоминаемых сообщений, от изменений которых отказались.
+# Шаги генерации приходят из потоков планировщика с задержкой и могут
+# прийти уже после удаления сообщения.
+MAX_DISCARDED = 10_000
+
+
+class _ChatProgress:
+    """
+    Состояние обновления сообщений одного чата.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.sent = {}
+        self.markups = {}
+        self.last_edit_at = 0.0
+        self.task = None
+
+
+class ProgressUpdater:
+    """
+    Обновление сообщений о ходе генерации с объединением промежуточных
+    состояний и ограничением частоты изменений для каждого чата.
+
+    Вызовы update только запоминают последний текст сообщения, изменение
+    отправляется не чаще одного раза за min_interval секунд на чат, и
+    только если текст изменился.
+
+    Attributes:
+        bot(Bot): Бот.
+        min_interval(float): Минимальный интервал между изменениями
+        сообщений одного чата.
+        updates(int): Количество полученных обновлений.
+        edits(int): Количество отправленных изменений.
+    """
+
+    def __init__(self,
+                 bot: Bot,
+                 min_interval=MIN_EDIT_INTERVAL):
+        self.bot = bot
+        self.min_interval = min_interval
+        self.updates = 0
+        self.edits = 0
+        self._chats = {}
+        self._discarded = OrderedDict()
+
+    def update(self,
+               chat_id: int,
+               message_id: int,
+               text: str):
+        """
+        Запоминание нового текста сообщения. Должно вызываться из
+        цикла событий.
+
+        Parameters:
+            chat_id(int): Id чата.
+            message_id(int): Id сообщения.
+            text(str): Новый текст сообщения.
+        """
+        self.updates += 1
+        if (chat_id, message_id) in self._discarded:
+            return
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatProgress()
+            self._chats[chat_id] = chat
+        if chat.sent.get(message_id) == text:
+            chat.pending.pop(message_id, None)
+            return
+        chat.pending[message_id] = text
+        if chat.task is None or chat.task.done():
+            chat.task = asyncio.create_task(self._flush(chat_id,
+                                                        chat))
+
+    def set_reply_markup(self,
+                         chat_id: int,
+                         message_id: int,
+                         reply_markup):
+        """
+        Клавиатура, сохраняемая при изменениях сообщения: без неё
+        изменение текста удаляет клавиатуру сообщения.
+
+        Parameters:
+            chat_id(int): Id чата.
+            message_id(int): Id сообщения.
+            reply_markup(InlineKeyboardMarkup): Клавиатура сообщения.
+        """
+        if (chat_id, message_id) in self._discarded:
+            return
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatProgress()
+            self._chats[chat_id] = chat
+        chat.markups[message_id] = reply_markup
+
+    def make_step_callback(self,
+                           chat_id: int,
+                           message_id: int,
+                           template: str):
+        """
+        Создание функции для отслеживания шагов генерации из потока
+        планировщика.
+
+        Parameters:
+            chat_id(int): Id чата.
+            message_id(int): Id сообщения.
+            template(str): Шаблон текста с местами для шага и количества
+            шагов.
+
+        Returns:
+            object: Функция progress(step, total).
+        """
+        loop = asyncio.get_running_loop()
+
+        def progress(step, total):
+            loop.call_soon_threadsafe(self.update,
+                                      chat_id,
+                                      message_id,
+                                      template.format(step, total))
+
+        return progress
+
+    def discard(self,
+                chat_id: int,
+                message_id: int):
+        """
+        Отказ от дальнейших изменений сообщения, например перед его
+        удалением. Обновления, пришедшие после отказа, не учитываются.
+
+        Parameters:
+            chat_id(int): Id чата.
+            message_id(int): Id сообщения.
+        """
+        self._discarded[(chat_id, message_id)] = None
+        if len(self._discarded) > MAX_DISCARDED:
+            self._discarded.popitem(last=False)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        chat.pending.pop(message_id, None)
+        chat.sent.pop(message_id, None)
+        chat.markups.pop(message_id, None)
+        if not chat.pending and not chat.sent and not chat.markups:
+            if chat.task is not None and not chat.task.done():
+                chat.task.cancel()
+            del self._chats[chat_id]
+
+    async def _flush(self,
+                     chat_id: int,
+                     chat: _ChatProgress):
+        while chat.pending:
+            delay = chat.last_edit_at + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            message_id, text = next(iter(chat.pending.items()))
+            del chat.pending[message_id]
+            chat.last_edit_at = time.monotonic()
+            try:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    reply_markup=chat.markups.get(message_id))
+                chat.sent[message_id] = text
+                self.edits += 1
+            except TelegramRetryAfter as e:
+                chat.pending.setdefault(message_id, text)
+                chat.last_edit_at = time.monotonic() + e.retry_after
+            except TelegramBadRequest as e:
+                print(e)
@@ -0,0 +1,116 @@
+import json
+import math
+
+# Относительная погрешность оценки перцентилей.
+RELATIVE_ACCURACY = 0.01
+# Значения меньше этого считаются нулевыми.
+MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """
+    Скетч для оценки перцентилей с ограниченной относительной
+    погрешностью (DDSketch). Значения раскладываются по корзинам с
+    логарифмическими границами, поэтому два скетча с одинаковой
+    погрешностью объединяются сложением счётчиков корзин.
+
+    Attributes:
+        relative_accuracy(float): Относительная погрешность оценки.
+        count(int): Количество добавленных значений.
+    """
+
+    def __init__(self,
+                 relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._bins = {}
+        self._zero_count = 0
+        self.count = 0
+
+    def add(self,
+            value: float,
+            count=1):
+        """
+        Добавление значения.
+
+        Parameters:
+            value(float): Неотрицательное значение.
+            count(int): Сколько раз добавить значение.
+        """
+        if value <= MIN_VALUE:
+            self._zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._bins[index] = self._bins.get(index, 0) + count
+        self.count += count
+
+    def merge(self,
+              other: "QuantileSketch"):
+        """
+        Добавление всех значений другого скетча.
+
+        Parameters:
+            other(QuantileSketch): Скетч с той же погрешностью.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("sketches have different relative accuracy")
+        for index, count in other._bins.items():
+            self._bins[index] = self._bins.get(index, 0) + count
+        self._zero_count += other._zero_count
+        self.count += other.count
+
+    def quantile(self,
+                 q: float):
+        """
+        Оценка перцентиля.
+
+        Parameters:
+            q(float): Уровень от 0 до 1, например 0.95.
+
+        Returns:
+            float: Оценка значения. Если скетч пуст, возвращается None.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self._zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._bins):
+            seen += self._bins[index]
+            if seen > rank:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return 2 * self._gamma ** max(self._bins) / (self._gamma + 1)
+
+    def to_json(self):
+        """
+        Сериализация скетча для хранения в БД.
+
+        Returns:
+            str: Скетч в формате JSON.
+        """
+        return json.dumps({"accuracy": self.relative_accuracy,
+                           "zero": self._zero_count,
+                           "bins": self._bins},
+                          separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls,
+                  data: str):
+        """
+        Восстановление скетча из JSON.
+
+        Parameters:
+            data(str): Скетч в формате JSON.
+
+        Returns:
+            QuantileSketch: Скетч.
+        """
+        raw = json.loads(data)
+        sketch = cls(raw["accuracy"])
+        sketch._zero_count = raw["zero"]
+        sketch._bins = {int(index): count
+                        for index, count in raw["bins"].items()}
+        sketch.count = sketch._zero_count + sum(sketch._bins.values())
+        return sketch
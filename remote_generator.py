@@ -0,0 +1,259 @@
+import threading
+from abc import ABC, abstractmethod
+
+import job_queue as jq
+
+# Время ожидания загрузки модели на узле в секундах. Первая загрузка
+# на узле включает скачивание модели, поэтому ограничение взято с большим
+# запасом относительно среднего времени загрузки: Stable Diffusion -
+# около 460 с, Kandinsky - около 240 с. Время ожидания генерации
+# ограничено generation_timeout генератора.
+LOAD_TIMEOUT = 3600
+
+
+def describe_generator(generator):
+    """
+    Параметры генератора, от которых зависит изображение. По ним бот
+    строит ключи кэша и объединяет задания в пакеты.
+
+    Parameters:
+        generator(ImageGenerator): Генератор изображений.
+
+    Returns:
+        dict: Параметры генератора.
+    """
+    return {"model_id": generator.model_id,
+            "image_format": generator.image_format,
+            "image_quality": generator.image_quality,
+            "extension": generator.get_image_extension(),
+            "negative_prompt": generator.negative_prompt,
+            "num_inference_steps": generator.num_inference_steps,
+            "height": generator.height,
+            "width": generator.width,
+            "seed": generator.seed,
+            "generation_timeout": generator.generation_timeout,
+            "preview_num_inference_steps": (
+                generator.preview_num_inference_steps),
+            "preview_height": generator.preview_height,
+            "preview_width": generator.preview_width}
+
+
+class GeneratorProxy(ABC):
+    """
+    Генератор изображений, модель которого загружена вне потоков бота.
+    Повторяет интерфейс ImageGenerator, поэтому планировщик, пакетная
+    генерация и предварительная генерация работают с ним без изменений.
+    Параметры генерации сообщает сторона, загрузившая модель, поэтому
+    бот не импортирует torch и diffusers.
+
+    Attributes:
+        class_name(str): Имя класса генератора в image_generators.
+        model_id: Имя модели.
+        image_format: Формат изображения при кодировании.
+        image_quality: Качество изображения при кодировании.
+        negative_prompt: Негативное описание изображения.
+        num_inference_steps: Количество шагов генерации.
+        height: Высота изображения.
+        width: Ширина изображения.
+        seed: Зерно генератора случайных чисел.
+        generation_timeout: Максимальное время генерации в секундах.
+        preview_num_inference_steps: Количество шагов предварительного
+        изображения, None - без предварительного изображения.
+        preview_height: Высота предварительного изображения.
+        preview_width: Ширина предварительного изображения.
+    """
+
+    def __init__(self,
+                 class_name: str):
+        self.class_name = class_name
+
+    def set_params(self,
+                   params: dict):
+        """
+        Установка параметров генератора.
+
+        Parameters:
+            params(dict): Параметры, полученные describe_generator.
+        """
+        self.model_id = params["model_id"]
+        self.image_format = params["image_format"]
+        self.image_quality = params["image_quality"]
+        self.negative_prompt = params["negative_prompt"]
+        self.num_inference_steps = params["num_inference_steps"]
+        self.height = params["height"]
+        self.width = params["width"]
+        self.seed = params["seed"]
+        self.generation_timeout = params["generation_timeout"]
+        self.preview_num_inference_steps = (
+            params["preview_num_inference_steps"])
+        self.preview_height = params["preview_height"]
+        self.preview_width = params["preview_width"]
+        self._extension = params["extension"]
+
+    def get_memory_size(self):
+        """
+        Модель занимает память вне бота.
+
+        Returns:
+            int: 0.
+        """
+        return 0
+
+    def release(self):
+        """
+        Освобождение модели.
+        """
+
+    def get_image_extension(self):
+        """
+        Расширение файла изображения в формате генератора.
+
+        Returns:
+            str: Расширение файла с точкой.
+        """
+        return self._extension
+
+    def generate_image(self,
+                       prompt: str,
+                       progress=None,
+                       should_stop=None,
+                       preview=False):
+        """
+        Генерация изображения по текстовому описанию.
+
+        Parameters:
+            prompt(srt): Текстовое описание изображения.
+            progress(object): Функция progress(step, total).
+            should_stop(object): Функция should_stop().
+            preview(bool): Генерация предварительного изображения.
+
+        Returns:
+            bytes: Закодированное изображение.
+        """
+        images = self.generate_images([prompt],
+                                      progress,
+                                      should_stop,
+                                      preview)
+        if images is None:
+            return None
+        return images[0]
+
+    @abstractmethod
+    def generate_images(self,
+                        prompts: list[str],
+                        progress=None,
+                        should_stop=None,
+                        preview=False):
+        """
+        Генерация нескольких изображений одним вызовом модели.
+
+        Parameters:
+            prompts(list[str]): Текстовые описания изображений.
+            progress(object): Функция progress(step, total).
+            should_stop(object): Функция should_stop(), по которой
+            генерация прерывается.
+            preview(bool): Генерация предварительного изображения.
+
+        Returns:
+            list[bytes]: Закодированные изображения в порядке описаний.
+        """
+
+
+class RemoteImageGenerator(GeneratorProxy):
+    """
+    Генератор изображений, выполняющий загрузку модели и генерацию на
+    узлах генерации через очередь заданий.
+
+    Attributes:
+        job_queue(JobQueue): Очередь заданий.
+        load_timeout(float): Время ожидания загрузки модели.
+        load_timing(dict): Время загрузки модели на узле.
+    """
+
+    def __init__(self,
+                 job_queue: jq.JobQueue,
+                 class_name: str,
+                 load_timeout=LOAD_TIMEOUT):
+        super().__init__(class_name)
+        self.job_queue = job_queue
+        self.load_timeout = load_timeout
+        self._lock = threading.Lock()
+        self._timings = {}
+
+        job_result = self._run(jq.JOB_LOAD,
+                               {},
+                               self.load_timeout)
+        if job_result.status != jq.STATUS_DONE:
+            raise RuntimeError(job_result.error)
+        self.load_timing = job_result.timing
+        self.set_params(job_result.result)
+
+    def _run(self,
+             kind: str,
+             payload: dict,
+             timeout: float,
+             progress=None,
+             should_stop=None):
+        job_id = self.job_queue.submit(kind,
+                                       self.class_name,
+                                       payload)
+        job_result = self.job_queue.wait(job_id,
+                                         timeout,
+                                         progress,
+                                         should_stop)
+        self._record(job_result.timing)
+        return job_result
+
+    def _record(self,
+                timing: dict):
+        with self._lock:
+            worker = self._timings.setdefault(timing.get("worker_id"),
+                                              {"jobs": 0,
+                                               "queue_time": 0.0,
+                                               "load_time": 0.0,
+                                               "generation_time": 0.0})
+            worker["jobs"] += 1
+            for key in ("queue_time", "load_time", "generation_time"):
+                worker[key] += timing.get(key, 0.0)
+
+    def generate_images(self,
+                        prompts: list[str],
+                        progress=None,
+                        should_stop=None,
+                        preview=False):
+        # Прерванное задание удаляется из очереди, узел генерации
+        # обнаруживает это при сохранении хода выполнения.
+        try:
+            job_result = self._run(jq.JOB_GENERATE,
+                                   {"prompts": prompts,
+                                    "preview": preview},
+                                   self.generation_timeout,
+                                   progress,
+                                   should_stop)
+        except Exception as e:
+            print(e)
+            return None
+        if job_result.status != jq.STATUS_DONE:
+            print(job_result.error)
+            return None
+        return job_result.images
+
+    def stats(self):
+        """
+        Время выполнения заданий по узлам генерации.
+
+        Returns:
+            dict[str, dict]: Для каждого узла количество заданий и
+            среднее время ожидания в очереди, загрузки модели и
+            генерации.
+        """
+        with self._lock:
+            return {worker_id: {"jobs": worker["jobs"],
+                                "avg_queue_time": (worker["queue_time"]
+                                                   / worker["jobs"]),
+                                "avg_load_time": (worker["load_time"]
+                                                  / worker["jobs"]),
+                                "avg_generation_time": (
+                                    worker["generation_time"]
+                                    / worker["jobs"])}
+                    for worker_id, worker in self._timings.items()}
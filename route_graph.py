@@ -0,0 +1,213 @@
+import time
+
+import db
+
+# Как часто проверять, не изменили ли таблицы карты другие подключения.
+REFRESH_INTERVAL = 5.0
+
+
+class PointRecord:
+    """
+    Точка на карте в индексе маршрутов.
+
+    Attributes:
+        id(int): Id точки на карте.
+        name(str): Название локации.
+        description(str): Описание локации.
+        ai_description(str): Описание локации для генерации изображений.
+    """
+    __slots__ = ("id", "name", "description", "ai_description")
+
+    def __init__(self,
+                 id: int,
+                 name: str,
+                 description: str,
+                 ai_description: str):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.ai_description = ai_description
+
+
+class RouteGraph:
+    """
+    Граф точек на карте и маршрутов между ними, загруженный в память
+    списками смежности. Поиск соседей выполняется за O(степени точки)
+    без запросов к БД.
+
+    Изменения, сделанные через методы графа, применяются к индексу
+    сразу. Изменения таблиц другими подключениями обнаруживаются по
+    счётчику изменений карты в БД, после чего индекс перестраивается.
+
+    Attributes:
+        version(int): Версия индекса, увеличивается при каждом изменении.
+    """
+
+    def __init__(self,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self._points = {}
+        self._adjacency = {}
+        self._map_version = None
+        self._checked_at = 0.0
+
+    def build(self):
+        """
+        Загрузка всех точек на карте и маршрутов из БД.
+        """
+        self._map_version = db.get_map_version()
+        self._checked_at = time.monotonic()
+
+        points = {}
+        for point_map in db.PointMap.select().tuples():
+            points[point_map[0]] = PointRecord(*point_map)
+
+        adjacency = {point_map_id: [] for point_map_id in points}
+        routes = (db.Route.select(db.Route.point_map_id,
+                                  db.Route.another_point_map_id)
+                  .order_by(db.Route.id)
+                  .tuples())
+        for point_map_id, another_point_map_id in routes:
+            self._link(adjacency,
+                       point_map_id,
+                       another_point_map_id)
+
+        self._points = points
+        self._adjacency = {point_map_id: tuple(neighbours)
+                           for point_map_id, neighbours in adjacency.items()}
+        self.version += 1
+
+    @staticmethod
+    def _link(adjacency: dict,
+              point_map_id: int,
+              another_point_map_id: int):
+        if point_map_id == another_point_map_id:
+            return
+        for source, target in ((point_map_id, another_point_map_id),
+                               (another_point_map_id, point_map_id)):
+            neighbours = adjacency.setdefault(source, [])
+            if target not in neighbours:
+                neighbours.append(target)
+
+    def refresh_if_changed(self):
+        """
+        Перестроение индекса, если таблицы карты изменены другим
+        подключением. Проверка выполняется не чаще refresh_interval
+        секунд.
+        """
+        now = time.monotonic()
+        if self._map_version is None:
+            self.build()
+        elif now - self._checked_at >= self.refresh_interval:
+            self._checked_at = now
+            if db.get_map_version() != self._map_version:
+                self.build()
+
+    def get_point(self,
+                  point_map_id: int):
+        """
+        Возвращает точку на карте по её id.
+
+        Parameters:
+            point_map_id(int): Id точки на карте.
+
+        Returns:
+            PointRecord: Точка на карте. Если точка не найдена,
+            возвращается None.
+        """
+        self.refresh_if_changed()
+        return self._points.get(point_map_id)
+
+    def get_neighbours(self,
+                       point_map_id: int):
+        """
+        Возвращает точки на карте, в которые можно перейти из указанной.
+
+        Parameters:
+            point_map_id(int): Id точки на карте.
+
+        Returns:
+            list[PointRecord]: Доступные точки на карте.
+        """
+        self.refresh_if_changed()
+        return [self._points[neighbour]
+                for neighbour in self._adjacency.get(point_map_id, ())
+                if neighbour in self._points]
+
+    def add_point_map(self,
+                      name: str,
+                      description: str,
+                      ai_description: str):
+        """
+        Добавление точки на карте в БД и в индекс.
+
+        Parameters:
+            name(str): Название локации.
+            description(str): Описание локации.
+            ai_description(str): Описание локации для генерации
+            изображений.
+
+        Returns:
+            PointRecord: Добавленная точка на карте.
+        """
+        point_map = db.PointMap.create(name=name,
+                                       description=description,
+                                       ai_description=ai_description)
+        record = PointRecord(point_map.id,
+                             name,
+                             description,
+                             ai_description)
+        self._points[record.id] = record
+        self._adjacency.setdefault(record.id, ())
+        self._patched()
+        return record
+
+    def add_route(self,
+                  point_map_id: int,
+                  another_point_map_id: int):
+        """
+        Добавление маршрута в БД и в индекс.
+
+        Parameters:
+            point_map_id(int): Id точки на карте.
+            another_point_map_id(int): Id связанной точки на карте.
+        """
+        db.Route.create(point_map_id=point_map_id,
+                        another_point_map_id=another_point_map_id)
+        adjacency = {point: list(self._adjacency.get(point, ()))
+                     for point in (point_map_id, another_point_map_id)}
+        self._link(adjacency,
+                   point_map_id,
+                   another_point_map_id)
+        for point, neighbours in adjacency.items():
+            self._adjacency[point] = tuple(neighbours)
+        self._patched()
+
+    def remove_route(self,
+                     point_map_id: int,
+                     another_point_map_id: int):
+        """
+        Удаление маршрута между точками на карте из БД и из индекса.
+
+        Parameters:
+            point_map_id(int): Id точки на карте.
+            another_point_map_id(int): Id связанной точки на карте.
+        """
+        (db.Route.delete()
+         .where(((db.Route.point_map_id == point_map_id)
+                 & (db.Route.another_point_map_id == another_point_map_id))
+                | ((db.Route.point_map_id == another_point_map_id)
+                   & (db.Route.another_point_map_id == point_map_id)))
+         .execute())
+        for source, target in ((point_map_id, another_point_map_id),
+                               (another_point_map_id, point_map_id)):
+            self._adjacency[source] = tuple(
+                neighbour for neighbour in self._adjacency.get(source, ())
+                if neighbour != target)
+        self._patched()
+
+    def _patched(self):
+        self.version += 1
+        if self._map_version is not None:
+            self._map_version = db.get_map_version()
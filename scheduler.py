@@ -0,0 +1,450 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+WORKERS_PER_MODEL = 1
+LOADER_QUEUE = "loader"
+
+
+class JobCancelled(Exception):
+    """
+    Задание отменено во время ожидания или выполнения.
+
+    Attributes:
+        reason(str): Причина отмены.
+    """
+
+    def __init__(self,
+                 reason=None):
+        super().__init__(reason or "job cancelled")
+        self.reason = reason
+
+
+class GenerationJob:
+    """
+    Задание планировщика, результат которого можно ожидать через await.
+
+    Attributes:
+        queue_name(str): Имя очереди (модели), в которой выполняется
+        задание.
+        function(object): Функция, выполняемая в потоке.
+        args(tuple): Аргументы функции.
+        kwargs(dict): Именованные аргументы функции.
+        priority(int): Приоритет, меньшее значение выполняется раньше.
+        batch_key(object): Параметры, при совпадении которых задания
+        можно выполнить одним пакетом. Функция такого задания
+        принимает списки аргументов и именованных аргументов всех
+        заданий пакета и функцию should_stop() и возвращает список
+        результатов.
+        timeout(float): Максимальное время выполнения в секундах. None -
+        без ограничения.
+        future(asyncio.Future): Результат выполнения функции.
+        stop_event(threading.Event): Признак остановки выполняющегося
+        задания, проверяется функцией пакета между шагами генерации.
+        timed_out(bool): Задание остановлено по истечении timeout.
+        submitted_at(float): Время постановки в очередь.
+        started_at(float): Время начала выполнения.
+        finished_at(float): Время окончания выполнения.
+    """
+
+    def __init__(self,
+                 queue_name: str,
+                 function,
+                 args: tuple,
+                 kwargs: dict,
+                 priority: int,
+                 sequence: int,
+                 future: asyncio.Future,
+                 batch_key=None,
+                 timeout=None):
+        self.queue_name = queue_name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.sequence = sequence
+        self.batch_key = batch_key
+        self.timeout = timeout
+        self.future = future
+        self.stop_event = threading.Event()
+        self.timed_out = False
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    def __lt__(self, other):
+        return ((self.priority, self.sequence)
+                < (other.priority, other.sequence))
+
+    def __await__(self):
+        return self.future.__await__()
+
+    @property
+    def started(self):
+        return self.started_at is not None
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self,
+               interrupt=False,
+               reason=None):
+        """
+        Отмена задания. Без interrupt отменяется только задание, которое
+        ещё не начало выполняться. С interrupt ожидание завершается
+        исключением JobCancelled сразу, а выполняющееся задание
+        останавливается после текущего шага генерации.
+
+        Parameters:
+            interrupt(bool): Прервать выполняющееся задание.
+            reason(str): Причина отмены для JobCancelled.
+
+        Returns:
+            bool: Удалось ли отменить задание.
+        """
+        if not interrupt:
+            if self.started:
+                return False
+            return self.future.cancel()
+        if self.future.done():
+            return False
+        self.stop_event.set()
+        self.future.set_exception(JobCancelled(reason))
+        return True
+
+    def expire(self):
+        """
+        Остановка задания, превысившего время выполнения. Ожидание
+        завершается исключением TimeoutError сразу, а поток продолжает
+        выполнять функцию задания, пока она не проверит stop_event:
+        генерация прерывается между шагами, а загрузка модели,
+        декодирование изображения и другие действия без проверки
+        stop_event не прерываются. Место в очереди модели освобождается
+        только после возврата из функции.
+        """
+        if self.future.done():
+            return
+        self.timed_out = True
+        self.stop_event.set()
+        self.future.set_exception(
+            TimeoutError(f"job exceeded {self.timeout} s"))
+
+    @property
+    def wait_time(self):
+        """
+        Время ожидания в очереди в секундах.
+        """
+        end = self.started_at if self.started else time.monotonic()
+        return end - self.submitted_at
+
+    @property
+    def service_time(self):
+        """
+        Время выполнения в секундах. Если задание не начато, то 0.
+        """
+        if not self.started:
+            return 0.0
+        end = self.finished_at or time.monotonic()
+        return end - self.started_at
+
+
+class _JobQueue:
+    """
+    Очередь с приоритетами и ограниченным пулом потоков для одной модели.
+    """
+
+    def __init__(self,
+                 name: str,
+                 workers: int,
+                 batcher=None):
+        self.name = name
+        self.workers = workers
+        self.batcher = batcher
+        self.pending = []
+        self.running = set()
+        self.completed = 0
+        self.interrupted = 0
+        self.timed_out = 0
+        self.total_wait_time = 0.0
+        self.total_service_time = 0.0
+        self.batch_sizes = Counter()
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix=name)
+        self.condition = asyncio.Condition()
+        self.tasks = [asyncio.create_task(self._work())
+                      for _ in range(workers)]
+
+    async def push(self,
+                   job: GenerationJob):
+        async with self.condition:
+            heapq.heappush(self.pending,
+                           job)
+            self.condition.notify()
+
+    async def _pop(self):
+        async with self.condition:
+            while True:
+                while self.pending:
+                    job = heapq.heappop(self.pending)
+                    if not job.future.done():
+                        return job
+                await self.condition.wait()
+
+    async def _take_batch(self,
+                          job: GenerationJob):
+        """
+        Сбор пакета заданий, совместимых с заданием.
+        """
+        if self.batcher is None:
+            return [job]
+        # Задание уже извлечено из очереди, но модель занята им.
+        self.running.add(job)
+        if (self.batcher.window > 0
+                and self.batcher.count_compatible(job, self.pending)
+                < self.batcher.max_batch_size - 1):
+            await asyncio.sleep(self.batcher.window)
+        async with self.condition:
+            batch = self.batcher.take_batch(job,
+                                            self.pending)
+        self.batch_sizes[len(batch)] += 1
+        return batch
+
+    @staticmethod
+    def _run_batch(batch: list[GenerationJob]):
+        function = batch[0].function
+        # Пакет останавливается, только когда он не нужен ни одному
+        # заданию.
+        return function([job.args for job in batch],
+                        [job.kwargs for job in batch],
+                        should_stop=lambda: all(job.stop_event.is_set()
+                                                for job in batch))
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._pop()
+            if job.batch_key is None:
+                batch = [job]
+                call = functools.partial(job.function,
+                                         *job.args,
+                                         **job.kwargs)
+            else:
+                batch = await self._take_batch(job)
+                call = functools.partial(self._run_batch,
+                                         batch)
+
+            # Истечение времени не освобождает поток: модель нельзя
+            # передать следующему заданию, пока она выполняет текущее.
+            timers = []
+            for batch_job in batch:
+                batch_job.started_at = time.monotonic()
+                self.running.add(batch_job)
+                if batch_job.timeout is not None:
+                    timers.append(loop.call_later(batch_job.timeout,
+                                                  batch_job.expire))
+            try:
+                result = await loop.run_in_executor(self.executor,
+                                                    call)
+                results = [result] if job.batch_key is None else result
+                for batch_job, batch_result in zip(batch, results):
+                    if not batch_job.future.done():
+                        batch_job.future.set_result(batch_result)
+            except Exception as e:
+                for batch_job in batch:
+                    if not batch_job.future.done():
+                        batch_job.future.set_exception(e)
+            finally:
+                for timer in timers:
+                    timer.cancel()
+                for batch_job in batch:
+                    batch_job.finished_at = time.monotonic()
+                    self.running.discard(batch_job)
+                    self.completed += 1
+                    if batch_job.timed_out:
+                        self.timed_out += 1
+                    elif batch_job.stop_event.is_set():
+                        self.interrupted += 1
+                    self.total_wait_time += batch_job.wait_time
+                    self.total_service_time += batch_job.service_time
+
+    def position(self,
+                 job: GenerationJob):
+        if job.started or job.future.done():
+            return 0
+        return 1 + sum(1 for other in self.pending
+                       if other < job and not other.future.done())
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks,
+                             return_exceptions=True)
+        for job in self.pending:
+            job.future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False,
+                               cancel_futures=True)
+
+
+class GenerationScheduler:
+    """
+    Планировщик генерации: для каждой модели своя очередь с приоритетами
+    и ограниченным количеством одновременно выполняемых заданий.
+
+    Attributes:
+        workers_per_model(int): Количество потоков на модель по
+        умолчанию.
+        workers(dict[str, int]): Количество потоков для отдельных
+        очередей.
+        batcher(MicroBatcher): Объединение заданий в пакеты. Если None,
+        каждое задание выполняется отдельно.
+    """
+
+    def __init__(self,
+                 workers_per_model=WORKERS_PER_MODEL,
+                 workers=None,
+                 batcher=None):
+        self.workers_per_model = workers_per_model
+        self.workers = workers or {}
+        self.batcher = batcher
+        self._queues = {}
+        self._sequence = itertools.count()
+
+    def _get_queue(self,
+                   queue_name: str):
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            queue = _JobQueue(queue_name,
+                              self.workers.get(queue_name,
+                                               self.workers_per_model),
+                              self.batcher)
+            self._queues[queue_name] = queue
+        return queue
+
+    async def submit(self,
+                     queue_name: str,
+                     function,
+                     *args,
+                     priority=PRIORITY_INTERACTIVE,
+                     batch_key=None,
+                     timeout=None,
+                     **kwargs):
+        """
+        Постановка задания в очередь модели.
+
+        Parameters:
+            queue_name(str): Имя очереди (модели).
+            function(object): Функция, выполняемая в потоке.
+            args: Аргументы функции.
+            priority(int): Приоритет задания.
+            batch_key(object): Ключ объединения заданий в пакет.
+            timeout(float): Максимальное время выполнения задания в
+            секундах. По его истечении ожидание завершается исключением
+            TimeoutError, а задание останавливается, как при отмене.
+            Модель освобождается, когда функция задания вернёт
+            управление.
+            kwargs: Именованные аргументы функции.
+
+        Returns:
+            GenerationJob: Задание, результат которого можно ожидать.
+        """
+        job = GenerationJob(queue_name,
+                            function,
+                            args,
+                            kwargs,
+                            priority,
+                            next(self._sequence),
+                            asyncio.get_running_loop().create_future(),
+                            batch_key,
+                            timeout)
+        await self._get_queue(queue_name).push(job)
+        return job
+
+    def queue_position(self,
+                       job: GenerationJob):
+        """
+        Позиция задания в очереди.
+
+        Parameters:
+            job(GenerationJob): Задание.
+
+        Returns:
+            int: Позиция, начиная с 1. Если задание уже выполняется или
+            завершено, возвращается 0.
+        """
+        return self._queues[job.queue_name].position(job)
+
+    def queue_length(self,
+                     queue_name: str):
+        """
+        Количество ожидающих заданий в очереди.
+
+        Parameters:
+            queue_name(str): Имя очереди (модели).
+
+        Returns:
+            int: Количество заданий, которые ещё не начали выполняться.
+        """
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            return 0
+        return sum(1 for job in queue.pending
+                   if not job.future.done())
+
+    def is_busy(self,
+                queue_name: str):
+        """
+        Проверка наличия ожидающих или выполняющихся заданий в очереди.
+
+        Parameters:
+            queue_name(str): Имя очереди (модели).
+
+        Returns:
+            bool: Есть ли в очереди незавершённые задания.
+        """
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            return False
+        return bool(queue.running) or any(not job.future.done()
+                                          for job in queue.pending)
+
+    def stats(self):
+        """
+        Статистика очередей.
+
+        Returns:
+            dict[str, dict]: Для каждой очереди количество ожидающих,
+            выполняемых, завершённых, прерванных и остановленных по
+            времени заданий, среднее время ожидания и выполнения,
+            гистограмма размеров пакетов.
+        """
+        result = {}
+        for name, queue in self._queues.items():
+            completed = queue.completed or 1
+            result[name] = {
+                "queued": sum(1 for job in queue.pending
+                              if not job.future.done()),
+                "running": len(queue.running),
+                "completed": queue.completed,
+                "interrupted": queue.interrupted,
+                "timed_out": queue.timed_out,
+                "avg_wait_time": queue.total_wait_time / completed,
+                "avg_service_time": queue.total_service_time / completed,
+                "batch_sizes": dict(sorted(queue.batch_sizes.items())),
+            }
+        return result
+
+    async def shutdown(self):
+        """
+        Остановка всех очередей с отменой ожидающих заданий.
+        """
+        for queue in self._queues.values():
+            await queue.close()
+        self._queues.clear()
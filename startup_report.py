@@ -0,0 +1,60 @@
+import time
+
+# Модуль импортируется первым в main.py, поэтому время его импорта
+# считается началом запуска бота.
+STARTED_AT = time.perf_counter()
+TIME_UNITS = " с"
+
+
+class StartupReport:
+    """
+    Время этапов запуска бота.
+
+    Attributes:
+        started_at(float): Начало запуска по time.perf_counter.
+        phases(list[tuple[str, float]]): Название и длительность этапов
+        в порядке выполнения.
+    """
+
+    def __init__(self,
+                 started_at=STARTED_AT):
+        self.started_at = started_at
+        self.phases = []
+        self._last_mark = started_at
+
+    def mark(self,
+             phase: str):
+        """
+        Завершение этапа запуска: длительность считается от конца
+        предыдущего этапа.
+
+        Parameters:
+            phase(str): Название этапа.
+        """
+        now = time.perf_counter()
+        self.phases.append((phase,
+                            now - self._last_mark))
+        self._last_mark = now
+
+    def total(self):
+        """
+        Общее время запуска до последнего завершённого этапа.
+
+        Returns:
+            float: Время в секундах.
+        """
+        return self._last_mark - self.started_at
+
+    def format(self):
+        """
+        Текст отчёта по этапам запуска.
+
+        Returns:
+            str: По строке на этап и строка с общим временем.
+        """
+        width = max((len(phase) for phase, _ in self.phases),
+                    default=0)
+        lines = [f"{phase:<{width}} {duration:8.3f}{TIME_UNITS}"
+                 for phase, duration in self.phases]
+        lines.append(f"{'total':<{width}} {self.total():8.3f}{TIME_UNITS}")
+        return "\n".join(lines)
@@ -1,123 +1,516 @@
-import matplotlib.pyplot as plt
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-STATS_PATH = "images/stats/"
-GRAPH_NAME = "graph.png"
+import numpy as np
+
+GRAPH_FORMAT = "png"
+DASHBOARD_NAME = "dashboard.png"
+# Размер одного графика на общем изображении в дюймах.
+DASHBOARD_PANEL_SIZE = (6.4, 4.0)
+DASHBOARD_MARGINS = {"left": 0.07, "right": 0.98, "bottom": 0.13,
+                     "top": 0.91, "wspace": 0.22}
+# Сжатие PNG: меньший уровень быстрее, размер изображения меньше важен.
+DASHBOARD_COMPRESS_LEVEL = 3
 AVG_TIME_GENERATED_NAME = "Среднее время генерации изображения: "
 AVG_TIME_LOADED_NAME = "Среднее время загрузки модели: "
+AVG_TIME_CANCELLED_NAME = "Отменено игроком, среднее время до отмены: "
+AVG_TIME_TIMED_OUT_NAME = ("Остановлено по времени, среднее время до "
+                           "остановки: ")
+AVG_TIME_FIRST_IMAGE_NAME = "Среднее время до первого изображения: "
+PERCENTILES_NAME = "p50 / p95 / p99: "
+MIN_MAX_NAME = "Минимум / максимум: "
+COUNT_NAME = "Количество измерений: "
+VALUES_SEPARATOR = " / "
 TIME_GENERATED_NAME = "Время генерации изображения"
 TIME_LOADED_NAME = "Время загрузки нейросети"
 INDEX_NAME = "Номер измерения"
 SHOW_CUSTOM_TICKETS = True
+MOVING_AVERAGE_WINDOW = 10
+OUTLIER_IQR_FACTOR = 1.5
 SHOW_STATISTICS = True
 COLLECT_STATISTIC = True
+# Количество процессов для построения графиков.
+CHART_WORKERS = 2
+# Процессы создаются копированием уже запущенного бота, чтобы не
+# импортировать main.py заново. Там, где fork недоступен, используется
+# spawn.
+CHART_START_METHOD = ("fork"
+                      if "fork" in multiprocessing.get_all_start_methods()
+                      else "spawn")
 
 
-async def get_lists_by_neural_networks(statistics_detailed_data):
+async def get_summary_texts(statistics_data):
     """
-    Получение статистики по времени генерации изображения и загрузки нейросетей.
+    Получение текста сводной статистики по каждой нейросети.
 
     Parameters:
-        statistics_detailed_data(Any): Статистика по времени генерации изображения и загрузки нейросетей из БД.
+        statistics_data(list[StatisticRollup]): Сводная статистика из БД, упорядоченная по названию нейросети.
 
     Returns:
-        list[list[tuple[Any, Any, Any]]]: Список списков времени генерации изображений и скорости загрузки нейросетей,
-                                          и списков индексов.
+        list[str]: Текст статистики по каждой нейросети.
     """
-    lists_by_neural_networks = []
-    current_neural_network_list = []
+    average_names = {"time_generated": AVG_TIME_GENERATED_NAME,
+                     "time_loaded": AVG_TIME_LOADED_NAME,
+                     "time_cancelled": AVG_TIME_CANCELLED_NAME,
+                     "time_timed_out": AVG_TIME_TIMED_OUT_NAME,
+                     "time_first_image": AVG_TIME_FIRST_IMAGE_NAME}
+    texts = []
     last_neural_network_name = None
-    last_neural_network = None
 
-    for stat in statistics_detailed_data:
-        if (last_neural_network_name != stat.neural_network_name
-                or last_neural_network_name is None):
-            current_neural_network_list = []
-            lists_by_neural_networks.append(current_neural_network_list)
+    for stat in statistics_data:
+        if last_neural_network_name != stat.neural_network_name:
+            texts.append(stat.neural_network_name + ": \n")
             last_neural_network_name = stat.neural_network_name
 
-        last_neural_network = (stat.neural_network_name,
-                               stat.time_loaded,
-                               stat.time_generated)
+        text = average_names[stat.metric] + f"{stat.average:.2f}\n"
+        text += PERCENTILES_NAME + VALUES_SEPARATOR.join(
+            f"{value:.2f}" for value in stat.get_percentiles()) + "\n"
+        text += (MIN_MAX_NAME + f"{stat.min_value:.2f}" + VALUES_SEPARATOR
+                 + f"{stat.max_value:.2f}\n")
+        text += COUNT_NAME + str(stat.count) + "\n\n"
+        texts[-1] += text
+
+    return texts
+
+
+class MetricSeries:
+    """
+    Измерения одной нейросети по одному полю статистики.
+
+    Attributes:
+        neural_network_name(str): Название нейросети.
+        indexes(np.ndarray): Номера измерений, начиная с 1.
+        values(np.ndarray): Значения измерений.
+        moving_average(np.ndarray): Скользящее среднее за
+        MOVING_AVERAGE_WINDOW измерений.
+        outliers(np.ndarray): Признак выброса для каждого измерения.
+    """
+    __slots__ = ("neural_network_name", "indexes", "values",
+                 "moving_average", "outliers")
 
-        current_neural_network_list.append(last_neural_network)
+    def __init__(self,
+                 neural_network_name: str,
+                 indexes: np.ndarray,
+                 values: np.ndarray,
+                 moving_average: np.ndarray,
+                 outliers: np.ndarray):
+        self.neural_network_name = neural_network_name
+        self.indexes = indexes
+        self.values = values
+        self.moving_average = moving_average
+        self.outliers = outliers
 
-    return lists_by_neural_networks
 
+class StatisticColumns:
+    """
+    Детальная статистика по столбцам в памяти. Записи статистики только
+    добавляются, поэтому при обновлении из БД читаются лишь новые записи.
 
-async def get_time_generated_list_and_indexes(lists_by_neural_networks):
+    Attributes:
+        names(list[str]): Названия нейросетей в порядке появления.
+        last_id(int): Id последней прочитанной записи.
+        codes(np.ndarray): Номер названия нейросети для каждой записи.
+        time_generated(np.ndarray): Время генерации, NaN для записей без значения.
+        time_loaded(np.ndarray): Время загрузки, NaN для записей без значения.
     """
-    Получение списка времени генерации изображения, время загрузки нейросетей, и списка индексов.
+
+    def __init__(self):
+        self.names = []
+        self.last_id = 0
+        self.codes = np.empty(0, dtype=np.int16)
+        self.time_generated = np.empty(0)
+        self.time_loaded = np.empty(0)
+        self._codes_by_name = {}
+        self._order = np.empty(0, dtype=np.intp)
+        self._sorted_codes = np.empty(0, dtype=np.int16)
+        self._series = {}
+        self._lock = asyncio.Lock()
+
+    def _get_code(self,
+                  name: str):
+        code = self._codes_by_name.get(name)
+        if code is None:
+            code = self._codes_by_name[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    async def refresh(self,
+                      database):
+        """
+        Чтение новых записей статистики из БД.
+
+        Parameters:
+            database(AsyncDatabase): Асинхронный доступ к БД.
+        """
+        async with self._lock:
+            (names,
+             ids,
+             codes,
+             time_generated,
+             time_loaded) = await database.get_statistic_columns(self.last_id)
+            if len(ids) == 0:
+                return
+
+            mapping = np.array([self._get_code(name) for name in names],
+                               dtype=np.int16)
+            self.codes = np.concatenate((self.codes, mapping[codes]))
+            self.time_generated = np.concatenate((self.time_generated,
+                                                  time_generated))
+            self.time_loaded = np.concatenate((self.time_loaded,
+                                               time_loaded))
+            self.last_id = int(ids[-1])
+
+            # Порядок записей, сгруппированных по названию нейросети по
+            # алфавиту, с сохранением порядка измерений внутри группы.
+            ranks = np.empty(len(self.names), dtype=np.int16)
+            ranks[np.argsort(self.names)] = np.arange(len(self.names))
+            self._order = np.argsort(ranks[self.codes], kind="stable")
+            self._sorted_codes = ranks[self.codes][self._order]
+
+    async def get_series(self,
+                         metric: str,
+                         window=MOVING_AVERAGE_WINDOW):
+        """
+        Измерения по каждой нейросети в порядке названий. Результат
+        сохраняется до появления новых записей.
+
+        Parameters:
+            metric(str): Столбец: time_generated или time_loaded.
+            window(int): Количество измерений в скользящем среднем.
+
+        Returns:
+            list[MetricSeries]: Измерения по каждой нейросети.
+        """
+        key = (metric, window)
+        cached = self._series.get(key)
+        if cached is not None and cached[0] == self.last_id:
+            return cached[1]
+
+        series = await get_metric_series(sorted(self.names),
+                                         self._sorted_codes,
+                                         getattr(self, metric)[self._order],
+                                         window)
+        self._series[key] = (self.last_id, series)
+        return series
+
+
+async def get_metric_series(names: list[str],
+                            codes: np.ndarray,
+                            values: np.ndarray,
+                            window=MOVING_AVERAGE_WINDOW):
+    """
+    Разделение измерений по нейросетям с расчётом номеров измерений, скользящего среднего и выбросов.
+    Все расчёты выполняются над массивами целиком, цикл идёт только по нейросетям.
 
     Parameters:
-        lists_by_neural_networks(list[list[tuple[Any, Any, Any]]]): Список списков времени генерации изображения,
-                                                                    времени загрузки нейросетей, и списков индексов.
+        names(list[str]): Названия нейросетей.
+        codes(np.ndarray): Номер названия нейросети для каждой записи, по возрастанию.
+        values(np.ndarray): Значения измерений, NaN для записей без значения.
+        window(int): Количество измерений в скользящем среднем.
+
     Returns:
-        Any: Список времени генерации изображения, времени загрузки нейросетей и списков индексов.
-    """
-    lists_time_generated = []
-    lists_time_generated_indexes = []
-    lists_time_loaded = []
-    lists_time_loaded_indexes = []
-    for split_lists_by_neural_networks in lists_by_neural_networks:
-        list_time_generated = []
-        list_time_generated_indexes = []
-        current_time_generated_index = 0
-
-        list_time_loaded = []
-        list_time_loaded_indexes = []
-        current_time_loaded_index = 0
-
-        for stat in split_lists_by_neural_networks:
-            name, time_loaded, time_generated = stat
-            if time_generated is not None:
-                list_time_generated.append(time_generated)
-                current_time_generated_index += 1
-                list_time_generated_indexes.append(current_time_generated_index)
-
-            if time_loaded is not None:
-                list_time_loaded.append(time_loaded)
-                current_time_loaded_index += 1
-                list_time_loaded_indexes.append(current_time_loaded_index)
-
-        lists_time_generated.append(list_time_generated)
-        lists_time_generated_indexes.append(list_time_generated_indexes)
-        lists_time_loaded.append(list_time_loaded)
-        lists_time_loaded_indexes.append(list_time_loaded_indexes)
-
-    return (lists_time_generated,
-            lists_time_generated_indexes,
-            lists_time_loaded,
-            lists_time_loaded_indexes)
-
-
-async def create_graph(list_indexes,
-                       lists_values,
-                       title,
-                       xlabel,
-                       ylabel,
-                       xticks,
-                       yticks):
-    """
-    Создание графика скорости генерации изображения или загрузки нейросети.
+        list[MetricSeries]: Измерения по каждой нейросети в порядке names.
+    """
+    present = ~np.isnan(values)
+    codes = codes[present]
+    values = values[present]
+    positions = np.arange(len(values))
+
+    # Границы нейросетей в отсортированном по номеру названия массиве.
+    bounds = np.searchsorted(codes, np.arange(len(names) + 1))
+    starts = bounds[codes]
+    indexes = positions - starts + 1
+
+    # Скользящее среднее по накопленным суммам с обнулением на границах
+    # нейросетей.
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    lower = np.maximum(positions + 1 - window, starts)
+    moving_average = ((sums[positions + 1] - sums[lower])
+                      / (positions + 1 - lower))
+
+    # Выбросы по правилу Тьюки: дальше OUTLIER_IQR_FACTOR межквартильных
+    # размахов от квартилей своей нейросети.
+    outliers = np.zeros(len(values), dtype=np.bool_)
+    series = []
+    for code, name in enumerate(names):
+        start, end = bounds[code], bounds[code + 1]
+        if end > start:
+            q1, q3 = np.percentile(values[start:end], (25, 75))
+            spread = OUTLIER_IQR_FACTOR * (q3 - q1)
+            outliers[start:end] = ((values[start:end] < q1 - spread)
+                                   | (values[start:end] > q3 + spread))
+        series.append(MetricSeries(name,
+                                   indexes[start:end],
+                                   values[start:end],
+                                   moving_average[start:end],
+                                   outliers[start:end]))
+
+    return series
+
+
+def _draw_series(axes,
+                 list_indexes,
+                 lists_values,
+                 title,
+                 xlabel,
+                 ylabel,
+                 xticks,
+                 yticks,
+                 moving_average=None,
+                 outliers=None):
+    """
+    Построение на осях axes графика скорости генерации изображения или загрузки нейросети.
+    Используется объектный интерфейс matplotlib без глобального состояния pyplot, поэтому функция может
+    выполняться одновременно в нескольких потоках и процессах.
 
     Parameters:
-        list_indexes(list[int]): Список индексов измерений.
-        lists_values(list[float]): Список значений.
+        axes(Axes): Оси графика.
+        list_indexes(np.ndarray): Номера измерений.
+        lists_values(np.ndarray): Значения.
         title(str): Заголовок графика.
         xlabel(str): Заголовок оси х.
         ylabel(str): Заголовок оси y.
         xticks(list[float]): Список значений, отмечаемых на оси х.
         yticks(list[float]): Список значений, отмечаемых на оси y.
+        moving_average(np.ndarray): Скользящее среднее значений.
+        outliers(np.ndarray): Признак выброса для каждого значения.
     """
-    plt.plot(list_indexes,
-             lists_values)
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
+    axes.plot(list_indexes,
+              lists_values)
+    if moving_average is not None:
+        axes.plot(list_indexes,
+                  moving_average)
+    if outliers is not None and outliers.any():
+        axes.scatter(list_indexes[outliers],
+                     lists_values[outliers],
+                     color="red")
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
     if not SHOW_CUSTOM_TICKETS:
-        plt.xticks(xticks)
-        plt.yticks(yticks)
-    plt.savefig(STATS_PATH + GRAPH_NAME)
-    plt.clf()
+        axes.set_xticks(xticks)
+        axes.set_yticks(yticks)
+
+
+def _create_figure(**kwargs):
+    # matplotlib импортируется при первом построении графика в процессе
+    # построения графиков, а не при запуске бота.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(**kwargs)
+    return figure, FigureCanvasAgg(figure)
+
+
+def render_dashboard_row(graphs):
+    """
+    Построение строки общего изображения статистики: графики одной нейросети рядом друг с другом.
+
+    Parameters:
+        graphs(list[tuple]): Аргументы _draw_series для каждого графика строки.
+
+    Returns:
+        np.ndarray: Изображение строки в формате RGBA.
+    """
+    figure, canvas = _create_figure(
+        figsize=(DASHBOARD_PANEL_SIZE[0] * len(graphs),
+                 DASHBOARD_PANEL_SIZE[1]))
+    axes = figure.subplots(1,
+                           len(graphs),
+                           squeeze=False)
+    for column_index, graph in enumerate(graphs):
+        _draw_series(axes[0][column_index],
+                     *graph)
+    figure.subplots_adjust(**DASHBOARD_MARGINS)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def compose_dashboard(rows):
+    """
+    Объединение строк в одно изображение статистики.
+
+    Parameters:
+        rows(list[np.ndarray]): Изображения строк в формате RGBA одинаковой ширины.
+
+    Returns:
+        bytes: Изображение в формате PNG.
+    """
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(np.vstack(rows)).save(buffer,
+                                          format=GRAPH_FORMAT,
+                                          compress_level=DASHBOARD_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def get_graph_arguments(series: MetricSeries,
+                        title: str):
+    """
+    Аргументы _draw_series для графика измерений нейросети.
+
+    Parameters:
+        series(MetricSeries): Измерения нейросети.
+        title(str): Название поля статистики.
+
+    Returns:
+        tuple: Аргументы _draw_series без осей графика.
+    """
+    return (series.indexes,
+            series.values,
+            title + " " + series.neural_network_name,
+            INDEX_NAME,
+            title,
+            series.indexes,
+            series.values,
+            series.moving_average,
+            series.outliers)
+
+
+def _warm_up():
+    _create_figure()
+    return os.getpid()
+
+
+class ChartRenderer:
+    """
+    Построение графиков в пуле процессов. Готовые графики хранятся до
+    изменения версии статистики, поэтому повторный просмотр статистики
+    без новых данных не строит графики заново.
+
+    Attributes:
+        workers(int): Количество процессов.
+        rendered(int): Количество построенных графиков.
+        rows_rendered(int): Количество построенных строк общего изображения.
+        cache_hits(int): Количество графиков, взятых из кэша.
+    """
+
+    def __init__(self,
+                 workers=CHART_WORKERS):
+        self.workers = workers
+        self.rendered = 0
+        self.cache_hits = 0
+        self._executor = None
+        self.rows_rendered = 0
+        self._version = None
+        self._charts = {}
+        self._rows = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            context = multiprocessing.get_context(CHART_START_METHOD)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=context)
+        return self._executor
+
+    def start(self):
+        """
+        Запуск процессов до начала обработки сообщений, пока у бота нет
+        рабочих потоков. Процессы создаются сразу, а импорт matplotlib в
+        них выполняется в фоне и не задерживает запуск бота.
+        """
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_warm_up)
+
+    async def _run(self,
+                   function,
+                   *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(),
+                                              function,
+                                              *args)
+        except BrokenProcessPool:
+            self._executor = None
+            raise
+
+    async def _cached(self,
+                      key,
+                      version: int,
+                      create):
+        if version != self._version:
+            self._charts = {}
+            self._version = version
+
+        chart = self._charts.get(key)
+        if chart is not None:
+            self.cache_hits += 1
+            return await asyncio.shield(chart)
+
+        chart = asyncio.ensure_future(create())
+        self._charts[key] = chart
+        try:
+            data = await asyncio.shield(chart)
+        except Exception:
+            if self._charts.get(key) is chart:
+                del self._charts[key]
+            raise
+        self.rendered += 1
+        return data
+
+    async def _render_row(self,
+                          graphs: list[tuple]):
+        return await self._run(render_dashboard_row,
+                               graphs)
+
+    async def _render_dashboard(self,
+                                series_generated: list[MetricSeries],
+                                series_loaded: list[MetricSeries]):
+        # Записи статистики только добавляются, поэтому строка нейросети
+        # меняется только вместе с количеством её измерений.
+        rows = {}
+        for generated, loaded in zip(series_generated, series_loaded):
+            key = (generated.neural_network_name,
+                   len(generated.values),
+                   len(loaded.values))
+            row = self._rows.get(key)
+            if row is None or (row.done() and row.exception() is not None):
+                row = asyncio.ensure_future(self._render_row(
+                    [get_graph_arguments(generated, TIME_GENERATED_NAME),
+                     get_graph_arguments(loaded, TIME_LOADED_NAME)]))
+                self.rows_rendered += 1
+            rows[key] = row
+        self._rows = rows
+
+        images = await asyncio.gather(*rows.values())
+        return await asyncio.to_thread(compose_dashboard,
+                                       images)
+
+    async def render_dashboard(self,
+                               series_generated: list[MetricSeries],
+                               series_loaded: list[MetricSeries],
+                               version: int):
+        """
+        Построение общего изображения со статистикой всех нейросетей. Строки нейросетей строятся
+        параллельно в пуле процессов, и заново строятся только строки нейросетей с новыми измерениями.
+
+        Parameters:
+            series_generated(list[MetricSeries]): Время генерации изображений по нейросетям.
+            series_loaded(list[MetricSeries]): Время загрузки по нейросетям в том же порядке.
+            version(int): Версия статистики.
+
+        Returns:
+            bytes: Изображение в формате PNG. Если статистики нет, возвращается None.
+        """
+        if not series_generated:
+            return None
+        return await self._cached(DASHBOARD_NAME,
+                                  version,
+                                  lambda: self._render_dashboard(
+                                      series_generated,
+                                      series_loaded))
 
-    return STATS_PATH + GRAPH_NAME
+    def close(self):
+        """
+        Остановка пула процессов.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True,
+                                    cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,204 @@
+import asyncio
+
+import db
+from async_db import AsyncDatabase
+
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 5.0
+# Максимальное количество записей в буфере. Записи, которые не удалось
+# сохранить, остаются в буфере до следующей записи, а при превышении
+# размера удаляются самые старые.
+MAX_BUFFER_SIZE = 10_000
+
+
+class StatisticWriter:
+    """
+    Буферизованная запись статистики. Записи добавляются в буфер без
+    обращения к БД и сохраняются пакетами в одной транзакции в потоке
+    БД, когда буфер заполнен или прошло FLUSH_INTERVAL секунд.
+
+    Attributes:
+        database(AsyncDatabase): Асинхронный доступ к БД.
+        flush_size(int): Количество записей, при котором буфер
+        сохраняется сразу.
+        flush_interval(float): Максимальное время хранения записи в
+        буфере в секундах.
+        written(int): Количество сохранённых записей.
+        flushes(int): Количество транзакций записи.
+        failures(int): Количество неудачных транзакций записи.
+        dropped(int): Количество записей, удалённых из переполненного
+        буфера.
+    """
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.database = database
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self._buffer = []
+        # Записи сохраняются по одной транзакции за раз.
+        self._flush_lock = asyncio.Lock()
+        self._flush_event = None
+        self._task = None
+
+    def _start(self):
+        if self._task is None:
+            self._flush_event = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def add(self,
+            record: dict):
+        """
+        Добавление записи статистики в буфер. Должно вызываться из цикла
+        событий.
+
+        Parameters:
+            record(dict): Запись статистики с полями модели Statistic.
+        """
+        self._start()
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_size:
+            self._flush_event.set()
+
+    def add_metric(self,
+                   neural_network_name: str,
+                   metric: str,
+                   value: float):
+        """
+        Добавление одного измерения. Остальные поля записи пустые, чтобы
+        все записи пакета имели одинаковые поля.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            metric(str): Поле статистики из STATISTIC_METRICS.
+            value(float): Значение в секундах.
+        """
+        record = dict.fromkeys(db.STATISTIC_METRICS)
+        record["neural_network_name"] = neural_network_name
+        record[metric] = value
+        self.add(record)
+
+    def add_generated(self,
+                      neural_network_name: str,
+                      time_generated: float):
+        """
+        Добавление статистики по времени генерации изображения.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            time_generated(float): Время генерации изображения.
+        """
+        self.add_metric(neural_network_name,
+                        "time_generated",
+                        time_generated)
+
+    def add_loaded(self,
+                   neural_network_name: str,
+                   time_loaded: float):
+        """
+        Добавление статистики по времени загрузки нейронной сети.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            time_loaded(float): Время загрузки нейронной сети.
+        """
+        self.add_metric(neural_network_name,
+                        "time_loaded",
+                        time_loaded)
+
+    def add_cancelled(self,
+                      neural_network_name: str,
+                      time_cancelled: float):
+        """
+        Добавление статистики по генерации, отменённой игроком.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            time_cancelled(float): Время от запроса до отмены.
+        """
+        self.add_metric(neural_network_name,
+                        "time_cancelled",
+                        time_cancelled)
+
+    def add_timed_out(self,
+                      neural_network_name: str,
+                      time_timed_out: float):
+        """
+        Добавление статистики по генерации, остановленной по превышению
+        времени.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            time_timed_out(float): Время от запроса до остановки.
+        """
+        self.add_metric(neural_network_name,
+                        "time_timed_out",
+                        time_timed_out)
+
+    def add_first_image(self,
+                        neural_network_name: str,
+                        time_first_image: float):
+        """
+        Добавление статистики по времени до первого изображения.
+
+        Parameters:
+            neural_network_name(str): Название нейронной сети.
+            time_first_image(float): Время от запроса до отправки
+            первого изображения.
+        """
+        self.add_metric(neural_network_name,
+                        "time_first_image",
+                        time_first_image)
+
+    async def flush(self):
+        """
+        Сохранение всех записей буфера одной транзакцией. Если записать
+        не удалось, записи возвращаются в начало буфера.
+        """
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            records = self._buffer
+            self._buffer = []
+            try:
+                await self.database.add_statistics(records)
+            except Exception:
+                self.failures += 1
+                self._buffer = records + self._buffer
+                overflow = len(self._buffer) - MAX_BUFFER_SIZE
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+                raise
+            self.written += len(records)
+            self.flushes += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(),
+                                       timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(e)
+
+    async def close(self):
+        """
+        Остановка фоновой записи с сохранением оставшихся записей.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task,
+                                 return_exceptions=True)
+            self._task = None
+        await self.flush()
@@ -4,10 +4,24 @@ NEURO_LOADING_TIME = "Время загрузки нейросети: "
 NEURO_IN_PROCESS = "Нейросеть загружается: "
 NEURO_SELECT = "Выберете нейросеть для генерации изображений:"
 GENERATION_IN_PROCESS = "Генерация изображения: "
+GENERATION_STEP = "Генерация изображения: шаг {} из {}"
 GENERATION_TIME = "Время генерации изображения: "
 GENERATION_ERROR = "Ошибка генерации изображения"
+GENERATION_CANCELLED = "Генерация изображения отменена"
+GENERATION_CANCELLING = "Генерация будет остановлена"
+GENERATION_NOT_CANCELLED = "Генерация уже завершена"
+GENERATION_TIMEOUT = "Генерация изображения заняла слишком много времени"
+NEURO_LOADING_ERROR = "Ошибка загрузки нейросети"
 NEURO_INIT_TIME = "Время инициализации нейросети: "
 TIME_UNITS = " с"
+QUEUE_POSITION = "Позиция в очереди: "
+QUEUE_WAITING = "Ожидание в очереди"
+QUEUE_WAIT_TIME = "Время ожидания в очереди: "
+QUEUE_POSITION_OF = " из "
+QUEUE_FULL = "Сейчас слишком много запросов, попробуйте позже"
+RATE_LIMITED = "Слишком частые запросы генерации, изображение не создано. Подождите немного"
+REQUEST_COALESCED = "Будет показана последняя выбранная локация"
+BUTTON_OUTDATED = "Кнопка больше не действует"
 
 BOT_START = "Бот запущен"
 
@@ -0,0 +1,134 @@
+import asyncio
+import secrets
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import (SimpleRequestHandler,
+                                            setup_application)
+from aiohttp import web
+
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+# Время в секундах, в течение которого при остановке дожидаются
+# обработки уже принятых обновлений.
+SHUTDOWN_TIMEOUT = 30
+
+
+class WebhookServer:
+    """
+    Получение обновлений через веб-хук. Telegram отправляет обновления
+    на aiohttp-сервер бота, обновление подтверждается сразу, а
+    обрабатывается в фоне диспетчером.
+
+    Запросы без заголовка с секретом отклоняются. Если секрет не задан,
+    он создаётся при запуске: веб-хук регистрируется заново при каждом
+    запуске бота.
+
+    Attributes:
+        dispatcher(Dispatcher): Диспетчер бота.
+        bot(Bot): Бот.
+        url(str): Внешний адрес сервера без пути веб-хука.
+        path(str): Путь веб-хука.
+        host(str): Адрес, на котором принимаются соединения.
+        port(int): Порт, на котором принимаются соединения.
+        secret_token(str): Секрет, который Telegram передаёт в заголовке
+        X-Telegram-Bot-Api-Secret-Token.
+        shutdown_timeout(float): Время ожидания обработки принятых
+        обновлений при остановке.
+    """
+
+    def __init__(self,
+                 dispatcher: Dispatcher,
+                 bot: Bot,
+                 url: str,
+                 secret_token=None,
+                 path=WEBHOOK_PATH,
+                 host=WEBHOOK_HOST,
+                 port=WEBHOOK_PORT,
+                 shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.url = url.rstrip("/")
+        self.path = path
+        self.host = host
+        self.port = port
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.shutdown_timeout = shutdown_timeout
+        self._handler = None
+        self._runner = None
+
+    async def start(self):
+        """
+        Запуск сервера и регистрация веб-хука в Telegram. Обновления,
+        пришедшие пока бот был остановлен, пропускаются.
+        """
+        app = web.Application()
+        self._handler = SimpleRequestHandler(dispatcher=self.dispatcher,
+                                             bot=self.bot,
+                                             secret_token=self.secret_token)
+        self._handler.register(app,
+                               path=self.path)
+        setup_application(app,
+                          self.dispatcher,
+                          bot=self.bot)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner,
+                           host=self.host,
+                           port=self.port)
+        await site.start()
+
+        await self.bot.set_webhook(
+            url=self.url + self.path,
+            secret_token=self.secret_token,
+            allowed_updates=self.dispatcher.resolve_used_update_types(),
+            drop_pending_updates=True)
+
+    async def wait(self):
+        """
+        Ожидание сигнала остановки процесса. Если обработчики сигналов
+        не поддерживаются (Windows), ожидание прерывается отменой задачи
+        по Ctrl+C.
+        """
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        signals = (signal.SIGINT, signal.SIGTERM)
+        try:
+            for signal_number in signals:
+                loop.add_signal_handler(signal_number,
+                                        stopped.set)
+        except NotImplementedError:
+            signals = ()
+
+        try:
+            await stopped.wait()
+        finally:
+            for signal_number in signals:
+                loop.remove_signal_handler(signal_number)
+
+    async def stop(self):
+        """
+        Остановка сервера: новые запросы не принимаются, принятые
+        обновления обрабатываются в течение shutdown_timeout, затем
+        вызываются обработчики завершения диспетчера и закрывается
+        сессия бота. Веб-хук в Telegram не удаляется: при следующем
+        запуске он регистрируется заново, а обновления, пришедшие пока
+        бот был остановлен, пропускаются, как и при получении обновлений
+        опросом.
+        """
+        if self._runner is None:
+            return
+        for site in list(self._runner.sites):
+            await site.stop()
+
+        tasks = getattr(self._handler,
+                        "_background_feed_update_tasks",
+                        ())
+        if tasks:
+            await asyncio.wait(set(tasks),
+                               timeout=self.shutdown_timeout)
+
+        await self._runner.cleanup()
+        self._runner = None